@@ -0,0 +1,271 @@
+"""
+Control de admisión y contrapresión para los endpoints de análisis.
+
+Delante de los analizadores hay una cola acotada: como mucho
+OPTISCAN_ADMISION_MAX_EN_VUELO análisis a la vez y
+OPTISCAN_ADMISION_MAX_COLA solicitudes esperando turno. Lo que no cabe se
+rechaza de inmediato con 503 y Retry-After en lugar de apilar procesos
+hasta que la máquina empieza a usar swap. Opcionalmente cada cliente (IP)
+tiene un token bucket; al agotarlo recibe 429.
+
+La profundidad de la cola y los tiempos de espera se exponen en
+estadisticas() para dimensionar la flota.
+"""
+import functools
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from flask import jsonify, request
+
+from metricas import observar, ETAPA_ESPERA_ADMISION
+from plazos import AnalisisCancelado, verificar_plazo, plazo_restante
+
+ADMISION_MAX_EN_VUELO = int(os.environ.get('OPTISCAN_ADMISION_MAX_EN_VUELO', '4'))
+ADMISION_MAX_COLA = int(os.environ.get('OPTISCAN_ADMISION_MAX_COLA', '16'))
+ADMISION_ESPERA_MAX_S = float(os.environ.get('OPTISCAN_ADMISION_ESPERA_MAX_S', '10'))
+# Token bucket por cliente: solicitudes por segundo (0 = desactivado) y ráfaga
+ADMISION_TASA_CLIENTE = float(os.environ.get('OPTISCAN_ADMISION_TASA_CLIENTE', '0'))
+ADMISION_RAFAGA_CLIENTE = float(os.environ.get('OPTISCAN_ADMISION_RAFAGA_CLIENTE', '10'))
+
+# Clientes inactivos que se olvidan al superar este número de buckets
+MAX_CLIENTES = 10000
+# Ventana de muestras para los percentiles de espera
+MUESTRAS_ESPERA = 1000
+# Cada cuánto se comprueba en cola si el cliente sigue conectado
+SONDEO_COLA_S = 0.25
+
+
+class RechazoAdmision(Exception):
+    """Solicitud rechazada por capacidad (503) o por límite del cliente (429)"""
+
+    def __init__(self, estado, retry_after, motivo):
+        super().__init__(motivo)
+        self.estado = estado
+        self.retry_after = retry_after
+        self.motivo = motivo
+
+
+class TokenBucket:
+    """Token bucket de un cliente"""
+
+    def __init__(self, tasa, rafaga, ahora):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.tokens = rafaga
+        self.actualizado = ahora
+
+    def consumir(self, ahora):
+        """Consumir un token; devuelve 0 o los segundos hasta el próximo token"""
+        self.tokens = min(self.rafaga, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.tasa
+
+
+class ControlAdmision:
+    """Cola acotada con límite de análisis en vuelo"""
+
+    def __init__(self, max_en_vuelo=None, max_cola=None, espera_max_s=None,
+                 tasa_cliente=None, rafaga_cliente=None):
+        self.max_en_vuelo = ADMISION_MAX_EN_VUELO if max_en_vuelo is None else max_en_vuelo
+        self.max_cola = ADMISION_MAX_COLA if max_cola is None else max_cola
+        self.espera_max_s = ADMISION_ESPERA_MAX_S if espera_max_s is None else espera_max_s
+        self.tasa_cliente = ADMISION_TASA_CLIENTE if tasa_cliente is None else tasa_cliente
+        self.rafaga_cliente = ADMISION_RAFAGA_CLIENTE if rafaga_cliente is None else rafaga_cliente
+
+        self._condicion = threading.Condition()
+        self._buckets = {}
+        # Llegada de cada solicitud en cola (por orden): antigüedad de la más vieja
+        self._llegadas_cola = {}
+        self.en_vuelo = 0
+        self.en_cola = 0
+
+        self.admitidas = 0
+        self.rechazadas_capacidad = 0
+        self.rechazadas_cliente = 0
+        self.expiradas_en_cola = 0
+        self.canceladas_en_cola = 0
+        self.max_cola_observada = 0
+        self._esperas = deque(maxlen=MUESTRAS_ESPERA)
+        self._espera_total = 0.0
+        self._servicio_total = 0.0
+        self._servicios = 0
+
+        print(f">>> Control de admisión: {self.max_en_vuelo} en vuelo, cola {self.max_cola}, "
+              f"espera máx. {self.espera_max_s:.0f}s")
+
+    def _limitar_cliente(self, cliente, ahora):
+        # Llamar con self._condicion tomada
+        if self.tasa_cliente <= 0 or cliente is None:
+            return
+        bucket = self._buckets.get(cliente)
+        if bucket is None:
+            if len(self._buckets) >= MAX_CLIENTES:
+                self._buckets.clear()
+            bucket = self._buckets[cliente] = TokenBucket(self.tasa_cliente, self.rafaga_cliente, ahora)
+        espera = bucket.consumir(ahora)
+        if espera > 0:
+            self.rechazadas_cliente += 1
+            raise RechazoAdmision(429, espera, "Demasiadas solicitudes de este cliente")
+
+    def _estimar_retry_after(self):
+        # Llamar con self._condicion tomada
+        servicio_medio = self._servicio_total / self._servicios if self._servicios else 1.0
+        return servicio_medio * (self.en_cola + 1) / max(self.max_en_vuelo, 1)
+
+    def entrar(self, cliente=None):
+        """Esperar turno; lanza RechazoAdmision si no hay capacidad
+
+        La espera en cola cuenta dentro del plazo vigente (plazos.py): no pasa
+        de lo que le queda, y si vence o el cliente se desconecta mientras
+        espera se lanza AnalisisCancelado sin ocupar el turno.
+        """
+        inicio = time.time()
+        with self._condicion:
+            self._limitar_cliente(cliente, inicio)
+
+            if self.en_vuelo >= self.max_en_vuelo:
+                if self.en_cola >= self.max_cola:
+                    self.rechazadas_capacidad += 1
+                    raise RechazoAdmision(503, self._estimar_retry_after(), "Servidor saturado")
+
+                self.en_cola += 1
+                self.max_cola_observada = max(self.max_cola_observada, self.en_cola)
+                turno = object()
+                self._llegadas_cola[turno] = inicio
+                limite = time.monotonic() + plazo_restante(self.espera_max_s)
+                try:
+                    while True:
+                        admitida = self._condicion.wait_for(
+                            lambda: self.en_vuelo < self.max_en_vuelo,
+                            timeout=max(0.0, min(limite - time.monotonic(), SONDEO_COLA_S))
+                        )
+                        verificar_plazo('cola_admision')
+                        if admitida or time.monotonic() >= limite:
+                            break
+                except AnalisisCancelado:
+                    self.canceladas_en_cola += 1
+                    # El turno libre que pudo despertarla pasa a la siguiente en cola
+                    self._condicion.notify()
+                    raise
+                finally:
+                    self.en_cola -= 1
+                    del self._llegadas_cola[turno]
+
+                if not admitida:
+                    self.expiradas_en_cola += 1
+                    self.rechazadas_capacidad += 1
+                    raise RechazoAdmision(503, self._estimar_retry_after(),
+                                          "Tiempo de espera en cola agotado")
+
+            self.en_vuelo += 1
+            self.admitidas += 1
+            espera = time.time() - inicio
+            self._esperas.append(espera)
+            self._espera_total += espera
+
+        return time.time()
+
+    def intentar_entrar(self):
+        """Tomar un turno solo si hay uno libre y nadie espera en cola (None si no)
+
+        Para el trabajo adicional de una solicitud ya admitida (las imágenes
+        en paralelo de un lote): no hace cola ni cuenta como rechazo.
+        """
+        with self._condicion:
+            if self.en_vuelo >= self.max_en_vuelo or self.en_cola:
+                return None
+            self.en_vuelo += 1
+        return time.time()
+
+    def salir(self, admitida_en):
+        """Liberar el turno; `admitida_en` es lo que devolvió entrar()"""
+        with self._condicion:
+            self.en_vuelo -= 1
+            self._servicio_total += time.time() - admitida_en
+            self._servicios += 1
+            self._condicion.notify()
+
+    def espera_mas_antigua_s(self):
+        """Segundos que lleva en cola la solicitud que más espera (0 con la cola vacía)"""
+        with self._condicion:
+            llegada = next(iter(self._llegadas_cola.values()), None)
+        return time.time() - llegada if llegada is not None else 0.0
+
+    def estadisticas(self):
+        espera_mas_antigua = self.espera_mas_antigua_s()
+        with self._condicion:
+            esperas = sorted(self._esperas)
+            return {
+                'max_en_vuelo': self.max_en_vuelo,
+                'max_cola': self.max_cola,
+                'en_vuelo': self.en_vuelo,
+                'en_cola': self.en_cola,
+                'espera_mas_antigua_ms': round(1000 * espera_mas_antigua, 2),
+                'max_cola_observada': self.max_cola_observada,
+                'admitidas': self.admitidas,
+                'rechazadas_capacidad': self.rechazadas_capacidad,
+                'rechazadas_cliente': self.rechazadas_cliente,
+                'expiradas_en_cola': self.expiradas_en_cola,
+                'canceladas_en_cola': self.canceladas_en_cola,
+                'espera_media_ms': round(1000 * self._espera_total / self.admitidas, 2) if self.admitidas else 0.0,
+                'espera_p95_ms': round(1000 * esperas[int(0.95 * (len(esperas) - 1))], 2) if esperas else 0.0,
+                'espera_max_ms': round(1000 * esperas[-1], 2) if esperas else 0.0,
+                'servicio_medio_ms': round(1000 * self._servicio_total / self._servicios, 2) if self._servicios else 0.0,
+                'limite_cliente': {
+                    'tasa': self.tasa_cliente,
+                    'rafaga': self.rafaga_cliente,
+                    'clientes': len(self._buckets)
+                } if self.tasa_cliente > 0 else None
+            }
+
+
+def requiere_admision(control):
+    """Decorador de endpoint: pasa por el control de admisión antes de analizar
+
+    En respuestas generadas en streaming el turno se libera al cerrar la respuesta.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            if request.method == 'OPTIONS':
+                return vista(*args, **kwargs)
+
+            llegada = time.perf_counter()
+            try:
+                admitida_en = control.entrar(request.remote_addr)
+            except RechazoAdmision as e:
+                respuesta = jsonify({
+                    "success": False,
+                    "error": e.motivo,
+                    "message": "Intenta de nuevo en unos segundos"
+                })
+                respuesta.status_code = e.estado
+                respuesta.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+                return respuesta
+
+            observar(ETAPA_ESPERA_ADMISION, time.perf_counter() - llegada)
+            liberar = functools.partial(control.salir, admitida_en)
+            try:
+                respuesta = vista(*args, **kwargs)
+            except BaseException:
+                liberar()
+                raise
+
+            # Respuestas generadas en streaming (NDJSON): el análisis sigue mientras
+            # se envían, así que el turno se libera al cerrarlas. Los archivos
+            # (send_file) ya están generados y el servidor no llama a close().
+            objeto = respuesta[0] if isinstance(respuesta, tuple) else respuesta
+            if getattr(objeto, 'is_streamed', False) and not getattr(objeto, 'direct_passthrough', False):
+                objeto.call_on_close(liberar)
+            else:
+                liberar()
+            return respuesta
+
+        return envoltura
+    return decorador
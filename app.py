@@ -1,14 +1,50 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 from flask_cors import CORS
 import subprocess
 import json
 import os
-import base64
 import tempfile
-from mm import analizar_imagen_con_medidas_reales
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import cv2
+from mm import integrar_medidas_reales
+from main import AnalizadorFormaRostroAvanzado, analizar_imagen_memoria
+from tonos import AnalizadorTonoPielMejorado, analizar_tono_memoria
+from pipeline import PipelineAnalisisCompleto, eventos_resultado, EVENTO_MEDIDAS, EVENTO_TONO, EVENTO_COMPLETO
+from pool_trabajadores import PoolTrabajadores, ErrorTrabajador, memoria_proceso_mb
+from canal_resultado import leer_resultado, ErrorCanalResultado
+from imagen_solicitud import (leer_imagen_solicitud, leer_lote_solicitud, imagen_desde_entrada,
+                              ErrorImagenSolicitud, MAX_BYTES_SOLICITUD)
+from campos_respuesta import leer_campos_solicitud, filtrar_forma, filtrar_tono, ErrorCamposSolicitud
+from cache_resultados import CacheResultados, clave_cache, configuracion_cache, a_json
+from sesiones_analisis import AlmacenSesiones, campos_con_sesion, clave_imagen, leer_sesion_solicitud
+from vuelo_unico import VueloUnico
+from plazos import (Plazo, AnalisisCancelado, con_plazo, activar_plazo, plazo_actual,
+                    plazo_restante, MOTIVO_PLAZO)
+from admision import ControlAdmision, requiere_admision
+from calentamiento import (EstadoPreparacion, imagen_calentamiento, calentar_forma,
+                           calentar_tono, calentar_referencia, calentar_completo)
+from metricas import (instrumentar_app, respuesta_metricas, registro, medir, con_tiempos,
+                      copiar_contexto, latencias_recientes, ETAPA_ARCHIVO_TEMPORAL, ETAPA_SUBPROCESO)
 
 app = Flask(__name__)
 CORS(app)
+# Cuerpo máximo de una solicitud (OPTISCAN_MAX_BYTES_SOLICITUD); por encima, 413
+app.config['MAX_CONTENT_LENGTH'] = MAX_BYTES_SOLICITUD
+
+
+@app.errorhandler(413)
+def solicitud_demasiado_grande(e):
+    return jsonify({
+        "success": False,
+        "error": f"La solicitud supera el tamaño máximo de {MAX_BYTES_SOLICITUD} bytes",
+        "message": "Envía una imagen más pequeña"
+    }), 413
+
+
+# Contadores por endpoint y resultado, latencia y solicitudes en vuelo (/metrics)
+instrumentar_app(app)
 
 # Rutas a los scripts
 venv_path = "./venv"
@@ -16,106 +52,614 @@ python_path = os.path.join(venv_path, "Scripts", "python")
 main_script_path = os.path.join(os.path.dirname(__file__), "main.py")
 tonos_script_path = os.path.join(os.path.dirname(__file__), "tonos.py")
 
+# Modo de ejecución de los analizadores:
+#   "proceso"    -> analizadores residentes en este proceso (por defecto)
+#   "pool"       -> pool fijo de trabajadores pre-cargados (aislamiento de fallos)
+#   "subproceso" -> un intérprete nuevo por solicitud
+MODO_AISLAMIENTO = os.environ.get('OPTISCAN_AISLAMIENTO', 'proceso')
+
+# Modo prefork (prefork.py): el maestro importa las bibliotecas y construye los
+# analizadores sin grafo de MediaPipe; cada hijo llama a preparar_proceso_hijo()
+PREFORK = os.environ.get('OPTISCAN_PREFORK') == '1'
+
+# Configuración del pool de trabajadores (solo modo "pool")
+POOL_TAMANO = int(os.environ.get('OPTISCAN_POOL_TAMANO', '2'))
+POOL_MAX_TRABAJOS = int(os.environ.get('OPTISCAN_POOL_MAX_TRABAJOS', '200'))
+POOL_MAX_MEMORIA_MB = int(os.environ.get('OPTISCAN_POOL_MAX_MEMORIA_MB', '1024'))
+
+# Análisis por lotes (/analyze-batch): imágenes en vuelo a la vez y tamaño máximo
+LOTE_CONCURRENCIA = int(os.environ.get(
+    'OPTISCAN_LOTE_CONCURRENCIA',
+    str(POOL_TAMANO) if MODO_AISLAMIENTO == 'pool' else '4'
+))
+LOTE_MAX_IMAGENES = int(os.environ.get('OPTISCAN_LOTE_MAX_IMAGENES', '1000'))
+
+# Analizadores de larga vida: MediaPipe se carga una sola vez por proceso.
+# Cada analizador serializa internamente el acceso a su grafo FaceMesh.
+analizador_forma = None
+analizador_tono = None
+pipeline_completo = None
+pool_analisis = None
+
+# Caché de resultados por contenido de la imagen (OPTISCAN_CACHE_*)
+cache_analisis = CacheResultados()
+# El modo de aislamiento cambia el camino de los resultados: entra en la clave
+CONFIGURACION_CACHE = configuracion_cache(aislamiento=MODO_AISLAMIENTO)
+
+# Resultados de /analyze-complete que el servidor de PDF reutiliza por analysis_id
+sesiones = AlmacenSesiones()
+
+# Solicitudes idénticas simultáneas comparten un único análisis en curso
+vuelos_analisis = VueloUnico()
+
+# Cola acotada delante de los análisis (OPTISCAN_ADMISION_*). En modo pool
+# no tiene sentido admitir más análisis en vuelo que trabajadores.
+control_admision = ControlAdmision(
+    max_en_vuelo=int(os.environ.get(
+        'OPTISCAN_ADMISION_MAX_EN_VUELO',
+        str(POOL_TAMANO) if MODO_AISLAMIENTO == 'pool' else '4'
+    ))
+)
+registro.medidor('optiscan_admision_en_vuelo', 'Análisis admitidos en curso',
+                 funcion=lambda: control_admision.en_vuelo)
+registro.medidor('optiscan_admision_en_cola', 'Solicitudes esperando turno de análisis',
+                 funcion=lambda: control_admision.en_cola)
+registro.medidor('optiscan_vuelos_en_curso', 'Análisis distintos en curso (coalescencia)',
+                 funcion=lambda: vuelos_analisis.en_curso)
+
+if MODO_AISLAMIENTO == 'pool':
+    pool_analisis = PoolTrabajadores(POOL_TAMANO, POOL_MAX_TRABAJOS, POOL_MAX_MEMORIA_MB)
+elif MODO_AISLAMIENTO != 'subproceso':
+    analizador_forma = AnalizadorFormaRostroAvanzado(crear_grafo=not PREFORK)
+    analizador_tono = AnalizadorTonoPielMejorado(crear_grafo=not PREFORK)
+    pipeline_completo = PipelineAnalisisCompleto(analizador_forma, analizador_tono)
+
+
+def pasos_calentamiento():
+    """Pasadas de calentamiento de los analizadores residentes
+
+    En modo "pool" cada trabajador se calienta antes de anunciarse listo y
+    en modo "subproceso" no hay nada residente que calentar.
+    """
+    if pipeline_completo is None:
+        return []
+    imagen = imagen_calentamiento()
+    return [
+        ('forma', partial(calentar_forma, analizador_forma, imagen)),
+        ('tono', partial(calentar_tono, analizador_tono, imagen)),
+        ('referencia', partial(calentar_referencia, imagen)),
+        ('completo', partial(calentar_completo, pipeline_completo, imagen)),
+    ]
+
+
+# /ready responde 503 hasta que termine el calentamiento (en prefork, el de cada hijo)
+estado_preparacion = EstadoPreparacion()
+if not PREFORK:
+    estado_preparacion.iniciar_en_segundo_plano(pasos_calentamiento())
+
+# Hilos compartidos por todos los lotes; cada lote mantiene como mucho
+# LOTE_CONCURRENCIA imágenes en vuelo
+executor_lotes = ThreadPoolExecutor(max_workers=LOTE_CONCURRENCIA, thread_name_prefix='lote')
+
+
+def preparar_proceso_hijo():
+    """Crear en un hijo de prefork.py los grafos de MediaPipe y calentar
+
+    Las bibliotecas ya importadas se comparten con el maestro (copy-on-write).
+    """
+    if pipeline_completo is not None:
+        analizador_forma.iniciar_grafo()
+        analizador_tono.iniciar_grafo()
+    estado_preparacion.iniciar_en_segundo_plano(pasos_calentamiento())
+
+
+class ErrorScriptAnalisis(Exception):
+    """Fallo de un script de análisis ejecutado como subproceso"""
+
+    def __init__(self, mensaje, stdout='', stderr=''):
+        super().__init__(mensaje)
+        self.stdout = stdout or ''
+        self.stderr = stderr or ''
+
+
+def ejecutar_script(script_path, ruta_imagen):
+    """Ejecutar un script de análisis en un subproceso y devolver su JSON
+
+    El stdout del script es solo el canal de resultados (canal_resultado.py):
+    trae exactamente un documento JSON y los diagnósticos van por stderr.
+    """
+    # Incluye el arranque del intérprete y la carga de MediaPipe en cada llamada
+    with medir(ETAPA_SUBPROCESO):
+        result = subprocess.run([
+            python_path,
+            script_path,
+            ruta_imagen  # Pasar la ruta de la imagen como parámetro
+        ], capture_output=True, timeout=plazo_restante(30))
+
+    stderr = result.stderr.decode('utf-8', errors='replace')
+    print(f">>> Resultado del script {os.path.basename(script_path)}: {result.returncode}")
+
+    if result.returncode != 0:
+        raise ErrorScriptAnalisis(stderr, '', stderr)
+
+    try:
+        return leer_resultado(result.stdout)
+    except ErrorCanalResultado as e:
+        print(f">>> Error decodificando JSON: {e}")
+        raise ErrorScriptAnalisis(
+            "Formato de respuesta inválido del script Python",
+            result.stdout[:1000].decode('utf-8', errors='replace'),
+            stderr
+        )
+
+
+def ejecutar_en_pool(tipo, buffer_imagen, incluir=None):
+    """Ejecutar un análisis en el pool de trabajadores
+
+    El trabajador recibe el plazo restante y abandona el análisis por su
+    cuenta al vencer, sin que haya que matarlo.
+    """
+    try:
+        return pool_analisis.ejecutar(tipo, buffer_imagen, incluir=incluir,
+                                      plazo_s=plazo_restante(pool_analisis.timeout))
+    except ErrorTrabajador as e:
+        raise ErrorScriptAnalisis(str(e))
+
+
+@contextmanager
+def imagen_temporal(buffer_imagen):
+    """Archivo temporal con la imagen para los scripts del modo "subproceso"
+
+    Los modos "proceso" y "pool" analizan la imagen en memoria y no lo usan.
+    """
+    with medir(ETAPA_ARCHIVO_TEMPORAL), \
+            tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
+        temp_path = temp_file.name
+        temp_file.write(buffer_imagen)
+    print(f">>> Imagen temporal guardada en: {temp_path}")
+    try:
+        yield temp_path
+    finally:
+        # Limpiar archivo temporal
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def analizar_forma(buffer_imagen, incluir=None):
+    """Análisis de forma de rostro según el modo de aislamiento
+
+    `incluir` son los artefactos pesados pedidos (None: todos). Los scripts
+    del modo "subproceso" siempre los calculan; aquí solo se descartan.
+    """
+    if MODO_AISLAMIENTO == 'subproceso':
+        with imagen_temporal(buffer_imagen) as ruta_imagen:
+            return filtrar_forma(ejecutar_script(main_script_path, ruta_imagen), incluir)
+    if MODO_AISLAMIENTO == 'pool':
+        return ejecutar_en_pool('forma', buffer_imagen, incluir)
+
+    return analizar_imagen_memoria(buffer_imagen, analizador_forma, incluir)
+
+
+def analizar_tono(buffer_imagen, incluir=None):
+    """Análisis de tono de piel según el modo de aislamiento"""
+    if MODO_AISLAMIENTO == 'subproceso':
+        with imagen_temporal(buffer_imagen) as ruta_imagen:
+            return filtrar_tono(ejecutar_script(tonos_script_path, ruta_imagen), incluir)
+    if MODO_AISLAMIENTO == 'pool':
+        return ejecutar_en_pool('tono', buffer_imagen, incluir)
+
+    return analizar_tono_memoria(buffer_imagen, analizador_tono, incluir)
+
+
+def analizar_completo(buffer_imagen, incluir=None):
+    """Análisis completo (forma + medidas reales + tono)
+
+    En los modos "proceso" y "pool" la imagen se decodifica y los landmarks
+    se detectan una sola vez (PipelineAnalisisCompleto), todo en memoria.
+    El modo "subproceso" conserva la ejecución separada de main.py y
+    tonos.py, lanzando ambos scripts en paralelo sobre un mismo archivo
+    temporal.
+    """
+    if MODO_AISLAMIENTO == 'pool':
+        return ejecutar_en_pool('completo', buffer_imagen, incluir)
+    if MODO_AISLAMIENTO != 'subproceso':
+        return pipeline_completo.analizar_imagen(buffer_imagen, incluir)
+
+    resultados = {}
+
+    with imagen_temporal(buffer_imagen) as ruta_imagen, \
+            ThreadPoolExecutor(max_workers=1) as executor:
+        # 2. Análisis de tono de piel, en paralelo con la forma
+        print(">>> Ejecutando análisis de tono de piel...")
+        futuro_tono = executor.submit(copiar_contexto(ejecutar_script), tonos_script_path, ruta_imagen)
+
+        # 1. Análisis de forma de rostro
+        print(">>> Ejecutando análisis de forma de rostro...")
+        try:
+            forma_data = ejecutar_script(main_script_path, ruta_imagen)
+            imagen = cv2.imdecode(buffer_imagen, cv2.IMREAD_COLOR)
+            forma_data = integrar_medidas_reales(imagen, forma_data, incluir=incluir)
+            resultados['forma_rostro'] = filtrar_forma(forma_data, incluir)
+        except ErrorScriptAnalisis as e:
+            print(f">>> Error en análisis de forma: {e}")
+
+        try:
+            resultados['tono_piel'] = filtrar_tono(futuro_tono.result(), incluir)
+        except ErrorScriptAnalisis as e:
+            print(f">>> Error en análisis de tono: {e}")
+
+    return resultados
+
+
+def filtrar_completo(resultados, incluir):
+    """Quitar de un análisis completo los artefactos no pedidos"""
+    return {
+        nombre: (filtrar_forma if nombre == 'forma_rostro' else filtrar_tono)(valor, incluir)
+        for nombre, valor in resultados.items()
+    }
+
+
+def analizar_completo_compartido(buffer_imagen, incluir=None):
+    """Análisis completo coordinado con otros procesos a través de las sesiones
+
+    Si otro proceso (un hijo de prefork.py) ya analizó o está analizando la
+    misma imagen, se espera y se reutiliza su sesión. Si no, el análisis se
+    marca en curso y se publica como sesión antes de retirar la marca, para
+    que el servidor de PDF que reciba la misma imagen lo espere en lugar de
+    repetir forma, medidas reales y tono.
+    """
+    clave = clave_imagen(buffer_imagen)
+    analysis_id, resultados = sesiones.esperar_por_imagen(clave, incluir)
+    if resultados is not None:
+        print(f">>> Análisis completo reutilizado de la sesión {analysis_id}")
+        return filtrar_completo(resultados, incluir)
+
+    with sesiones.en_curso(clave, incluir):
+        resultados = analizar_completo(buffer_imagen, incluir)
+        forma = resultados.get('forma_rostro')
+        if isinstance(forma, dict) and forma.get('estado') == 'exitoso':
+            sesiones.guardar(resultados, clave, incluir)
+    return resultados
+
+
+def analizar_con_cache(tipo, funcion_analisis, buffer_imagen, incluir):
+    """Devolver (resultado, en_cache): de la caché si la imagen ya se analizó
+
+    Si la misma imagen ya se está analizando con el mismo tipo y artefactos,
+    se espera a ese análisis en lugar de lanzar otro.
+    """
+    clave = clave_cache(buffer_imagen, tipo, incluir, CONFIGURACION_CACHE)
+    resultado = cache_analisis.obtener(clave)
+    if resultado is not None:
+        print(f">>> Resultado de {tipo} servido desde caché")
+        return resultado, True
+
+    def calcular():
+        resultado = funcion_analisis(buffer_imagen, incluir)
+        # Se guarda antes de cerrar el vuelo: una solicitud que llegue justo
+        # después ya lo encuentra en la caché
+        cache_analisis.guardar(clave, resultado)
+        return resultado
+
+    resultado, compartido = vuelos_analisis.ejecutar(clave, calcular)
+    if compartido:
+        print(f">>> Resultado de {tipo} compartido con una solicitud idéntica en curso")
+    return resultado, False
+
+
+def marcar_cache(respuesta, en_cache):
+    """Cabecera X-Cache para que el cliente sepa si el resultado vino de la caché"""
+    respuesta.headers['X-Cache'] = 'HIT' if en_cache else 'MISS'
+    return respuesta
+
+
+FUNCIONES_ANALISIS = {
+    'forma': analizar_forma,
+    'tono': analizar_tono,
+    'completo': analizar_completo
+}
+
+
+def analizar_elemento_lote(indice, tipo, buffer_imagen, incluir, plazo):
+    """Analizar una imagen del lote; nunca lanza, devuelve la línea NDJSON como dict
+
+    Cada imagen tiene su propio plazo; el lote lo cancela si el cliente se va.
+    """
+    try:
+        with activar_plazo(plazo):
+            resultado, en_cache = analizar_con_cache(tipo, FUNCIONES_ANALISIS[tipo], buffer_imagen, incluir)
+        return {"index": indice, "success": True, "cache": en_cache, "data": resultado}
+    except AnalisisCancelado as e:
+        return {"index": indice, "success": False, "error": str(e)}
+    except ErrorScriptAnalisis as e:
+        return {"index": indice, "success": False, "error": str(e)}
+    except subprocess.TimeoutExpired:
+        return {"index": indice, "success": False, "error": "El análisis tardó demasiado tiempo"}
+    except Exception as e:
+        return {"index": indice, "success": False, "error": str(e)}
+
+
+def linea_ndjson(mensaje):
+    return json.dumps(mensaje, ensure_ascii=False, default=a_json) + '\n'
+
+
+def generar_lote(elementos, tipo, incluir):
+    """Analizar un lote y emitir una línea NDJSON por imagen, en orden de finalización
+
+    Las imágenes se leen a medida que hay hueco: nunca hay más de
+    LOTE_CONCURRENCIA en vuelo, así que la memoria no crece con el lote.
+    Cada imagen en vuelo ocupa un turno del control de admisión: la primera
+    el de la propia solicitud y las demás uno libre más, que se suelta al
+    terminar. Sin turnos libres, el lote sigue con una imagen a la vez.
+    """
+    pendientes = set()
+    # Plazo de cada imagen en vuelo, para cancelarlas si el cliente se va
+    plazos = {}
+    # Imagen que usa el turno de la solicitud (None si está libre)
+    futuro_solicitud = None
+
+    def terminados(bloquear):
+        nonlocal pendientes, futuro_solicitud
+        if not pendientes:
+            return []
+        hechos, pendientes = wait(pendientes, timeout=None if bloquear else 0,
+                                  return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            plazos.pop(futuro, None)
+            if futuro is futuro_solicitud:
+                futuro_solicitud = None
+        return [linea_ndjson(futuro.result()) for futuro in hechos]
+
+    try:
+        for indice, (buffer_imagen, error) in enumerate(elementos):
+            if error:
+                yield linea_ndjson({"index": indice, "success": False, "error": error})
+            else:
+                # Turno para esta imagen: el de la solicitud o uno libre del control de admisión
+                turno_extra = None
+                while futuro_solicitud is not None:
+                    if len(pendientes) < LOTE_CONCURRENCIA:
+                        turno_extra = control_admision.intentar_entrar()
+                        if turno_extra is not None:
+                            break
+                    yield from terminados(bloquear=True)
+
+                plazo = Plazo()
+                futuro = executor_lotes.submit(
+                    analizar_elemento_lote, indice, tipo, buffer_imagen, incluir, plazo
+                )
+                if turno_extra is None:
+                    futuro_solicitud = futuro
+                else:
+                    futuro.add_done_callback(lambda _, turno=turno_extra: control_admision.salir(turno))
+                plazos[futuro] = plazo
+                pendientes.add(futuro)
+
+            yield from terminados(bloquear=False)
+
+        while pendientes:
+            yield from terminados(bloquear=True)
+    finally:
+        # Cliente desconectado: no seguir con las imágenes que aún no empezaron
+        # y abandonar las que están en curso en su siguiente etapa
+        for futuro in pendientes:
+            futuro.cancel()
+            plazos[futuro].cancelar()
+
+
+def mensaje_evento(evento, datos, sse):
+    """Un evento del análisis progresivo como línea NDJSON o evento SSE"""
+    mensaje = {"event": evento, **datos}
+    if sse:
+        return f"event: {evento}\ndata: {json.dumps(mensaje, ensure_ascii=False, default=a_json)}\n\n"
+    return linea_ndjson(mensaje)
+
+
+def etapas_completo(buffer_imagen, incluir, sesion=False):
+    """(evento, datos) del análisis completo en cuanto termina cada etapa
+
+    Con el pipeline residente (modo "proceso") los eventos salen a medida
+    que terminan las etapas; si el resultado está en caché, en una sesión
+    de otro proceso o lo está calculando otra solicitud idéntica, o en los
+    modos "pool" y "subproceso", salen todos juntos al final. Con `sesion`
+    el resultado se guarda como sesión igual que en /analyze-complete.
+    """
+    clave = clave_cache(buffer_imagen, 'completo', incluir, CONFIGURACION_CACHE)
+    resultados = cache_analisis.obtener(clave)
+    if resultados is None and sesion:
+        _, resultados = sesiones.esperar_por_imagen(clave_imagen(buffer_imagen), incluir)
+    if resultados is None and pipeline_completo is None:
+        funcion_analisis = analizar_completo_compartido if sesion else analizar_completo
+        resultados, _ = analizar_con_cache('completo', funcion_analisis, buffer_imagen, incluir)
+    if resultados is not None:
+        yield from eventos_resultado(resultados)
+        return
+
+    vuelo, lider = vuelos_analisis.unirse(clave)
+    if not lider:
+        resultados = vuelos_analisis.esperar(vuelo)
+        if resultados is not None:
+            print(">>> Resultado de completo compartido con una solicitud idéntica en curso")
+            yield from eventos_resultado(resultados)
+            return
+        # El líder se desconectó: calcular sin coalescencia
+        vuelo = None
+
+    try:
+        imagen = imagen_desde_entrada(buffer_imagen)
+    except ErrorImagenSolicitud as e:
+        print(f"ERROR: No se pudo cargar la imagen: {e}")
+        etapas = eventos_resultado(pipeline_completo.resultado_sin_imagen())
+    else:
+        etapas = pipeline_completo.analizar_por_etapas(imagen, incluir)
+
+    resultados = None
+    try:
+        clave_sesion = clave_imagen(buffer_imagen)
+        with sesiones.en_curso(clave_sesion, incluir) if sesion else nullcontext():
+            for evento, datos in etapas:
+                if evento == EVENTO_COMPLETO:
+                    resultados = datos
+                    cache_analisis.guardar(clave, resultados)
+                    forma = resultados.get('forma_rostro')
+                    if sesion and isinstance(forma, dict) and forma.get('estado') == 'exitoso':
+                        sesiones.guardar(resultados, clave_sesion, incluir)
+                yield evento, datos
+    except Exception as e:
+        if vuelo is not None:
+            vuelos_analisis.terminar(clave, vuelo, error=e)
+            vuelo = None
+        raise
+    finally:
+        if vuelo is not None:
+            vuelos_analisis.terminar(clave, vuelo, resultados, abandonado=resultados is None)
+
+
+def generar_completo_progresivo(buffer_imagen, incluir, incluir_analisis, sse, plazo, sesion=False):
+    """Emitir el análisis completo por etapas (NDJSON o SSE)
+
+    Eventos: forma_rostro, recomendaciones, medidas_convertidas y tono_piel
+    en cuanto terminan, y al final "completo" con la misma respuesta que
+    /analyze-complete (data y analysis_id). Un fallo o el plazo vencido se
+    emiten como evento "error"; si el cliente se desconecta, las etapas
+    pendientes se abandonan.
+    """
+    try:
+        with activar_plazo(plazo):
+            yield from eventos_completo_progresivo(buffer_imagen, incluir, incluir_analisis, sse, sesion)
+    except AnalisisCancelado as e:
+        print(f">>> Análisis completo progresivo cancelado: {e}")
+        if e.motivo == MOTIVO_PLAZO:
+            yield mensaje_evento('error', {"success": False, "error": str(e), "etapa": e.etapa}, sse)
+    except ErrorScriptAnalisis as e:
+        yield mensaje_evento('error', {"success": False, "error": str(e)}, sse)
+    except subprocess.TimeoutExpired:
+        yield mensaje_evento('error', {"success": False, "error": "El análisis tardó demasiado tiempo"}, sse)
+    except Exception as e:
+        print(f">>> Error en análisis completo progresivo: {e}")
+        yield mensaje_evento('error', {"success": False, "error": str(e)}, sse)
+    finally:
+        # Respuesta cerrada antes de tiempo: las etapas que siguen en otros
+        # hilos se abandonan en su siguiente punto de control
+        plazo.cancelar()
+
+
+def eventos_completo_progresivo(buffer_imagen, incluir, incluir_analisis, sse, sesion=False):
+    """Mensajes NDJSON/SSE de cada evento de etapas_completo(), filtrados según `incluir`"""
+    for evento, datos in etapas_completo(buffer_imagen, incluir_analisis, sesion):
+        if evento == EVENTO_COMPLETO:
+            analysis_id = None
+            forma = datos.get('forma_rostro')
+            if sesion and isinstance(forma, dict) and forma.get('estado') == 'exitoso':
+                analysis_id = sesiones.publicar(datos, clave_imagen(buffer_imagen), incluir_analisis)
+            datos = {
+                "success": True,
+                "data": filtrar_completo(datos, incluir),
+                "analysis_id": analysis_id
+            }
+        elif evento == EVENTO_TONO:
+            datos = {"data": filtrar_tono(datos, incluir)}
+        elif evento == EVENTO_MEDIDAS:
+            datos = {"data": filtrar_forma(datos, incluir)}
+        else:
+            datos = {"data": filtrar_forma(datos, incluir) if isinstance(datos, dict) else datos}
+        yield mensaje_evento(evento, datos, sse)
+
+
+def recibir_imagen():
+    """Leer la imagen de la solicitud (multipart, binario o JSON base64)
+
+    Devuelve (buffer, None) o (None, respuesta_error).
+    """
+    try:
+        buffer_imagen = leer_imagen_solicitud(request)
+    except ErrorImagenSolicitud as e:
+        return None, (jsonify({
+            "success": False,
+            "error": f"Error al guardar la imagen: {str(e)}",
+            "message": "No se pudo procesar la imagen enviada"
+        }), e.codigo_http)
+
+    if buffer_imagen is None:
+        return None, (jsonify({
+            "success": False,
+            "error": "No se proporcionó imagen",
+            "message": "Imagen requerida para el análisis"
+        }), 400)
+
+    return buffer_imagen, None
+
+
+def recibir_campos():
+    """Leer los artefactos pedidos con "fields"/"include" (por defecto, respuesta ligera)
+
+    Devuelve (incluir, None) o (None, respuesta_error).
+    """
+    try:
+        return leer_campos_solicitud(request), None
+    except ErrorCamposSolicitud as e:
+        return None, (jsonify({
+            "success": False,
+            "error": str(e),
+            "message": "Parámetro fields/include inválido"
+        }), 400)
+
+
+def respuesta_error_script(error, mensaje):
+    """Respuesta HTTP para un fallo del script de análisis"""
+    def recortar(texto):
+        return texto[:200] + "..." if len(texto) > 200 else texto
+
+    return jsonify({
+        "success": False,
+        "error": str(error),
+        "stdout_preview": recortar(error.stdout),
+        "stderr_preview": recortar(error.stderr),
+        "message": mensaje
+    }), 500
+
+
+def respuesta_timeout():
+    """Respuesta HTTP para un análisis que excedió el tiempo límite"""
+    return jsonify({
+        "success": False,
+        "error": "El análisis tardó demasiado tiempo",
+        "message": "Timeout del análisis"
+    }), 500
+
+
 @app.route('/check-camera', methods=['GET'])
 def check_camera():
     """Endpoint para verificar que el backend funciona"""
     return jsonify({"status": "Backend Flask conectado correctamente"})
 
 @app.route('/analyze-face', methods=['POST'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
 def analyze_face():
     """Endpoint para ejecutar el análisis facial con imagen capturada"""
     try:
-        data = request.get_json()
+        buffer_imagen, error = recibir_imagen()
+        if error:
+            return error
 
-        if not data or 'image' not in data:
-            return jsonify({
-                "success": False,
-                "error": "No se proporcionó imagen",
-                "message": "Imagen requerida para el análisis"
-            }), 400
-
-        # Obtener la imagen base64 del frontend
-        image_base64 = data['image']
-
-        # Guardar la imagen temporalmente
-        try:
-            image_bytes = base64.b64decode(image_base64.split(',')[-1])
-            
-            # Crear archivo temporal
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                temp_path = temp_file.name
-                temp_file.write(image_bytes)
-            
-            print(f">>> Imagen temporal guardada en: {temp_path}")
-        except Exception as e:
-            return jsonify({
-                "success": False,
-                "error": f"Error al guardar la imagen: {str(e)}",
-                "message": "No se pudo procesar la imagen enviada"
-            }), 400
-
-        # Ejecutar el script main.py con la ruta de la imagen como parámetro
-        result = subprocess.run([
-            python_path,
-            main_script_path,
-            temp_path  # Pasar la ruta de la imagen como parámetro
-        ], capture_output=True, text=True, timeout=30, encoding='utf-8')
+        incluir, error = recibir_campos()
+        if error:
+            return error
 
-        # Limpiar archivo temporal
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        analysis_result, en_cache = analizar_con_cache('forma', analizar_forma, buffer_imagen, incluir)
 
-        print(f">>> Resultado del script: {result.returncode}")
-
-        if result.returncode == 0:
-            # Buscar el JSON en la salida
-            lines = result.stdout.strip().split('\n')
-            json_line = None
-
-            for line in reversed(lines):
-                line = line.strip()
-                if line.startswith('{') and line.endswith('}'):
-                    try:
-                        json.loads(line)
-                        json_line = line
-                        break
-                    except Exception:
-                        continue
-
-            if not json_line:
-                json_line = lines[-1] if lines else ""
-
-            print(f">>> JSON encontrado: {json_line[:100]}...")
-
-            try:
-                analysis_result = json.loads(json_line)
-                return jsonify({
-                    "success": True,
-                    "data": analysis_result,
-                    "message": "Análisis completado exitosamente"
-                })
-            except json.JSONDecodeError as e:
-                print(f">>> Error decodificando JSON: {e}")
-                return jsonify({
-                    "success": False,
-                    "error": "Formato de respuesta inválido del script Python",
-                    "stdout_preview": result.stdout[:200] + "..." if len(result.stdout) > 200 else result.stdout,
-                    "stderr_preview": result.stderr[:200] + "..." if result.stderr and len(result.stderr) > 200 else result.stderr
-                }), 500
-        else:
-            return jsonify({
-                "success": False,
-                "error": result.stderr,
-                "stdout": result.stdout,
-                "message": "Error en el análisis facial"
-            }), 500
+        return marcar_cache(jsonify({
+            "success": True,
+            "data": analysis_result,
+            "message": "Análisis completado exitosamente"
+        }), en_cache)
 
+    except ErrorScriptAnalisis as e:
+        return respuesta_error_script(e, "Error en el análisis facial")
     except subprocess.TimeoutExpired:
-        return jsonify({
-            "success": False,
-            "error": "El análisis tardó demasiado tiempo",
-            "message": "Timeout del análisis"
-        }), 500
+        return respuesta_timeout()
     except Exception as e:
         return jsonify({
             "success": False,
@@ -124,100 +668,32 @@ def analyze_face():
         }), 500
 
 @app.route('/analyze-skin-tone', methods=['POST'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
 def analyze_skin_tone():
     """Endpoint para análisis de tono de piel"""
     try:
-        data = request.get_json()
+        buffer_imagen, error = recibir_imagen()
+        if error:
+            return error
 
-        if not data or 'image' not in data:
-            return jsonify({
-                "success": False,
-                "error": "No se proporcionó imagen",
-                "message": "Imagen requerida para el análisis"
-            }), 400
+        incluir, error = recibir_campos()
+        if error:
+            return error
 
-        # Obtener la imagen base64 del frontend
-        image_base64 = data['image']
+        analysis_result, en_cache = analizar_con_cache('tono', analizar_tono, buffer_imagen, incluir)
 
-        # Guardar la imagen temporalmente
-        try:
-            image_bytes = base64.b64decode(image_base64.split(',')[-1])
-            
-            # Crear archivo temporal
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                temp_path = temp_file.name
-                temp_file.write(image_bytes)
-            
-            print(f">>> Imagen temporal para tono guardada en: {temp_path}")
-        except Exception as e:
-            return jsonify({
-                "success": False,
-                "error": f"Error al guardar la imagen: {str(e)}",
-                "message": "No se pudo procesar la imagen enviada"
-            }), 400
-
-        # Ejecutar el script tonos.py
-        result = subprocess.run([
-            python_path,
-            tonos_script_path,
-            temp_path
-        ], capture_output=True, text=True, timeout=30, encoding='utf-8')
-
-        # Limpiar archivo temporal
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-        print(f">>> Resultado del script tonos: {result.returncode}")
-
-        if result.returncode == 0:
-            # Buscar el JSON en la salida
-            lines = result.stdout.strip().split('\n')
-            json_line = None
-
-            for line in reversed(lines):
-                line = line.strip()
-                if line.startswith('{') and line.endswith('}'):
-                    try:
-                        json.loads(line)
-                        json_line = line
-                        break
-                    except Exception:
-                        continue
-
-            if not json_line:
-                json_line = lines[-1] if lines else ""
-
-            print(f">>> JSON tono encontrado: {json_line[:100]}...")
-
-            try:
-                analysis_result = json.loads(json_line)
-                return jsonify({
-                    "success": True,
-                    "data": analysis_result,
-                    "message": "Análisis de tono completado exitosamente"
-                })
-            except json.JSONDecodeError as e:
-                print(f">>> Error decodificando JSON: {e}")
-                return jsonify({
-                    "success": False,
-                    "error": "Formato de respuesta inválido del script Python",
-                    "stdout_preview": result.stdout[:200] + "..." if len(result.stdout) > 200 else result.stdout,
-                    "stderr_preview": result.stderr[:200] + "..." if result.stderr and len(result.stderr) > 200 else result.stderr
-                }), 500
-        else:
-            return jsonify({
-                "success": False,
-                "error": result.stderr,
-                "stdout": result.stdout,
-                "message": "Error en el análisis de tono de piel"
-            }), 500
+        return marcar_cache(jsonify({
+            "success": True,
+            "data": analysis_result,
+            "message": "Análisis de tono completado exitosamente"
+        }), en_cache)
 
+    except ErrorScriptAnalisis as e:
+        return respuesta_error_script(e, "Error en el análisis de tono de piel")
     except subprocess.TimeoutExpired:
-        return jsonify({
-            "success": False,
-            "error": "El análisis tardó demasiado tiempo",
-            "message": "Timeout del análisis"
-        }), 500
+        return respuesta_timeout()
     except Exception as e:
         return jsonify({
             "success": False,
@@ -226,108 +702,60 @@ def analyze_skin_tone():
         }), 500
 
 @app.route('/analyze-complete', methods=['POST'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
 def analyze_complete():
-    """Endpoint para análisis completo (forma + tono)"""
-    try:
-        data = request.get_json()
+    """Endpoint para análisis completo (forma + tono)
 
-        if not data or 'image' not in data:
-            return jsonify({
-                "success": False,
-                "error": "No se proporcionó imagen",
-                "message": "Imagen requerida para el análisis"
-            }), 400
+    Con ?session=1, si el análisis de forma sale bien, el resultado se
+    guarda como sesión y la respuesta lleva su "analysis_id" para
+    /generate-pdf-report.
+    """
+    try:
+        buffer_imagen, error = recibir_imagen()
+        if error:
+            return error
 
-        # Obtener la imagen base64 del frontend
-        image_base64 = data['image']
+        incluir, error = recibir_campos()
+        if error:
+            return error
 
-        # Guardar la imagen temporalmente
-        try:
-            image_bytes = base64.b64decode(image_base64.split(',')[-1])
-            
-            # Crear archivo temporal
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                temp_path = temp_file.name
-                temp_file.write(image_bytes)
-            
-            print(f">>> Imagen temporal para análisis completo: {temp_path}")
-        except Exception as e:
-            return jsonify({
-                "success": False,
-                "error": f"Error al guardar la imagen: {str(e)}",
-                "message": "No se pudo procesar la imagen enviada"
-            }), 400
+        # Solo si se pide: la sesión guarda también la imagen y los landmarks
+        # que usa la figura del PDF, y se escribe en disco
+        sesion = sesiones.activo and leer_sesion_solicitud(request)
+        incluir_analisis = campos_con_sesion(incluir) if sesion else incluir
 
         try:
+            resultados, en_cache = analizar_con_cache(
+                'completo',
+                analizar_completo_compartido if sesion else analizar_completo,
+                buffer_imagen, incluir_analisis
+            )
+        except ErrorScriptAnalisis as e:
+            print(f">>> Error en análisis completo: {e}")
             resultados = {}
-            
-            # 1. Análisis de forma de rostro
-            print(">>> Ejecutando análisis de forma de rostro...")
-            result_forma = subprocess.run([
-                python_path,
-                main_script_path,
-                temp_path
-            ], capture_output=True, text=True, timeout=30, encoding='utf-8')
-            
-            if result_forma.returncode == 0:
-                for line in reversed(result_forma.stdout.strip().split('\n')):
-                    line = line.strip()
-                    if line.startswith('{') and line.endswith('}'):
-                        try:
-                            forma_data = json.loads(line)
-                            
-                            # --- AÑADIR MEDIDAS CONVERTIDAS AQUÍ ---
-                            # Importar la función (ajusta la ruta según tu estructura)
-                            from mm import analizar_imagen_con_medidas_reales
-                            forma_data = analizar_imagen_con_medidas_reales(image_base64, forma_data)
-                            
-                            resultados['forma_rostro'] = forma_data
-                            break
-                        except:
-                            continue
-            
-            # 2. Análisis de tono de piel
-            print(">>> Ejecutando análisis de tono de piel...")
-            result_tono = subprocess.run([
-                python_path,
-                tonos_script_path,
-                temp_path
-            ], capture_output=True, text=True, timeout=30, encoding='utf-8')
-            
-            if result_tono.returncode == 0:
-                for line in reversed(result_tono.stdout.strip().split('\n')):
-                    line = line.strip()
-                    if line.startswith('{') and line.endswith('}'):
-                        try:
-                            resultados['tono_piel'] = json.loads(line)
-                            break
-                        except:
-                            continue
-            
-            # Limpiar archivo temporal
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            if resultados:
-                return jsonify({
-                    "success": True,
-                    "data": resultados,
-                    "message": "Análisis completados exitosamente"
-                })
-            else:
-                return jsonify({
-                    "success": False,
-                    "error": "No se pudieron procesar los análisis",
-                    "message": "Error en el procesamiento"
-                }), 500
-
         except subprocess.TimeoutExpired:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            return respuesta_timeout()
+
+        if resultados:
+            analysis_id = None
+            forma = resultados.get('forma_rostro')
+            if sesion and isinstance(forma, dict) and forma.get('estado') == 'exitoso':
+                analysis_id = sesiones.publicar(resultados, clave_imagen(buffer_imagen), incluir_analisis)
+                resultados = {**resultados, 'forma_rostro': filtrar_forma(forma, incluir)}
+
+            return marcar_cache(jsonify({
+                "success": True,
+                "data": resultados,
+                "analysis_id": analysis_id,
+                "message": "Análisis completados exitosamente"
+            }), en_cache)
+        else:
             return jsonify({
                 "success": False,
-                "error": "El análisis tardó demasiado tiempo",
-                "message": "Timeout del análisis"
+                "error": "No se pudieron procesar los análisis",
+                "message": "Error en el procesamiento"
             }), 500
 
     except Exception as e:
@@ -337,25 +765,210 @@ def analyze_complete():
             "message": "Error interno del servidor"
         }), 500
 
+@app.route('/analyze-complete/stream', methods=['POST'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
+def analyze_complete_stream():
+    """Variante progresiva de /analyze-complete: un evento por etapa terminada
+
+    NDJSON por defecto; Server-Sent Events con "Accept: text/event-stream"
+    o ?formato=sse. Cada mensaje lleva "event" y "data". Los eventos se
+    generan con el mismo plazo de con_plazo, que ya descuenta la espera en
+    cola; las respuestas en streaming no llevan Server-Timing.
+    """
+    buffer_imagen, error = recibir_imagen()
+    if error:
+        return error
+
+    incluir, error = recibir_campos()
+    if error:
+        return error
+
+    sse = request.args.get('formato') == 'sse' or \
+        request.accept_mimetypes.best_match(['application/x-ndjson', 'text/event-stream']) == 'text/event-stream'
+    sesion = sesiones.activo and leer_sesion_solicitud(request)
+    incluir_analisis = campos_con_sesion(incluir) if sesion else incluir
+
+    respuesta = Response(
+        stream_with_context(generar_completo_progresivo(
+            buffer_imagen, incluir, incluir_analisis, sse, plazo_actual(), sesion)),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson'
+    )
+    # Que los proxies no acumulen los eventos
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@app.route('/analyze-batch', methods=['POST'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
+def analyze_batch():
+    """Endpoint para analizar muchas imágenes con respuesta NDJSON en streaming
+
+    Cada línea es {"index", "success", "data" | "error"} y se emite en cuanto
+    termina su imagen (orden de finalización, no de envío). El plazo de
+    con_plazo cubre la espera en cola; cada imagen tiene después el suyo.
+    """
+    tipo = request.args.get('tipo', 'completo')
+    if tipo not in FUNCIONES_ANALISIS:
+        return jsonify({
+            "success": False,
+            "error": f"Tipo de análisis inválido: {tipo}",
+            "message": f"Usa uno de: {', '.join(FUNCIONES_ANALISIS)}"
+        }), 400
+
+    incluir, error = recibir_campos()
+    if error:
+        return error
+
+    try:
+        elementos = leer_lote_solicitud(request, LOTE_MAX_IMAGENES)
+    except ErrorImagenSolicitud as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "message": ("Lote demasiado grande" if e.codigo_http == 413
+                        else "Imágenes requeridas para el análisis por lotes")
+        }), e.codigo_http
+
+    print(f">>> Lote de análisis '{tipo}' recibido")
+    return Response(
+        stream_with_context(generar_lote(elementos, tipo, incluir)),
+        mimetype='application/x-ndjson'
+    )
+
+@app.route('/pool-status', methods=['GET'])
+def pool_status():
+    """Endpoint con la utilización de cada trabajador del pool"""
+    if MODO_AISLAMIENTO != 'pool':
+        return jsonify({
+            "modo_aislamiento": MODO_AISLAMIENTO,
+            "pool": None
+        })
+
+    return jsonify({
+        "modo_aislamiento": MODO_AISLAMIENTO,
+        "pool": pool_analisis.estadisticas()
+    })
+
+@app.route('/admission-status', methods=['GET'])
+def admission_status():
+    """Endpoint con la profundidad de la cola y los tiempos de espera de admisión"""
+    return jsonify(control_admision.estadisticas())
+
+@app.route('/cache-status', methods=['GET'])
+def cache_status():
+    """Endpoint con aciertos, fallos y ocupación de la caché de resultados"""
+    return jsonify({**cache_analisis.estadisticas(), "vuelos": vuelos_analisis.estadisticas()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Endpoint con las métricas en formato de texto Prometheus"""
+    return respuesta_metricas()
+
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Endpoint de preparación: 200 solo con los modelos cargados y calentados"""
+    estado = estado_preparacion.estadisticas()
+    estado['modo_aislamiento'] = MODO_AISLAMIENTO
+    if MODO_AISLAMIENTO == 'pool':
+        vivos = sum(1 for t in pool_analisis.trabajadores if t.vivo())
+        estado['trabajadores_vivos'] = vivos
+        estado['ready'] = estado['ready'] and vivos > 0
+    return jsonify(estado), 200 if estado['ready'] else 503
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Endpoint para verificar el estado del servidor"""
+    """Endpoint para verificar el estado del servidor (proceso vivo; ver /ready)"""
     return jsonify({
-        "status": "healthy", 
+        "status": "healthy",
         "service": "OptiScan Backend",
+        "ready": estado_preparacion.listo,
+        "modo_aislamiento": MODO_AISLAMIENTO,
         "python_path": python_path,
         "main_script_exists": os.path.exists(main_script_path),
         "tonos_script_exists": os.path.exists(tonos_script_path),
-        "venv_exists": os.path.exists(venv_path)
+        "venv_exists": os.path.exists(venv_path),
+        "sesiones": sesiones.estadisticas()
+    })
+
+@app.route('/health/deep', methods=['GET'])
+def health_deep():
+    """Endpoint de diagnóstico: modelos, ocupación, cola, caché, latencia reciente y memoria
+
+    Para el autoescalado y las guardias: muestra la saturación directamente.
+    """
+    admision = control_admision.estadisticas()
+    memoria_proceso = memoria_proceso_mb(os.getpid())
+
+    if MODO_AISLAMIENTO == 'pool':
+        pool = pool_analisis.estadisticas()
+        trabajadores = {
+            'tipo': 'pool',
+            'total': pool['tamano'],
+            'ocupados': pool['ocupados'],
+            'libres': pool['libres'],
+            'vivos': sum(1 for t in pool['trabajadores'] if t['vivo'])
+        }
+        # Los modelos viven en los trabajadores, que se calientan antes de anunciarse listos
+        modelos = {'pool': {'cargado': trabajadores['vivos'] > 0, 'calentado': trabajadores['vivos'] > 0}}
+        memoria_trabajadores = round(sum(t['memoria_mb'] or 0.0 for t in pool['trabajadores']), 1)
+    else:
+        # Sin pool, los turnos de admisión son los análisis que pueden correr a la vez
+        trabajadores = {
+            'tipo': 'turnos_admision',
+            'total': admision['max_en_vuelo'],
+            'ocupados': admision['en_vuelo'],
+            'libres': max(0, admision['max_en_vuelo'] - admision['en_vuelo'])
+        }
+        modelos = estado_preparacion.estado_modelos({
+            'forma': analizador_forma,
+            'tono': analizador_tono
+        }) if pipeline_completo is not None else {}
+        memoria_trabajadores = None
+
+    cache = cache_analisis.estadisticas()
+    return jsonify({
+        "status": "healthy",
+        "service": "OptiScan Backend",
+        "ready": estado_preparacion.listo,
+        "modo_aislamiento": MODO_AISLAMIENTO,
+        "pid": os.getpid(),
+        "modelos": modelos,
+        "trabajadores": trabajadores,
+        "cola": {
+            'en_cola': admision['en_cola'],
+            'max_cola': admision['max_cola'],
+            'espera_mas_antigua_ms': admision['espera_mas_antigua_ms'],
+            'espera_p95_ms': admision['espera_p95_ms'],
+            'rechazadas_capacidad': admision['rechazadas_capacidad'],
+            'rechazadas_cliente': admision['rechazadas_cliente']
+        },
+        "cache": {
+            'entradas': cache['entradas'],
+            'max_entradas': cache['max_entradas'],
+            'tasa_aciertos': cache['tasa_aciertos'],
+            'aciertos': cache['aciertos'] + cache['aciertos_disco'],
+            'fallos': cache['fallos']
+        },
+        "vuelos": vuelos_analisis.estadisticas(),
+        "latencia_reciente": latencias_recientes.estadisticas(),
+        "memoria": {
+            'rss_mb': round(memoria_proceso, 1) if memoria_proceso is not None else None,
+            'trabajadores_mb': memoria_trabajadores
+        }
     })
 
 if __name__ == '__main__':
     print(">>> Iniciando servidor Flask para OptiScan...")
+    print(f">>> Modo de aislamiento: {MODO_AISLAMIENTO}")
     print(f">>> Python path: {python_path}")
     print(f">>> Main script path: {main_script_path}")
     print(f">>> Tonos script path: {tonos_script_path}")
     print(f">>> Main script existe: {os.path.exists(main_script_path)}")
     print(f">>> Tonos script existe: {os.path.exists(tonos_script_path)}")
     print(f">>> Venv existe: {os.path.exists(venv_path)}")
-    
-    app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+
+    app.run(debug=True, port=5000, host='0.0.0.0')
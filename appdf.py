@@ -1,6 +1,7 @@
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
+import io
 import base64
 import tempfile
 import cv2
@@ -9,24 +10,101 @@ import matplotlib
 matplotlib.use('Agg')  # Usar backend que no requiere display
 import matplotlib.pyplot as plt
 from main_pdf import AnalizadorFormaRostroPDF
+from tonos import AnalizadorTonoPielMejorado
 from pdf import PDFReportGenerator
 import traceback
-import subprocess
-import json
-from mm import analizar_imagen_con_medidas_reales, PDFReportGeneratorExtendido
+from functools import partial
+from mm import integrar_medidas_reales, PDFReportGeneratorExtendido
+from imagen_solicitud import (leer_imagen_solicitud, decodificar_imagen, ErrorImagenSolicitud,
+                              MAX_BYTES_SOLICITUD)
+from campos_respuesta import CAMPO_IMAGEN_FORMA, CAMPO_PUNTOS_FACIALES
+from cache_resultados import CacheResultados, clave_cache
+from sesiones_analisis import AlmacenSesiones, leer_id_solicitud, clave_imagen
+from vuelo_unico import VueloUnico
+from plazos import con_plazo
+from admision import ControlAdmision, requiere_admision
+from calentamiento import (EstadoPreparacion, imagen_calentamiento, calentar_forma,
+                           calentar_tono, calentar_referencia, calentar_figura_pdf)
+from metricas import (instrumentar_app, respuesta_metricas, registro, medir, con_tiempos,
+                      latencias_recientes, ETAPA_GENERAR_PDF)
+from pool_trabajadores import memoria_proceso_mb
 
 app = Flask(__name__)
 CORS(app)
+# Cuerpo máximo de una solicitud (OPTISCAN_MAX_BYTES_SOLICITUD); por encima, 413
+app.config['MAX_CONTENT_LENGTH'] = MAX_BYTES_SOLICITUD
 
-# Inicializar analizador y generador de PDFs
-analizador = AnalizadorFormaRostroPDF()
+
+@app.errorhandler(413)
+def solicitud_demasiado_grande(e):
+    return jsonify({'success': False,
+                    'error': f'La solicitud supera el tamaño máximo de {MAX_BYTES_SOLICITUD} bytes'}), 413
+
+
+# Contadores por endpoint y resultado, latencia y solicitudes en vuelo (/metrics)
+instrumentar_app(app)
+
+# Modo prefork (prefork.py): el maestro importa las bibliotecas y construye los
+# analizadores sin grafo de MediaPipe; cada hijo llama a preparar_proceso_hijo()
+PREFORK = os.environ.get('OPTISCAN_PREFORK') == '1'
+
+# Inicializar analizadores y generador de PDFs
+analizador = AnalizadorFormaRostroPDF(crear_grafo=not PREFORK)
+analizador_tono = AnalizadorTonoPielMejorado(crear_grafo=not PREFORK)
 pdf_generator = PDFReportGenerator(analizador)
 
+# Caché de análisis por contenido de la imagen (OPTISCAN_CACHE_*)
+cache_analisis = CacheResultados()
+
+# Análisis guardados por /analyze-complete (analysis_id)
+sesiones = AlmacenSesiones()
+
+# Solicitudes simultáneas con la misma imagen comparten un único análisis
+vuelos_analisis = VueloUnico()
+
+def pasos_calentamiento():
+    """Pasadas de calentamiento de los modelos y de la figura del PDF"""
+    imagen = imagen_calentamiento()
+    return [
+        ('forma', partial(calentar_forma, analizador, imagen)),
+        ('tono', partial(calentar_tono, analizador_tono, imagen)),
+        ('referencia', partial(calentar_referencia, imagen)),
+        ('figura_pdf', partial(calentar_figura_pdf, imagen)),
+    ]
+
+
+# /ready responde 503 hasta que termine el calentamiento (en prefork, el de cada hijo)
+estado_preparacion = EstadoPreparacion()
+if not PREFORK:
+    estado_preparacion.iniciar_en_segundo_plano(pasos_calentamiento())
+
+
+def preparar_proceso_hijo():
+    """Crear en un hijo de prefork.py los grafos de MediaPipe y calentar"""
+    analizador.iniciar_grafo()
+    analizador_tono.iniciar_grafo()
+    estado_preparacion.iniciar_en_segundo_plano(pasos_calentamiento())
+
+
+# Cola acotada delante del análisis y la generación de PDFs (OPTISCAN_ADMISION_*)
+control_admision = ControlAdmision()
+registro.medidor('optiscan_admision_en_vuelo', 'Análisis admitidos en curso',
+                 funcion=lambda: control_admision.en_vuelo)
+registro.medidor('optiscan_admision_en_cola', 'Solicitudes esperando turno de análisis',
+                 funcion=lambda: control_admision.en_cola)
+registro.medidor('optiscan_vuelos_en_curso', 'Análisis distintos en curso (coalescencia)',
+                 funcion=lambda: vuelos_analisis.en_curso)
+
 # Configuración
 venv_path = "./venv"
 python_path = os.path.join(venv_path, "Scripts", "python")
 tonos_script_path = os.path.join(os.path.dirname(__file__), "tonos.py")
 
+# Artefactos pesados que usa el PDF: la figura se dibuja sobre la imagen y
+# los puntos faciales. La visualización de tono y la imagen de debug del
+# cuadrado de referencia no se usan, así que no se generan.
+CAMPOS_PDF = frozenset({CAMPO_IMAGEN_FORMA, CAMPO_PUNTOS_FACIALES})
+
 def crear_figura_directamente(analisis):
     """Crear la figura de matplotlib directamente para debug"""
     try:
@@ -168,139 +246,194 @@ def crear_figura_directamente(analisis):
         print(f"🔍 Traceback: {traceback.format_exc()}")
         return None
 
-def ejecutar_analisis_tono(ruta_imagen):
-    """Ejecutar análisis de tono de piel"""
+def ejecutar_analisis_tono(imagen):
+    """Ejecutar análisis de tono de piel en memoria con el analizador residente"""
     try:
-        print(f">>> Ejecutando análisis de tono para: {ruta_imagen}")
-        result = subprocess.run([
-            python_path,
-            tonos_script_path,
-            ruta_imagen
-        ], capture_output=True, text=True, timeout=30, encoding='utf-8')
-        
-        if result.returncode == 0:
-            # Buscar el JSON en la salida
-            lines = result.stdout.strip().split('\n')
-            json_line = None
-            
-            for line in reversed(lines):
-                line = line.strip()
-                if line.startswith('{') and line.endswith('}'):
-                    try:
-                        json.loads(line)
-                        json_line = line
-                        break
-                    except:
-                        continue
-            
-            if json_line:
-                return json.loads(json_line)
-        
-        return None
+        print(">>> Ejecutando análisis de tono...")
+        return analizador_tono.analizar_tono_piel_imagen(imagen, CAMPOS_PDF)
     except Exception as e:
         print(f"❌ Error ejecutando análisis de tono: {e}")
         return None
 
 
+def analizar_para_pdf(imagen):
+    """Análisis de forma + medidas reales + tono que alimenta el PDF"""
+    # Analizar forma de rostro (en memoria, sin imagen temporal)
+    analisis_result = analizador.analizar_rostro_imagen(imagen)
+    
+    # --- INTEGRAR MEDIDAS REALES ---
+    if analisis_result and analisis_result.get('estado') == 'exitoso':
+        print("🔄 Integrando medidas reales...")
+        analisis_result = integrar_medidas_reales(imagen, analisis_result, incluir=CAMPOS_PDF)
+        
+        if 'medidas_convertidas' in analisis_result:
+            print("✅ Medidas reales integradas exitosamente")
+        else:
+            print("⚠️ No se pudieron integrar medidas reales")
+    
+    if not analisis_result:
+        return analisis_result
+    
+    # Analizar tono de piel
+    tono_result = ejecutar_analisis_tono(imagen)
+    
+    # Combinar resultados si el análisis de tono fue exitoso
+    if tono_result and tono_result.get('estado') == 'exitoso':
+        analisis_result['tono_piel'] = tono_result
+        print("✅ Análisis de tono de piel agregado al reporte")
+    
+    return analisis_result
+
+
+def analisis_desde_sesion(resultados):
+    """Análisis para el PDF a partir de una sesión de /analyze-complete, sin recalcular
+
+    Las recomendaciones se regeneran con las del PDF (incluyen la imagen de
+    cada montura); el resto se toma tal cual de la sesión.
+    """
+    forma = resultados.get('forma_rostro')
+    if not isinstance(forma, dict) or forma.get('estado') != 'exitoso':
+        return None
+
+    analisis_result = dict(forma)
+    analisis_result['recomendaciones'] = analizador.generar_recomendaciones_completas(forma.get('forma'))
+
+    tono = resultados.get('tono_piel')
+    if isinstance(tono, dict) and tono.get('estado') == 'exitoso':
+        analisis_result['tono_piel'] = tono
+    return analisis_result
+
+
+def analisis_imagen_pdf(buffer_imagen, imagen):
+    """Análisis para el PDF de una imagen: caché, /analyze-complete o análisis propio
+
+    Si el servidor principal ya guardó una sesión de la misma imagen, se
+    toman de ella la forma, las medidas reales y el tono en lugar de
+    repetirlos. Un análisis de la misma imagen aún en curso allí no se
+    espera: sondear el disco ocuparía un hilo y un turno de admisión.
+    """
+    # El análisis se reutiliza si la misma imagen ya se procesó (p. ej. reintento de descarga)
+    clave = clave_cache(buffer_imagen, 'pdf', CAMPOS_PDF)
+    analisis_result = cache_analisis.obtener(clave)
+    if analisis_result is not None:
+        print("♻️ Análisis servido desde caché")
+        return analisis_result
+
+    analysis_id, resultados = sesiones.buscar_por_imagen(clave_imagen(buffer_imagen), CAMPOS_PDF)
+    analisis_result = analisis_desde_sesion(resultados) if resultados is not None else None
+    if analisis_result is not None:
+        print(f"♻️ Análisis de la misma imagen reutilizado de /analyze-complete ({analysis_id})")
+    else:
+        analisis_result = analizar_para_pdf(imagen)
+    cache_analisis.guardar(clave, analisis_result)
+    return analisis_result
+
+
+def generar_reporte(obtener_analisis):
+    """Obtener el análisis y generar el PDF: (contenido, error, código HTTP)"""
+    analisis_result = obtener_analisis()
+    if not analisis_result or analisis_result.get('estado') == 'error':
+        return None, 'Error en análisis facial', 400
+
+    # Crear archivo temporal PDF
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
+        temp_pdf_path = temp_file.name
+    
+    try:
+        print("📄 Generando PDF completo con PDFReportGenerator...")
+        with medir(ETAPA_GENERAR_PDF):
+            pdf_path = pdf_generator.generar_pdf(analisis_result, temp_pdf_path)
+        
+        if not pdf_path or not os.path.exists(pdf_path):
+            print("❌ No se pudo generar el PDF")
+            return None, 'Error generando PDF report', 500
+        
+        # El PDF se envía desde memoria: send_file con una ruta no avisa
+        # al terminar el envío y el archivo temporal quedaba en disco
+        with open(pdf_path, 'rb') as f:
+            contenido = f.read()
+    finally:
+        try:
+            os.remove(temp_pdf_path)
+        except OSError:
+            pass
+    
+    print(f"✅ PDF generado ({len(contenido)} bytes)")
+    if not contenido:
+        print("❌ PDF generado está vacío")
+        return None, 'PDF vacío generado', 500
+    return contenido, None, 200
+
+
 # ==========================
 # ENDPOINTS
 # ==========================
 
 @app.route('/generate-pdf-report', methods=['POST', 'OPTIONS'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
 def generate_pdf_report():
-    """Endpoint para generar PDF del análisis facial"""
+    """Endpoint para generar PDF del análisis facial
+
+    Con "analysis_id" (de /analyze-complete) el PDF se genera desde el
+    análisis guardado, sin imagen; si la sesión expiró y la solicitud trae
+    la imagen, se analiza la imagen. Las solicitudes simultáneas con el
+    mismo analysis_id o la misma imagen comparten un único reporte.
+    """
     if request.method == 'OPTIONS':
         return '', 200
 
     try:
         print("📨 Recibiendo solicitud para generar PDF...")
-        data = request.get_json()
-        
-        if not data or 'image' not in data:
-            print("❌ No se proporcionó imagen en la solicitud")
-            return jsonify({'success': False, 'error': 'No image data provided'}), 400
-        
-        base64_image = data['image']
-        print(f"📷 Imagen recibida (longitud base64: {len(base64_image)})")
-        
-        # Crear archivo temporal PDF
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
-            temp_pdf_path = temp_file.name
         
-        # Guardar imagen temporal
-        temp_img_path = "temp_pdf_analysis.jpg"
-        try:
-            if ',' in base64_image:
-                base64_image_clean = base64_image.split(',')[1]
-            else:
-                base64_image_clean = base64_image
+        obtener_analisis = None
+        analysis_id = leer_id_solicitud(request)
+        if analysis_id:
+            resultados = sesiones.obtener(analysis_id)
+            if resultados is not None:
+                forma = resultados.get('forma_rostro')
+                if isinstance(forma, dict) and forma.get('estado') == 'exitoso':
+                    print(f"♻️ Análisis {analysis_id} reutilizado de /analyze-complete")
+                    clave_vuelo = f"sesion:{analysis_id}"
+                    obtener_analisis = partial(analisis_desde_sesion, resultados)
+        
+        if obtener_analisis is None:
+            # Imagen como multipart, binario crudo o JSON base64
+            try:
+                buffer_imagen = leer_imagen_solicitud(request)
+                if buffer_imagen is None:
+                    if analysis_id:
+                        print(f"❌ analysis_id desconocido o expirado: {analysis_id}")
+                        return jsonify({
+                            'success': False,
+                            'error': 'analysis_id desconocido o expirado; envía la imagen de nuevo'
+                        }), 404
+                    print("❌ No se proporcionó imagen en la solicitud")
+                    return jsonify({'success': False, 'error': 'No image data provided'}), 400
                 
-            image_bytes = base64.b64decode(base64_image_clean)
-            with open(temp_img_path, 'wb') as f:
-                f.write(image_bytes)
-        except Exception as e:
-            return jsonify({'success': False, 'error': f'Error procesando imagen: {str(e)}'}), 400
-        
-        # Analizar forma de rostro
-        analisis_result = analizador.analizar_rostro(temp_img_path)
-        
-        # --- INTEGRAR MEDIDAS REALES ---
-        if analisis_result and analisis_result.get('estado') == 'exitoso':
-            print("🔄 Integrando medidas reales...")
-            analisis_result = analizar_imagen_con_medidas_reales(base64_image, analisis_result)
-            
-            if 'medidas_convertidas' in analisis_result:
-                print("✅ Medidas reales integradas exitosamente")
-            else:
-                print("⚠️ No se pudieron integrar medidas reales")
-        
-        # Analizar tono de piel
-        tono_result = ejecutar_analisis_tono(temp_img_path)
-        
-        # Combinar resultados si el análisis de tono fue exitoso
-        if tono_result and tono_result.get('estado') == 'exitoso':
-            analisis_result['tono_piel'] = tono_result
-            print("✅ Análisis de tono de piel agregado al reporte")
-        
-        # Limpiar imagen temporal
-        if os.path.exists(temp_img_path):
-            os.remove(temp_img_path)
-        
-        if not analisis_result or analisis_result.get('estado') == 'error':
-            return jsonify({'success': False, 'error': 'Error en análisis facial'}), 400
-
-        print("📄 Generando PDF completo con PDFReportGenerator...")
-        pdf_path = pdf_generator.generar_pdf(analisis_result, temp_pdf_path)
-        
-        if pdf_path and os.path.exists(pdf_path):
-            # Verificar tamaño del PDF
-            file_size = os.path.getsize(pdf_path)
-            print(f"✅ PDF generado: {pdf_path} ({file_size} bytes)")
-            
-            if file_size == 0:
-                print("❌ PDF generado está vacío")
-                return jsonify({'success': False, 'error': 'PDF vacío generado'}), 500
+                print(f"📷 Imagen recibida ({buffer_imagen.size} bytes)")
+                imagen = decodificar_imagen(buffer_imagen)
+            except ErrorImagenSolicitud as e:
+                return jsonify({'success': False, 'error': f'Error procesando imagen: {str(e)}'}), e.codigo_http
             
-            response = send_file(
-                pdf_path,
-                as_attachment=True,
-                download_name='analisis_facial_optiscan.pdf', 
-                mimetype='application/pdf'
-            )
-            
-            @response.call_on_close
-            def cleanup():
-                try:
-                    if os.path.exists(pdf_path):
-                        os.remove(pdf_path)
-                        print("🧹 PDF temporal limpiado")
-                except Exception as e:
-                    print(f"⚠️ Error limpiando archivo temporal: {e}")
-            
-            return response
-        else:
-            print("❌ No se pudo generar el PDF")
-            return jsonify({'success': False, 'error': 'Error generando PDF report'}), 500
+            clave_vuelo = f"imagen:{clave_imagen(buffer_imagen)}"
+            obtener_analisis = partial(analisis_imagen_pdf, buffer_imagen, imagen)
+        
+        # Solicitudes idénticas simultáneas esperan un único análisis y PDF
+        (contenido, error, codigo), compartido = vuelos_analisis.ejecutar(
+            clave_vuelo, generar_reporte, obtener_analisis)
+        if compartido:
+            print("♻️ PDF compartido con una solicitud idéntica en curso")
+        if error:
+            return jsonify({'success': False, 'error': error}), codigo
+        
+        return send_file(
+            io.BytesIO(contenido),
+            as_attachment=True,
+            download_name='analisis_facial_optiscan.pdf', 
+            mimetype='application/pdf'
+        )
             
     except Exception as e:
         print(f"💥 Error crítico en generate-pdf-report: {traceback.format_exc()}")
@@ -308,6 +441,9 @@ def generate_pdf_report():
 
 
 @app.route('/debug-figure', methods=['POST', 'OPTIONS'])
+@con_tiempos
+@con_plazo
+@requiere_admision(control_admision)
 def debug_figure():
     """Endpoint solo para debug de la figura"""
     if request.method == 'OPTIONS':
@@ -315,24 +451,16 @@ def debug_figure():
 
     try:
         print("🐛 DEBUG: Probando creación de figura...")
-        data = request.get_json()
-        
-        if not data or 'image' not in data:
-            return jsonify({'success': False, 'error': 'No image'}), 400
         
-        base64_image = data['image']
+        try:
+            buffer_imagen = leer_imagen_solicitud(request)
+        except ErrorImagenSolicitud as e:
+            return jsonify({'success': False, 'error': str(e)}), e.codigo_http
         
-        temp_img_path = "temp_debug.jpg"
-        if ',' in base64_image:
-            base64_image_clean = base64_image.split(',')[1]
-        else:
-            base64_image_clean = base64_image
-                
-        with open(temp_img_path, 'wb') as f:
-            f.write(base64.b64decode(base64_image_clean))
+        if buffer_imagen is None:
+            return jsonify({'success': False, 'error': 'No image'}), 400
         
-        analisis_result = analizador.analizar_rostro(temp_img_path)
-        os.remove(temp_img_path)
+        analisis_result = analizador.analizar_rostro_imagen(buffer_imagen)
         
         if not analisis_result:
             return jsonify({'success': False, 'error': 'No se pudo analizar'}), 400
@@ -351,14 +479,76 @@ def debug_figure():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Endpoint con las métricas en formato de texto Prometheus"""
+    return respuesta_metricas()
+
+
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Endpoint de preparación: 200 solo con los modelos cargados y calentados"""
+    estado = estado_preparacion.estadisticas()
+    return jsonify(estado), 200 if estado['ready'] else 503
+
+
 @app.route('/health-pdf', methods=['GET'])
 def health_check():
-    """Endpoint para verificar el estado del servidor PDF"""
+    """Endpoint para verificar el estado del servidor PDF (proceso vivo; ver /ready)"""
     return jsonify({
         "status": "healthy", 
         "service": "OptiScan PDF Generator",
+        "ready": estado_preparacion.listo,
         "pdf_generator": "active",
-        "tonos_script_exists": os.path.exists(tonos_script_path)
+        "tonos_script_exists": os.path.exists(tonos_script_path),
+        "cache": cache_analisis.estadisticas(),
+        "sesiones": sesiones.estadisticas(),
+        "vuelos": vuelos_analisis.estadisticas(),
+        "admision": control_admision.estadisticas()
+    })
+
+
+@app.route('/health-pdf/deep', methods=['GET'])
+def health_deep():
+    """Endpoint de diagnóstico: modelos, ocupación, cola, caché, latencia reciente y memoria"""
+    admision = control_admision.estadisticas()
+    cache = cache_analisis.estadisticas()
+    memoria_proceso = memoria_proceso_mb(os.getpid())
+    return jsonify({
+        "status": "healthy",
+        "service": "OptiScan PDF Generator",
+        "ready": estado_preparacion.listo,
+        "pid": os.getpid(),
+        "modelos": estado_preparacion.estado_modelos({
+            'forma': analizador,
+            'tono': analizador_tono
+        }),
+        "trabajadores": {
+            'tipo': 'turnos_admision',
+            'total': admision['max_en_vuelo'],
+            'ocupados': admision['en_vuelo'],
+            'libres': max(0, admision['max_en_vuelo'] - admision['en_vuelo'])
+        },
+        "cola": {
+            'en_cola': admision['en_cola'],
+            'max_cola': admision['max_cola'],
+            'espera_mas_antigua_ms': admision['espera_mas_antigua_ms'],
+            'espera_p95_ms': admision['espera_p95_ms'],
+            'rechazadas_capacidad': admision['rechazadas_capacidad'],
+            'rechazadas_cliente': admision['rechazadas_cliente']
+        },
+        "cache": {
+            'entradas': cache['entradas'],
+            'max_entradas': cache['max_entradas'],
+            'tasa_aciertos': cache['tasa_aciertos'],
+            'aciertos': cache['aciertos'] + cache['aciertos_disco'],
+            'fallos': cache['fallos']
+        },
+        "vuelos": vuelos_analisis.estadisticas(),
+        "latencia_reciente": latencias_recientes.estadisticas(),
+        "memoria": {
+            'rss_mb': round(memoria_proceso, 1) if memoria_proceso is not None else None
+        }
     })
 
 
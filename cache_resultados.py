@@ -0,0 +1,286 @@
+"""
+Caché de resultados de análisis direccionada por contenido.
+
+La clave es un hash de los bytes de la imagen (ya sin base64, así que la
+misma foto enviada como JSON, multipart o binario comparte entrada) más
+el tipo de análisis, los artefactos pedidos y la configuración de los
+analizadores. Un reintento con el mismo fotograma se responde sin pasar
+por MediaPipe.
+
+Nivel en memoria LRU con TTL y tamaño acotado; nivel opcional en disco
+(un archivo JSON por entrada) que sobrevive a los reinicios y se comparte
+entre procesos que usen el mismo directorio. Los directorios en disco
+(este y el de sesiones_analisis.py) se crean con permisos 0700 y se
+rechazan si son un enlace simbólico o pertenecen a otro usuario.
+"""
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from malla import RESOLUCION_DETECCION
+
+# Configuración por defecto (variables de entorno)
+CACHE_ENTRADAS = int(os.environ.get('OPTISCAN_CACHE_ENTRADAS', '256'))
+CACHE_TTL_S = float(os.environ.get('OPTISCAN_CACHE_TTL_S', '3600'))
+CACHE_DIRECTORIO = os.environ.get('OPTISCAN_CACHE_DIR') or None
+CACHE_DISCO_MAX = int(os.environ.get('OPTISCAN_CACHE_DISCO_MAX', '2000'))
+
+# Versión del código de análisis dentro de la clave: se sube cada vez que
+# cambian los resultados para la misma imagen
+VERSION_ANALISIS = 'analisis-v3'
+
+# Etiqueta adicional de la configuración; cambiarla invalida todos los
+# resultados guardados sin tocar el código
+CACHE_CONFIGURACION = os.environ.get('OPTISCAN_CACHE_CONFIG', '')
+
+# Cada cuántas escrituras se poda el nivel en disco
+PODA_CADA = 50
+
+
+def a_json(valor):
+    """Convertir tipos de NumPy que json no serializa por sí mismo"""
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, np.ndarray):
+        return valor.tolist()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def crear_directorio_privado(ruta):
+    """Crear el directorio solo para el usuario actual, o validar el que ya existe
+
+    Lanza OSError si es un enlace simbólico, no es un directorio o
+    pertenece a otro usuario (otro podría leer o plantar resultados).
+    """
+    os.makedirs(ruta, mode=0o700, exist_ok=True)
+    info = os.lstat(ruta)
+    if stat.S_ISLNK(info.st_mode) or not stat.S_ISDIR(info.st_mode):
+        raise OSError(f"{ruta} no es un directorio propio (enlace simbólico u otro tipo de archivo)")
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise OSError(f"{ruta} pertenece a otro usuario (uid {info.st_uid})")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(ruta, 0o700)
+
+
+def configuracion_cache(**ajustes):
+    """Componente de configuración de la clave
+
+    Versión del código, etiqueta de OPTISCAN_CACHE_CONFIG, resolución de
+    detección y los ajustes del servidor que cambian los resultados (p. ej.
+    aislamiento='pool'): cambiar cualquiera de ellos invalida la caché.
+    """
+    ajustes = dict(ajustes, deteccion=RESOLUCION_DETECCION)
+    partes = [VERSION_ANALISIS, CACHE_CONFIGURACION] + [f"{k}={v}" for k, v in sorted(ajustes.items())]
+    return ';'.join(partes)
+
+
+CONFIGURACION_ANALISIS = configuracion_cache()
+
+
+def clave_cache(buffer_imagen, tipo, incluir=None, configuracion=None):
+    """Clave de caché: hash de la imagen + tipo + artefactos + configuración
+
+    Sin `configuracion` se usa la común a ambos servidores (CONFIGURACION_ANALISIS).
+    """
+    if configuracion is None:
+        configuracion = CONFIGURACION_ANALISIS
+    h = hashlib.blake2b(digest_size=20)
+    h.update(memoryview(buffer_imagen).cast('B'))
+    campos = 'todos' if incluir is None else ','.join(sorted(incluir))
+    h.update(f"|{tipo}|{campos}|{configuracion}".encode('utf-8'))
+    return h.hexdigest()
+
+
+def resultado_cacheable(resultado):
+    """Solo se guardan resultados completos, sin errores"""
+    if not isinstance(resultado, dict) or not resultado:
+        return False
+    if resultado.get('estado') == 'error':
+        return False
+    return not any(
+        isinstance(v, dict) and v.get('estado') == 'error'
+        for v in resultado.values()
+    )
+
+
+class CacheResultados:
+    """Caché LRU + TTL con nivel opcional en disco"""
+
+    def __init__(self, max_entradas=None, ttl_s=None, directorio=None, max_disco=None):
+        self.max_entradas = CACHE_ENTRADAS if max_entradas is None else max_entradas
+        self.ttl_s = CACHE_TTL_S if ttl_s is None else ttl_s
+        self.directorio = directorio if directorio is not None else CACHE_DIRECTORIO
+        self.max_disco = CACHE_DISCO_MAX if max_disco is None else max_disco
+
+        # clave -> (momento de guardado, JSON serializado)
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.aciertos = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.expiraciones = 0
+        self._escrituras_disco = 0
+
+        if self.directorio:
+            try:
+                crear_directorio_privado(self.directorio)
+            except OSError as e:
+                print(f">>> Caché: no se pudo usar {self.directorio} ({e}), nivel en disco desactivado")
+                self.directorio = None
+
+        print(f">>> Caché de resultados: {self.max_entradas} entradas, TTL {self.ttl_s:.0f}s, "
+              f"disco: {self.directorio or 'desactivado'}")
+
+    @property
+    def activa(self):
+        return self.max_entradas > 0 or bool(self.directorio)
+
+    def _ruta_disco(self, clave):
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def obtener(self, clave):
+        """Resultado guardado (copia nueva) o None"""
+        if not self.activa:
+            return None
+
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None:
+                guardado, serializado = entrada
+                if ahora - guardado <= self.ttl_s:
+                    self._entradas.move_to_end(clave)
+                    self.aciertos += 1
+                    return json.loads(serializado)
+                del self._entradas[clave]
+                self.expiraciones += 1
+
+        guardado, serializado = self._leer_disco(clave, ahora)
+        if serializado is not None:
+            try:
+                resultado = json.loads(serializado)
+            except ValueError:
+                resultado = None
+            if resultado is not None:
+                with self._lock:
+                    self.aciertos_disco += 1
+                    # Conserva el momento original: el TTL no se reinicia
+                    self._guardar_memoria(clave, serializado, guardado)
+                return resultado
+
+        with self._lock:
+            self.fallos += 1
+        return None
+
+    def guardar(self, clave, resultado):
+        """Guardar un resultado si es cacheable; devuelve True si se guardó"""
+        if not self.activa or not resultado_cacheable(resultado):
+            return False
+
+        try:
+            serializado = json.dumps(resultado, ensure_ascii=False, default=a_json)
+        except (TypeError, ValueError) as e:
+            print(f">>> Caché: resultado no serializable ({e})")
+            return False
+
+        ahora = time.time()
+        with self._lock:
+            self._guardar_memoria(clave, serializado, ahora)
+        self._escribir_disco(clave, serializado)
+        return True
+
+    def _guardar_memoria(self, clave, serializado, ahora):
+        # Llamar con self._lock tomado
+        if self.max_entradas <= 0:
+            return
+        self._entradas[clave] = (ahora, serializado)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+            self.desalojos += 1
+
+    def _leer_disco(self, clave, ahora):
+        """(momento de guardado, JSON serializado) del nivel en disco, o (None, None)"""
+        if not self.directorio:
+            return None, None
+        ruta = self._ruta_disco(clave)
+        try:
+            guardado = os.path.getmtime(ruta)
+            if ahora - guardado > self.ttl_s:
+                os.remove(ruta)
+                with self._lock:
+                    self.expiraciones += 1
+                return None, None
+            with open(ruta, 'r', encoding='utf-8') as f:
+                return guardado, f.read()
+        except OSError:
+            return None, None
+
+    def _escribir_disco(self, clave, serializado):
+        if not self.directorio:
+            return
+        try:
+            # Escritura atómica: otro proceso nunca lee un archivo a medias
+            fd, temporal = tempfile.mkstemp(dir=self.directorio, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(serializado)
+            os.replace(temporal, self._ruta_disco(clave))
+            self._escrituras_disco += 1
+            if self._escrituras_disco % PODA_CADA == 0:
+                self._podar_disco()
+        except OSError as e:
+            print(f">>> Caché: no se pudo escribir en disco ({e})")
+
+    def _podar_disco(self):
+        """Mantener el nivel en disco por debajo de max_disco archivos"""
+        try:
+            archivos = [e for e in os.scandir(self.directorio) if e.name.endswith('.json')]
+        except OSError:
+            return
+        exceso = len(archivos) - self.max_disco
+        if exceso <= 0:
+            return
+        archivos.sort(key=lambda e: e.stat().st_mtime)
+        for entrada in archivos[:exceso]:
+            try:
+                os.remove(entrada.path)
+            except OSError:
+                pass
+
+    def limpiar(self):
+        """Vaciar ambos niveles"""
+        with self._lock:
+            self._entradas.clear()
+        if self.directorio:
+            for entrada in os.scandir(self.directorio):
+                if entrada.name.endswith('.json'):
+                    try:
+                        os.remove(entrada.path)
+                    except OSError:
+                        pass
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.aciertos + self.aciertos_disco + self.fallos
+            return {
+                'activa': self.activa,
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'ttl_s': self.ttl_s,
+                'directorio': self.directorio,
+                'aciertos': self.aciertos,
+                'aciertos_disco': self.aciertos_disco,
+                'fallos': self.fallos,
+                'tasa_aciertos': round((self.aciertos + self.aciertos_disco) / consultas, 4) if consultas else 0.0,
+                'desalojos': self.desalojos,
+                'expiraciones': self.expiraciones
+            }
@@ -0,0 +1,178 @@
+"""
+Calentamiento de los modelos al arrancar y estado de preparación (/ready).
+
+La primera inferencia de MediaPipe, el primer ajuste de KMeans y la
+primera figura de matplotlib pagan inicializaciones que no se repiten.
+Al arrancar, cada servidor ejecuta una pasada sintética por cada pipeline
+(forma, tono, cuadrado de referencia y, en el de PDF, la figura) y solo
+entonces /ready responde 200; /health sigue indicando que el proceso vive.
+
+La imagen por defecto es sintética (un óvalo color piel y un cuadrado
+verde): calienta el detector, KMeans y OpenCV, pero sin rostro real
+MediaPipe no llega a ejecutar el modelo de landmarks. Con
+OPTISCAN_CALENTAMIENTO_IMAGEN apuntando a una foto con un rostro se
+calienta también ese modelo.
+
+Las etapas del calentamiento no se registran en las métricas.
+"""
+import io
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metricas import sin_metricas
+
+# "0" desactiva el calentamiento (el servidor queda listo al cargar los analizadores)
+CALENTAMIENTO_ACTIVO = os.environ.get('OPTISCAN_CALENTAMIENTO', '1') != '0'
+CALENTAMIENTO_IMAGEN = os.environ.get('OPTISCAN_CALENTAMIENTO_IMAGEN') or None
+
+
+def imagen_sintetica(alto=480, ancho=640):
+    """Imagen BGR con un óvalo color piel y un cuadrado verde de referencia"""
+    imagen = np.full((alto, ancho, 3), 200, dtype=np.uint8)
+    centro = (ancho // 2, alto // 2)
+    cv2.ellipse(imagen, centro, (ancho // 6, alto // 3), 0, 0, 360, (150, 180, 225), -1)
+    for dx in (-ancho // 16, ancho // 16):
+        cv2.circle(imagen, (centro[0] + dx, centro[1] - alto // 12), 8, (60, 40, 30), -1)
+    lado = alto // 6
+    cv2.rectangle(imagen, (20, 20), (20 + lado, 20 + lado), (0, 200, 0), -1)
+    return imagen
+
+
+def imagen_calentamiento():
+    """Imagen BGR para calentar: la de OPTISCAN_CALENTAMIENTO_IMAGEN o la sintética"""
+    if CALENTAMIENTO_IMAGEN:
+        imagen = cv2.imread(CALENTAMIENTO_IMAGEN)
+        if imagen is not None:
+            return imagen
+        print(f">>> Calentamiento: no se pudo leer {CALENTAMIENTO_IMAGEN}, se usa la imagen sintética")
+    return imagen_sintetica()
+
+
+def calentar_forma(analizador, imagen):
+    """Face Mesh del analizador de forma (main.py o main_pdf.py)"""
+    analizador.analizar_rostro_imagen(imagen)
+
+
+def calentar_tono(analizador_tono, imagen):
+    """Face Mesh del analizador de tono y un ajuste de KMeans sobre la imagen"""
+    analizador_tono.analizar_tono_piel_imagen(imagen)
+    # Sin rostro no se llega a KMeans: se calienta sobre toda la imagen
+    imagen_rgb = cv2.cvtColor(imagen, cv2.COLOR_BGR2RGB)
+    mascara = np.full(imagen.shape[:2], 255, dtype=np.uint8)
+    analizador_tono.extraer_color_piel_mejorado(imagen_rgb, mascara)
+
+
+def calentar_referencia(imagen):
+    """Detección del cuadrado verde y codificación JPEG de la imagen de debug"""
+    from mm import ConversorMedidasReales
+    ConversorMedidasReales().detectar_cuadrado_verde(imagen)
+
+
+def calentar_completo(pipeline, imagen):
+    """Pipeline de /analyze-complete, incluidos sus hilos"""
+    pipeline.analizar(imagen)
+
+
+def calentar_figura_pdf(imagen):
+    """Primera figura de matplotlib (fuentes, backend Agg) y un PDF vacío de FPDF"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from fpdf import FPDF
+
+    plt.figure(figsize=(14, 10))
+    plt.imshow(cv2.cvtColor(imagen, cv2.COLOR_BGR2RGB))
+    plt.title("CALENTAMIENTO", fontsize=16, weight='bold')
+    plt.axis('off')
+    plt.tight_layout()
+    salida = io.BytesIO()
+    plt.savefig(salida, format='png', dpi=150, bbox_inches='tight', facecolor='white')
+    plt.close()
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font('Arial', 'B', 24)
+    pdf.cell(0, 20, "CALENTAMIENTO", 0, 1, 'C')
+    pdf.output(dest='S')
+
+
+class EstadoPreparacion:
+    """Estado del calentamiento: listo solo cuando todas las pasadas terminaron bien"""
+
+    def __init__(self):
+        self.listo = False
+        self.en_curso = False
+        self.error = None
+        self.pasos = {}
+        self.inicio = None
+        self.fin = None
+        self._lock = threading.Lock()
+
+    def ejecutar(self, pasos):
+        """Ejecutar las pasadas [(nombre, función), ...] en orden"""
+        with self._lock:
+            self.en_curso = True
+            self.inicio = time.time()
+
+        if not CALENTAMIENTO_ACTIVO:
+            pasos = []
+            print(">>> Calentamiento desactivado (OPTISCAN_CALENTAMIENTO=0)")
+
+        error = None
+        with sin_metricas():
+            for nombre, funcion in pasos:
+                inicio = time.perf_counter()
+                try:
+                    funcion()
+                    estado = {'estado': 'ok'}
+                except Exception as e:
+                    error = f"{nombre}: {e}"
+                    estado = {'estado': 'error', 'error': str(e)}
+                estado['ms'] = round(1000 * (time.perf_counter() - inicio), 1)
+                with self._lock:
+                    self.pasos[nombre] = estado
+                print(f">>> Calentamiento {nombre}: {estado['estado']} ({estado['ms']} ms)")
+
+        with self._lock:
+            self.en_curso = False
+            self.fin = time.time()
+            self.error = error
+            self.listo = error is None
+
+        if error is None:
+            print(f">>> Servidor listo (calentamiento en {self.fin - self.inicio:.1f}s)")
+        else:
+            print(f">>> Calentamiento fallido, el servidor no se marca como listo: {error}")
+
+    def iniciar_en_segundo_plano(self, pasos):
+        """Calentar en un hilo: el servidor acepta conexiones (y /ready responde 503) mientras tanto"""
+        hilo = threading.Thread(target=self.ejecutar, args=(pasos,),
+                                name='calentamiento', daemon=True)
+        hilo.start()
+        return hilo
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'ready': self.listo,
+                'calentando': self.en_curso,
+                'error': self.error,
+                'pasos': dict(self.pasos),
+                'duracion_s': round(self.fin - self.inicio, 2) if self.inicio and self.fin else None
+            }
+
+    def estado_modelos(self, analizadores):
+        """Por analizador ({paso: analizador}): grafo de MediaPipe creado y pasada de calentamiento hecha"""
+        with self._lock:
+            pasos = dict(self.pasos)
+        return {
+            nombre: {
+                'cargado': analizador is not None and getattr(analizador, 'face_mesh', None) is not None,
+                'calentado': pasos.get(nombre, {}).get('estado') == 'ok'
+            }
+            for nombre, analizador in analizadores.items()
+        }
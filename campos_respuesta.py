@@ -0,0 +1,109 @@
+"""
+Selección de los artefactos pesados que se incluyen en la respuesta.
+
+Por defecto los endpoints interactivos devuelven una respuesta ligera: solo
+forma, medidas, recomendaciones y clasificación. Los artefactos pesados se
+piden explícitamente con el parámetro "fields" (o su alias "include"), en
+la query string, en el formulario multipart o en el cuerpo JSON:
+
+    /analyze-face?fields=imagen_base64,puntos_faciales
+    /analyze-complete?include=all
+
+Los artefactos no pedidos no se calculan, no se codifican y no se
+serializan.
+"""
+
+# Artefactos opcionales
+CAMPO_IMAGEN_FORMA = 'imagen_base64'      # JPEG de la vista espejo (forma)
+CAMPO_PUNTOS_FACIALES = 'puntos_faciales'  # los 478 landmarks en píxeles
+CAMPO_IMAGEN_TONO = 'imagen_tono'          # visualización de la máscara de piel
+CAMPO_IMAGEN_DEBUG = 'imagen_debug'        # cuadrado de referencia detectado (mm.py)
+
+CAMPOS_OPCIONALES = frozenset({
+    CAMPO_IMAGEN_FORMA,
+    CAMPO_PUNTOS_FACIALES,
+    CAMPO_IMAGEN_TONO,
+    CAMPO_IMAGEN_DEBUG,
+})
+
+# Respuesta ligera por defecto de los endpoints interactivos
+CAMPOS_LIGEROS = frozenset()
+
+PARAMETROS_CAMPOS = ('fields', 'include')
+VALORES_TODOS = ('all', '*')
+
+
+class ErrorCamposSolicitud(ValueError):
+    """La solicitud pide un artefacto desconocido"""
+
+
+def incluye(incluir, campo):
+    """True si el artefacto debe calcularse; incluir=None significa todos"""
+    return incluir is None or campo in incluir
+
+
+def normalizar_campos(valor):
+    """Convertir "a,b", ["a", "b"] o "all" en un frozenset de artefactos"""
+    if isinstance(valor, str):
+        nombres = valor.split(',')
+    else:
+        nombres = list(valor)
+
+    nombres = {str(n).strip() for n in nombres if str(n).strip()}
+
+    if any(n in VALORES_TODOS for n in nombres):
+        return CAMPOS_OPCIONALES
+
+    desconocidos = nombres - CAMPOS_OPCIONALES
+    if desconocidos:
+        raise ErrorCamposSolicitud(
+            f"Campos desconocidos: {', '.join(sorted(desconocidos))}. "
+            f"Disponibles: {', '.join(sorted(CAMPOS_OPCIONALES))}"
+        )
+    return frozenset(nombres)
+
+
+def leer_campos_solicitud(req, por_defecto=CAMPOS_LIGEROS):
+    """Artefactos pedidos en la solicitud (query string, formulario o JSON)"""
+    for parametro in PARAMETROS_CAMPOS:
+        if parametro in req.args:
+            return normalizar_campos(req.args[parametro])
+        if parametro in req.form:
+            return normalizar_campos(req.form[parametro])
+
+    if req.is_json:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            for parametro in PARAMETROS_CAMPOS:
+                if parametro in data:
+                    return normalizar_campos(data[parametro])
+
+    return por_defecto
+
+
+def filtrar_forma(resultado, incluir):
+    """Quitar de un análisis de forma ya calculado los artefactos no pedidos
+
+    Para resultados que llegan completos (scripts del modo "subproceso") o
+    calculados con más artefactos de los pedidos (sesiones de análisis).
+    """
+    if incluir is None or not isinstance(resultado, dict):
+        return resultado
+
+    filtrado = {k: v for k, v in resultado.items()
+                if k not in (CAMPO_IMAGEN_FORMA, CAMPO_PUNTOS_FACIALES) or k in incluir}
+
+    referencia = filtrado.get('deteccion_referencia')
+    if CAMPO_IMAGEN_DEBUG not in incluir and isinstance(referencia, dict) \
+            and isinstance(referencia.get('deteccion'), dict):
+        deteccion = {k: v for k, v in referencia['deteccion'].items() if k != CAMPO_IMAGEN_DEBUG}
+        filtrado['deteccion_referencia'] = {**referencia, 'deteccion': deteccion}
+
+    return filtrado
+
+
+def filtrar_tono(resultado, incluir):
+    """Quitar de un análisis de tono ya calculado la visualización no pedida"""
+    if incluir is None or CAMPO_IMAGEN_TONO in incluir or not isinstance(resultado, dict):
+        return resultado
+    return {k: v for k, v in resultado.items() if k != 'imagen_base64'}
@@ -0,0 +1,58 @@
+"""
+Canal de resultados de los scripts de análisis (main.py, tonos.py, trabajador.py).
+
+El descriptor de stdout queda reservado para el resultado: al abrir el canal
+se duplica en un descriptor privado y el descriptor 1 se redirige a stderr.
+Así los print de diagnóstico, y también lo que escriban directamente
+bibliotecas en C (MediaPipe, TensorFlow Lite, OpenCV), van al log y nunca al
+canal de resultados.
+
+Los scripts main.py y tonos.py escriben exactamente un documento JSON y el
+proceso padre lo decodifica con una sola llamada (leer_resultado), sin
+recorrer líneas buscando algo que parezca JSON.
+"""
+import json
+import os
+import sys
+
+
+class ErrorCanalResultado(ValueError):
+    """La salida del script no es exactamente un resultado JSON"""
+
+
+def abrir_canal_resultado():
+    """Reservar el stdout real para el resultado y desviar todo lo demás a stderr
+
+    Devuelve el canal (texto UTF-8) sobre el descriptor original de stdout.
+    """
+    sys.stdout.flush()
+    descriptor = os.dup(sys.stdout.fileno())
+    # Lo que se escriba en el descriptor 1 (incluido código en C) va a stderr
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    if sys.platform == "win32":
+        # Los diagnósticos llevan emojis: que stderr no falle con la consola de Windows
+        sys.stderr.reconfigure(encoding='utf-8', errors='backslashreplace')
+
+    return os.fdopen(descriptor, 'w', encoding='utf-8', newline='\n')
+
+
+def enviar_resultado(canal, resultado):
+    """Escribir el único mensaje del script: el resultado como un documento JSON"""
+    canal.write(json.dumps(resultado, ensure_ascii=False))
+    canal.write('\n')
+    canal.flush()
+
+
+def leer_resultado(salida):
+    """Decodificar la salida completa (bytes o str) de un script como un único resultado"""
+    if not salida or not salida.strip():
+        raise ErrorCanalResultado("El script no devolvió ningún resultado")
+    try:
+        resultado = json.loads(salida)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ErrorCanalResultado(f"Resultado JSON inválido: {e}")
+    if not isinstance(resultado, dict):
+        raise ErrorCanalResultado("El resultado del script no es un objeto JSON")
+    return resultado
@@ -0,0 +1,445 @@
+"""
+Generador de carga para la API de OptiScan (solo localhost).
+
+Reproduce un corpus de capturas (JPEG/PNG) contra /analyze-face,
+/analyze-skin-tone, /analyze-complete y /generate-pdf-report subiendo la
+concurrencia por niveles. De cada nivel informa solicitudes por segundo,
+latencia p50/p95/p99, errores por código y la memoria residente (RSS) de
+los servidores a lo largo de la prueba, y lo guarda todo en un JSON para
+comparar versiones.
+
+Uso:
+    python carga.py --corpus capturas/ --niveles 1,2,4,8 --duracion 30
+    python carga.py --corpus foto.jpg --endpoints forma,completo --salida carga.json
+
+Los servidores deben estar arrancados (app.py en 5000, appdf.py en 5001, o
+prefork.py). La memoria se mide sobre todos los procesos que escuchan en el
+puerto y sus hijos (trabajadores del pool o de prefork).
+
+Por defecto cada envío añade unos bytes al final de la imagen (los
+decodificadores los ignoran) para que la caché de resultados y la
+coalescencia de solicitudes idénticas no conviertan la prueba en aciertos
+de caché; --con-cache envía las imágenes tal cual.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from pool_trabajadores import memoria_proceso_mb
+
+ENDPOINTS = {
+    'forma': ('principal', '/analyze-face'),
+    'tono': ('principal', '/analyze-skin-tone'),
+    'completo': ('principal', '/analyze-complete'),
+    'pdf': ('pdf', '/generate-pdf-report'),
+}
+PUERTOS = {'principal': 5000, 'pdf': 5001}
+HOSTS_LOCALES = ('localhost', '127.0.0.1', '::1')
+
+EXTENSIONES_CORPUS = ('.jpg', '.jpeg', '.png')
+TIPOS_CONTENIDO = {b'\x89PNG': 'image/png'}
+
+# Espera máxima a que /ready responda 200 antes de empezar
+ESPERA_PREPARADO_S = 120
+TIMEOUT_SOLICITUD_S = 120
+
+# Distingue las variaciones de esta ejecución de las de pruebas anteriores
+# (que pueden seguir en la caché del servidor)
+MARCA_EJECUCION = secrets.token_hex(4)
+
+
+def cargar_corpus(ruta):
+    """Bytes de las capturas: un archivo o todas las imágenes de un directorio"""
+    if os.path.isdir(ruta):
+        rutas = sorted(os.path.join(ruta, nombre) for nombre in os.listdir(ruta)
+                       if nombre.lower().endswith(EXTENSIONES_CORPUS))
+    else:
+        rutas = [ruta]
+    corpus = []
+    for archivo in rutas:
+        with open(archivo, 'rb') as f:
+            corpus.append((os.path.basename(archivo), f.read()))
+    return corpus
+
+
+def tipo_contenido(contenido):
+    return TIPOS_CONTENIDO.get(contenido[:4], 'image/jpeg')
+
+
+def variar(contenido, numero):
+    """Imagen con bytes extra tras el final del JPEG/PNG: misma foto, otra clave de caché"""
+    return contenido + f"\x00optiscan-carga-{MARCA_EJECUCION}-{numero}".encode('ascii')
+
+
+def percentil(ordenados, fraccion):
+    return ordenados[int(fraccion * (len(ordenados) - 1))] if ordenados else 0.0
+
+
+# ============================================================
+# PROCESOS DE LOS SERVIDORES Y MEMORIA
+# ============================================================
+
+def pids_escuchando(puerto):
+    """PIDs con un socket TCP escuchando en el puerto (varios con prefork)"""
+    try:
+        import psutil
+        return sorted({c.pid for c in psutil.net_connections(kind='tcp')
+                       if c.pid and c.status == psutil.CONN_LISTEN and c.laddr and c.laddr.port == puerto})
+    except ImportError:
+        pass
+    except Exception:
+        return []
+
+    # Respaldo sin psutil (Linux): inodos del puerto en /proc/net/tcp y dueños de esos sockets
+    inodos = set()
+    for tabla in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(tabla) as f:
+                next(f)
+                for linea in f:
+                    campos = linea.split()
+                    # Estado 0A = LISTEN
+                    if campos[3] == '0A' and int(campos[1].rsplit(':', 1)[1], 16) == puerto:
+                        inodos.add(f"socket:[{campos[9]}]")
+        except (OSError, StopIteration):
+            pass
+    if not inodos:
+        return []
+
+    pids = set()
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit():
+            continue
+        try:
+            directorio_fd = f"/proc/{entrada}/fd"
+            if any(os.readlink(os.path.join(directorio_fd, fd)) in inodos
+                   for fd in os.listdir(directorio_fd)):
+                pids.add(int(entrada))
+        except OSError:
+            pass
+    return sorted(pids)
+
+
+def procesos_descendientes(pids):
+    """Los PIDs dados y todos sus descendientes"""
+    try:
+        import psutil
+        todos = set()
+        for pid in pids:
+            try:
+                todos.add(pid)
+                todos.update(hijo.pid for hijo in psutil.Process(pid).children(recursive=True))
+            except psutil.Error:
+                pass
+        return sorted(todos)
+    except ImportError:
+        pass
+
+    # Respaldo sin psutil (Linux): padre de cada proceso en /proc/<pid>/stat
+    hijos = {}
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entrada}/stat") as f:
+                # El nombre va entre paréntesis y puede contener espacios
+                padre = int(f.read().rsplit(')', 1)[1].split()[1])
+            hijos.setdefault(padre, []).append(int(entrada))
+        except (OSError, ValueError, IndexError):
+            pass
+    todos = set()
+    pendientes = list(pids)
+    while pendientes:
+        pid = pendientes.pop()
+        if pid not in todos:
+            todos.add(pid)
+            pendientes.extend(hijos.get(pid, ()))
+    return sorted(todos)
+
+
+class MuestreadorMemoria:
+    """Hilo que anota cada `intervalo_s` el RSS de cada servidor (con sus hijos)"""
+
+    def __init__(self, puertos, intervalo_s, inicio):
+        self.puertos = puertos
+        self.intervalo_s = intervalo_s
+        self.inicio = inicio
+        self.nivel = None
+        self.muestras = []
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+
+    def medir(self):
+        rss_mb = {}
+        procesos = {}
+        for servidor, puerto in self.puertos.items():
+            pids = procesos_descendientes(pids_escuchando(puerto))
+            memorias = [m for m in (memoria_proceso_mb(pid) for pid in pids) if m is not None]
+            rss_mb[servidor] = round(sum(memorias), 1) if memorias else None
+            procesos[servidor] = len(pids)
+        self.muestras.append({
+            't_s': round(time.perf_counter() - self.inicio, 2),
+            'nivel': self.nivel,
+            'rss_mb': rss_mb,
+            'procesos': procesos
+        })
+
+    def _bucle(self):
+        while not self._detener.wait(self.intervalo_s):
+            self.medir()
+
+    def iniciar(self):
+        self.medir()
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join()
+        self.medir()
+
+    def maximo(self, nivel):
+        """RSS máximo de cada servidor durante un nivel"""
+        maximos = {}
+        for muestra in self.muestras:
+            if muestra['nivel'] != nivel:
+                continue
+            for servidor, rss in muestra['rss_mb'].items():
+                if rss is not None:
+                    maximos[servidor] = max(maximos.get(servidor, 0.0), rss)
+        return maximos
+
+
+# ============================================================
+# SOLICITUDES
+# ============================================================
+
+def enviar(host, puerto, ruta, contenido, timeout):
+    """POST binario de una imagen; devuelve (código, segundos, acierto de caché)
+
+    El código es 0 si la conexión falló (servidor caído, timeout).
+    """
+    inicio = time.perf_counter()
+    conexion = http.client.HTTPConnection(host, puerto, timeout=timeout)
+    try:
+        conexion.request('POST', ruta, body=contenido, headers={'Content-Type': tipo_contenido(contenido)})
+        respuesta = conexion.getresponse()
+        respuesta.read()
+        return respuesta.status, time.perf_counter() - inicio, respuesta.getheader('X-Cache') == 'HIT'
+    except (OSError, http.client.HTTPException):
+        return 0, time.perf_counter() - inicio, False
+    finally:
+        conexion.close()
+
+
+def esperar_preparado(host, puerto, espera_s):
+    """True cuando GET /ready responde 200"""
+    limite = time.monotonic() + espera_s
+    while True:
+        conexion = http.client.HTTPConnection(host, puerto, timeout=5)
+        try:
+            conexion.request('GET', '/ready')
+            respuesta = conexion.getresponse()
+            respuesta.read()
+            if respuesta.status == 200:
+                return True
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            conexion.close()
+        if time.monotonic() >= limite:
+            return False
+        time.sleep(1)
+
+
+def ejecutar_nivel(concurrencia, duracion_s, trabajos, host, puertos, con_cache, timeout):
+    """Lanzar `concurrencia` clientes durante duracion_s; devuelve las muestras y la duración real
+
+    `trabajos` es un iterador compartido de (número de envío, (endpoint, imagen)).
+    """
+    lock = threading.Lock()
+    muestras = []
+    limite = time.perf_counter() + duracion_s
+
+    def cliente():
+        while time.perf_counter() < limite:
+            with lock:
+                n, (endpoint, contenido) = next(trabajos)
+            servidor, ruta = ENDPOINTS[endpoint]
+            cuerpo = contenido if con_cache else variar(contenido, n)
+            codigo, segundos, cache = enviar(host, puertos[servidor], ruta, cuerpo, timeout)
+            with lock:
+                muestras.append((endpoint, codigo, segundos, cache))
+
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=cliente, daemon=True) for _ in range(concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    # Las solicitudes en curso al vencer el nivel también cuentan
+    return muestras, time.perf_counter() - inicio
+
+
+def resumir(muestras, duracion_s):
+    """Solicitudes/s, latencias (ms) y errores de un conjunto de muestras"""
+    latencias = sorted(segundos * 1000 for _, _, segundos, _ in muestras)
+    errores = {}
+    for _, codigo, _, _ in muestras:
+        if not 200 <= codigo < 300:
+            clave = str(codigo) if codigo else 'conexion'
+            errores[clave] = errores.get(clave, 0) + 1
+    total = len(muestras)
+    fallidas = sum(errores.values())
+    return {
+        'solicitudes': total,
+        'exitosas': total - fallidas,
+        'rps': round(total / duracion_s, 3) if duracion_s > 0 else 0.0,
+        'rps_exitosas': round((total - fallidas) / duracion_s, 3) if duracion_s > 0 else 0.0,
+        'latencia_ms': {
+            'p50': round(percentil(latencias, 0.50), 2),
+            'p95': round(percentil(latencias, 0.95), 2),
+            'p99': round(percentil(latencias, 0.99), 2),
+            'media': round(sum(latencias) / total, 2) if total else 0.0,
+            'max': round(latencias[-1], 2) if latencias else 0.0
+        },
+        'errores': errores,
+        'tasa_error': round(fallidas / total, 4) if total else 0.0,
+        'aciertos_cache': sum(1 for *_, cache in muestras if cache)
+    }
+
+
+def version_codigo():
+    """Commit actual del repositorio (None fuera de git)"""
+    try:
+        resultado = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+        return resultado.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def imprimir_nivel(nivel):
+    total = nivel['total']
+    lat = total['latencia_ms']
+    memoria = ', '.join(f"{s} {mb:.0f} MB" for s, mb in nivel['rss_max_mb'].items()) or 'sin datos'
+    print(f">>> Concurrencia {nivel['concurrencia']}: {total['solicitudes']} solicitudes, "
+          f"{total['rps']:.2f} req/s, p50 {lat['p50']:.0f} ms, p95 {lat['p95']:.0f} ms, "
+          f"p99 {lat['p99']:.0f} ms, errores {total['tasa_error']:.1%}, RSS máx. {memoria}")
+    for endpoint, resumen in nivel['por_endpoint'].items():
+        lat = resumen['latencia_ms']
+        print(f"    {endpoint:<9} {resumen['solicitudes']:>5} sol. {resumen['rps']:>7.2f} req/s  "
+              f"p50 {lat['p50']:>7.0f}  p95 {lat['p95']:>7.0f}  p99 {lat['p99']:>7.0f} ms  "
+              f"errores {resumen['errores'] or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de OptiScan contra localhost")
+    parser.add_argument('--corpus', default=os.environ.get('OPTISCAN_CALENTAMIENTO_IMAGEN'),
+                        help="Imagen o directorio de capturas (JPEG/PNG)")
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help=f"Lista separada por comas de: {', '.join(ENDPOINTS)}")
+    parser.add_argument('--niveles', default='1,2,4,8', help="Concurrencias a probar, en orden")
+    parser.add_argument('--duracion', type=float, default=30.0, help="Segundos por nivel")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=PUERTOS['principal'])
+    parser.add_argument('--puerto-pdf', type=int, default=PUERTOS['pdf'])
+    parser.add_argument('--intervalo-memoria', type=float, default=1.0, help="Segundos entre muestras de RSS")
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_SOLICITUD_S)
+    parser.add_argument('--con-cache', action='store_true',
+                        help="Enviar las imágenes sin variar (mide también la caché)")
+    parser.add_argument('--salida', default=None, help="Archivo JSON de resultados")
+    args = parser.parse_args()
+
+    if args.host not in HOSTS_LOCALES:
+        sys.exit(f"❌ La prueba de carga solo se ejecuta contra localhost ({', '.join(HOSTS_LOCALES)})")
+    if not args.corpus:
+        sys.exit("❌ Indica las capturas con --corpus (o OPTISCAN_CALENTAMIENTO_IMAGEN)")
+
+    endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    desconocidos = [e for e in endpoints if e not in ENDPOINTS]
+    if desconocidos or not endpoints:
+        sys.exit(f"❌ Endpoints desconocidos: {', '.join(desconocidos) or '(ninguno)'}")
+    try:
+        niveles = [int(n) for n in args.niveles.split(',') if n.strip()]
+    except ValueError:
+        sys.exit("❌ --niveles debe ser una lista de enteros, p. ej. 1,2,4,8")
+    if not niveles or min(niveles) < 1:
+        sys.exit("❌ --niveles debe ser una lista de enteros positivos")
+
+    try:
+        corpus = cargar_corpus(args.corpus)
+    except OSError as e:
+        sys.exit(f"❌ No se pudo leer el corpus: {e}")
+    if not corpus:
+        sys.exit(f"❌ No hay imágenes JPEG/PNG en {args.corpus}")
+
+    puertos_todos = {'principal': args.puerto, 'pdf': args.puerto_pdf}
+    puertos = {s: puertos_todos[s] for s in sorted({ENDPOINTS[e][0] for e in endpoints})}
+    for servidor, puerto in puertos.items():
+        print(f">>> Esperando a que el servidor {servidor} ({args.host}:{puerto}) esté listo...")
+        if not esperar_preparado(args.host, puerto, ESPERA_PREPARADO_S):
+            sys.exit(f"❌ El servidor {servidor} no respondió 200 en /ready")
+
+    # Todos los endpoints reciben todas las capturas, intercaladas; el número
+    # de envío (único en toda la prueba) hace distinta cada variación
+    trabajos = zip(itertools.count(), itertools.cycle(
+        [(endpoint, contenido) for _, contenido in corpus for endpoint in endpoints]))
+
+    inicio = time.perf_counter()
+    muestreador = MuestreadorMemoria(puertos, args.intervalo_memoria, inicio)
+    muestreador.iniciar()
+    print(f">>> Corpus: {len(corpus)} capturas; endpoints: {', '.join(endpoints)}; "
+          f"niveles: {niveles} x {args.duracion:.0f}s")
+
+    resultados_niveles = []
+    try:
+        for concurrencia in niveles:
+            muestreador.nivel = concurrencia
+            muestras, duracion = ejecutar_nivel(concurrencia, args.duracion, trabajos, args.host,
+                                                puertos_todos, args.con_cache, args.timeout)
+            nivel = {
+                'concurrencia': concurrencia,
+                'duracion_s': round(duracion, 3),
+                'total': resumir(muestras, duracion),
+                'por_endpoint': {e: resumir([m for m in muestras if m[0] == e], duracion) for e in endpoints},
+                'rss_max_mb': muestreador.maximo(concurrencia)
+            }
+            resultados_niveles.append(nivel)
+            imprimir_nivel(nivel)
+    except KeyboardInterrupt:
+        print("⚠️ Prueba interrumpida, guardando los niveles completados")
+    finally:
+        muestreador.nivel = None
+        muestreador.detener()
+
+    informe = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'version': version_codigo(),
+        'configuracion': {
+            'host': args.host,
+            'puertos': puertos,
+            'endpoints': endpoints,
+            'niveles': niveles,
+            'duracion_s': args.duracion,
+            'corpus': [nombre for nombre, _ in corpus],
+            'con_cache': args.con_cache
+        },
+        'niveles': resultados_niveles,
+        'memoria': muestreador.muestras
+    }
+    salida = args.salida or f"carga_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"✅ Resultados guardados en {salida}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Clasificación de la forma del rostro a partir de las medidas de medidas.py.
+
+Las reglas de AnalizadorFormaRostroAvanzado.determinar_forma_rostro_avanzada
+están en una tabla ordenada (forma, descripción, condición): gana la primera
+que se cumple. Las condiciones valen tanto para las medidas de un rostro
+(floats) como para columnas de muchos rostros (arrays), así que el análisis
+de una imagen y la reclasificación por lotes usan las mismas definiciones.
+
+Uso (reclasificar landmarks históricos guardados como .npy (N, 478, 2) en píxeles):
+    python clasificacion_forma.py landmarks.npy --salida clasificacion.npz
+"""
+import argparse
+import time
+
+from collections import Counter
+
+import numpy as np
+
+from medidas import columnas_medidas
+
+# Rostros por bloque en analizar_lote (acota la memoria de los intermedios)
+TAM_BLOQUE = 100_000
+
+
+def entre(valor, minimo, maximo):
+    """minimo <= valor <= maximo, también elemento a elemento"""
+    return (minimo <= valor) & (valor <= maximo)
+
+
+def _como_diamante(m):
+    return entre(m['R_BD'], 0.88, 0.93) & entre(m['angulo_mandibula'], 135, 140)
+
+
+# Reglas en orden de prioridad; la última se cumple siempre
+REGLAS_FORMA = (
+    # CUADRADO - PARÁMETROS BASADOS EN TUS IMÁGENES CORRECTAS
+    ('Cuadrado', "Rostro con estructura angular y mandibula definida",
+     lambda m: (entre(m['R_AA'], 1.60, 1.80) & entre(m['R_BC'], 2.5, 2.7) & entre(m['R_BD'], 0.85, 0.90)
+                & entre(m['angulo_mandibula'], 122, 128) & entre(m['curvatura'], 6.0, 20.0))),
+    # DIAMANTE
+    ('Diamante', "Rostro con pomulos anchos y estructura angular",
+     lambda m: (entre(m['R_AA'], 1.55, 1.75) & entre(m['R_BC'], 2.3, 2.5) & entre(m['R_BD'], 0.88, 0.93)
+                & entre(m['angulo_mandibula'], 135, 140) & entre(m['curvatura'], 4.0, 15.0))),
+    # OVALADO
+    ('Ovalado', "Rostro con proporciones equilibradas y contornos suaves",
+     lambda m: (entre(m['R_AA'], 1.5, 1.8) & entre(m['R_BC'], 2.0, 2.6) & entre(m['R_BD'], 0.90, 1.05)
+                & entre(m['angulo_mandibula'], 128, 135) & (m['curvatura'] <= 12.0))),
+    # OBLONGO (alargado y sin estructura de diamante)
+    ('Oblongo', "Rostro muy alargado",
+     lambda m: ((m['R_AA'] >= 1.80) & np.logical_not(_como_diamante(m))
+                & (m['R_AA'] >= 1.85) & (m['R_BD'] <= 0.85))),
+    ('Oblongo', "Rostro alargado con estructura definida",
+     lambda m: ((m['R_AA'] >= 1.80) & np.logical_not(_como_diamante(m))
+                & entre(m['R_BC'], 2.3, 2.8) & entre(m['R_BD'], 0.80, 0.85)
+                & entre(m['angulo_mandibula'], 125, 140))),
+    # REDONDO
+    ('Redondo', "Rostro con contornos curvos y proporciones balanceadas",
+     lambda m: (entre(m['R_AA'], 1.5, 1.7) & entre(m['R_BC'], 2.4, 2.8) & entre(m['R_BD'], 0.85, 0.92)
+                & entre(m['angulo_mandibula'], 122, 128) & (m['curvatura'] >= 3.8))),
+    # Clasificación por defecto
+    ('Cuadrado', "Rostro cuadrado (estructura angular)",
+     lambda m: entre(m['R_BD'], 0.85, 0.90) & entre(m['angulo_mandibula'], 122, 128)),
+    ('Diamante', "Rostro diamante (pomulos prominentes)",
+     _como_diamante),
+    ('Ovalado', "Rostro ovalado (proporciones balanceadas)",
+     lambda m: entre(m['R_BD'], 0.90, 1.05) & entre(m['angulo_mandibula'], 128, 135)),
+    ('Oblongo', "Rostro oblongo",
+     lambda m: (m['R_AA'] >= 1.80) & (m['R_BD'] <= 0.85)),
+    ('Redondo', "Rostro redondeado",
+     lambda m: m['R_AA'] < 1.2),
+    ('Ovalado', "Rostro con proporciones equilibradas",
+     lambda m: True),
+)
+
+FORMAS = np.array([forma for forma, _, _ in REGLAS_FORMA])
+DESCRIPCIONES = np.array([descripcion for _, descripcion, _ in REGLAS_FORMA])
+
+
+def clasificar_forma(medidas):
+    """(forma, descripción) de un rostro a partir de su diccionario de medidas"""
+    for forma, descripcion, condicion in REGLAS_FORMA:
+        if condicion(medidas):
+            return forma, descripcion
+
+
+def clasificar_columnas(columnas):
+    """Forma de cada rostro a partir de columnas de medidas: {'forma', 'descripcion', 'regla'}"""
+    condiciones = [condicion(columnas) for _, _, condicion in REGLAS_FORMA]
+    regla = np.select(condiciones, np.arange(len(REGLAS_FORMA)), default=len(REGLAS_FORMA) - 1)
+    return {
+        'forma': FORMAS[regla],
+        'descripcion': DESCRIPCIONES[regla],
+        'regla': regla
+    }
+
+
+def analizar_lote(puntos, tam_bloque=TAM_BLOQUE):
+    """Medidas y forma de N rostros a la vez a partir de landmarks (N, 478, 2) en píxeles
+
+    Devuelve columnas: {medida o 'forma'/'descripcion'/'regla': array (N,)},
+    con los mismos valores que el análisis de cada imagen por separado.
+    Acepta un np.memmap (np.load(..., mmap_mode='r')); se procesa por bloques.
+    """
+    puntos = np.asarray(puntos)
+    if puntos.ndim != 3 or puntos.shape[-1] != 2:
+        raise ValueError(f"Se esperaba un array (N, 478, 2) de landmarks, no {puntos.shape}")
+
+    bloques = []
+    for inicio in range(0, max(len(puntos), 1), tam_bloque):
+        columnas = columnas_medidas(puntos[inicio:inicio + tam_bloque])
+        columnas.update(clasificar_columnas(columnas))
+        bloques.append(columnas)
+    if len(bloques) == 1:
+        return bloques[0]
+    return {clave: np.concatenate([bloque[clave] for bloque in bloques]) for clave in bloques[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reclasificar la forma del rostro desde landmarks guardados")
+    parser.add_argument('landmarks', help="Archivo .npy con un array (N, 478, 2) de landmarks en píxeles")
+    parser.add_argument('--salida', default=None, help="Archivo .npz con las columnas de resultados")
+    parser.add_argument('--tam-bloque', type=int, default=TAM_BLOQUE)
+    args = parser.parse_args()
+
+    puntos = np.load(args.landmarks, mmap_mode='r')
+    inicio = time.perf_counter()
+    columnas = analizar_lote(puntos, args.tam_bloque)
+    duracion = time.perf_counter() - inicio
+
+    print(f">>> {len(puntos)} rostros reclasificados en {duracion:.2f}s")
+    for forma, cantidad in Counter(columnas['forma'].tolist()).most_common():
+        print(f"   {forma}: {cantidad}")
+
+    if args.salida:
+        np.savez(args.salida, **columnas)
+        print(f"✅ Resultados guardados en {args.salida}")
+
+
+if __name__ == '__main__':
+    main()
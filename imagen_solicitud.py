@@ -0,0 +1,229 @@
+"""
+Lectura de la imagen enviada a los endpoints de análisis.
+
+Formatos aceptados:
+  - multipart/form-data con el archivo en el campo "image"
+  - cuerpo binario crudo (image/jpeg, image/png, application/octet-stream)
+  - JSON {"image": "data:image/jpeg;base64,..."} (formato original)
+
+Los formatos binarios se leen directamente del stream de la solicitud a un
+buffer de NumPy, sin pasar por base64 ni por un string de Python.
+Los analizadores usan imagen_desde_entrada para aceptar bytes o ndarrays
+en memoria sin escribir archivos temporales.
+
+Cada imagen tiene un tamaño máximo (OPTISCAN_MAX_BYTES_IMAGEN) que se
+comprueba antes de reservar su buffer, y el cuerpo completo otro
+(OPTISCAN_MAX_BYTES_SOLICITUD, MAX_CONTENT_LENGTH de Flask); por encima de
+cualquiera de los dos la solicitud se rechaza con 413.
+"""
+import base64
+import binascii
+import io
+import os
+
+import cv2
+import numpy as np
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from metricas import medir, ETAPA_DECODIFICAR_BASE64, ETAPA_DECODIFICAR_IMAGEN
+
+TIPOS_BINARIOS = ('image/jpeg', 'image/png', 'image/webp', 'application/octet-stream')
+CAMPO_IMAGEN = 'image'
+CAMPO_LOTE = 'images'
+
+# Bytes máximos de una imagen comprimida y del cuerpo de una solicitud (lotes incluidos)
+MAX_BYTES_IMAGEN = int(os.environ.get('OPTISCAN_MAX_BYTES_IMAGEN', str(20 * 1024 * 1024)))
+MAX_BYTES_SOLICITUD = int(os.environ.get('OPTISCAN_MAX_BYTES_SOLICITUD', str(256 * 1024 * 1024)))
+
+
+class ErrorImagenSolicitud(Exception):
+    """La solicitud trae una imagen que no se puede leer"""
+    codigo_http = 400
+
+
+class ImagenDemasiadoGrande(ErrorImagenSolicitud):
+    """La imagen o el cuerpo de la solicitud superan el tamaño máximo"""
+    codigo_http = 413
+
+
+class LoteDemasiadoGrande(ErrorImagenSolicitud):
+    """El lote trae más imágenes que el máximo permitido"""
+    codigo_http = 413
+
+
+def _demasiado_grande(maximo):
+    return ImagenDemasiadoGrande(f"La imagen supera el tamaño máximo de {maximo} bytes")
+
+
+def _leer_stream_en_buffer(stream, longitud=None, maximo=None):
+    """Leer un stream completo en un buffer uint8 de NumPy (como mucho `maximo` bytes)"""
+    maximo = MAX_BYTES_IMAGEN if maximo is None else maximo
+    if longitud:
+        # Content-Length lo decide el cliente: comprobarlo antes de reservar
+        if longitud > maximo:
+            raise _demasiado_grande(maximo)
+        buffer = np.empty(longitud, dtype=np.uint8)
+        vista = memoryview(buffer)
+        leidos = 0
+        while leidos < longitud:
+            n = stream.readinto(vista[leidos:])
+            if not n:
+                break
+            leidos += n
+        return buffer[:leidos]
+
+    contenido = stream.read(maximo + 1)
+    if len(contenido) > maximo:
+        raise _demasiado_grande(maximo)
+    return np.frombuffer(contenido, dtype=np.uint8)
+
+
+def _decodificar_base64(texto):
+    if isinstance(texto, str) and len(texto) * 3 // 4 > MAX_BYTES_IMAGEN + 3:
+        raise _demasiado_grande(MAX_BYTES_IMAGEN)
+    try:
+        # Quitar el prefijo data:image/...;base64, si existe
+        with medir(ETAPA_DECODIFICAR_BASE64):
+            return np.frombuffer(base64.b64decode(texto.split(',')[-1]), dtype=np.uint8)
+    except (binascii.Error, ValueError, AttributeError) as e:
+        raise ErrorImagenSolicitud(f"Base64 inválido: {e}")
+
+
+def leer_imagen_solicitud(req):
+    """Devolver los bytes codificados (JPEG/PNG) de la imagen como buffer uint8
+
+    Devuelve None si la solicitud no contiene imagen y lanza
+    ErrorImagenSolicitud si el contenido no se puede decodificar
+    (ImagenDemasiadoGrande si supera el tamaño máximo).
+    """
+    tipo = req.mimetype or ''
+
+    try:
+        if tipo == 'multipart/form-data':
+            archivo = req.files.get(CAMPO_IMAGEN)
+            if archivo is None:
+                return None
+            buffer = _leer_stream_en_buffer(archivo.stream)
+
+        elif tipo in TIPOS_BINARIOS:
+            buffer = _leer_stream_en_buffer(req.stream, req.content_length)
+
+        else:
+            data = req.get_json(silent=True)
+            if not data or CAMPO_IMAGEN not in data:
+                return None
+            buffer = _decodificar_base64(data[CAMPO_IMAGEN])
+    except RequestEntityTooLarge:
+        # Cuerpo por encima de MAX_CONTENT_LENGTH (multipart o JSON)
+        raise _demasiado_grande(req.max_content_length)
+
+    if buffer.size == 0:
+        return None
+    return buffer
+
+
+def _tomar_archivos_subidos(req):
+    """Streams de los archivos subidos (multipart), separados de la solicitud
+
+    Flask cierra los archivos de la solicitud al terminar la vista (con
+    Flask 3 antes de que stream_with_context vuelva a activar el contexto),
+    así que el lote se queda con sus streams y los cierra él mismo. Con más
+    de 500 KB de cuerpo Werkzeug los guarda en archivos temporales.
+    """
+    streams = []
+    for _, archivo in req.files.items(multi=True):
+        streams.append(archivo.stream)
+        archivo.stream = io.BytesIO()
+    return streams
+
+
+def _leer_stream_subido(stream):
+    """Bytes de un archivo subido, cerrándolo después"""
+    try:
+        return _leer_stream_en_buffer(stream)
+    finally:
+        stream.close()
+
+
+def leer_lote_solicitud(req, max_imagenes=None):
+    """Imágenes de una solicitud de lote
+
+    Acepta multipart con varios archivos (cualquier nombre de campo, en el
+    orden del cuerpo) o JSON {"images": ["data:image/jpeg;base64,...", ...]}.
+    Devuelve un generador de (buffer, error); un error en una imagen no
+    interrumpe las demás. Lanza ErrorImagenSolicitud si no hay imágenes y
+    LoteDemasiadoGrande si hay más de max_imagenes, antes de leer ninguna.
+
+    Cada archivo subido se lee a un buffer (y base64 se decodifica) recién
+    al consumir su elemento, y el buffer se suelta en cuanto se entrega, así
+    que la memoria no crece con el lote. Los archivos que no se llegan a
+    leer (cliente desconectado) se cierran al cerrar el generador.
+    """
+    try:
+        if (req.mimetype or '') == 'multipart/form-data':
+            entradas = _tomar_archivos_subidos(req)
+            leer = _leer_stream_subido
+        else:
+            data = req.get_json(silent=True)
+            entradas = data.get(CAMPO_LOTE) if isinstance(data, dict) else None
+            leer = _decodificar_base64
+    except RequestEntityTooLarge:
+        raise ImagenDemasiadoGrande(f"El lote supera el tamaño máximo de {req.max_content_length} bytes")
+
+    if not isinstance(entradas, list) or not entradas:
+        raise ErrorImagenSolicitud("No se proporcionaron imágenes")
+    if max_imagenes is not None and len(entradas) > max_imagenes:
+        raise LoteDemasiadoGrande(f"El lote tiene {len(entradas)} imágenes; el máximo es {max_imagenes}")
+
+    def generar():
+        try:
+            for i in range(len(entradas)):
+                entrada, entradas[i] = entradas[i], None
+                try:
+                    buffer = leer(entrada)
+                except ErrorImagenSolicitud as e:
+                    yield None, str(e)
+                    continue
+                yield (buffer, None) if buffer.size else (None, "Imagen vacía")
+        finally:
+            if leer is _leer_stream_subido:
+                for stream in entradas:
+                    if stream is not None:
+                        stream.close()
+
+    return generar()
+
+
+def decodificar_imagen(buffer):
+    """Decodificar un buffer JPEG/PNG a una imagen BGR de OpenCV"""
+    with medir(ETAPA_DECODIFICAR_IMAGEN):
+        imagen = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if imagen is None:
+        raise ErrorImagenSolicitud("No se pudo decodificar la imagen")
+    return imagen
+
+
+def imagen_desde_entrada(entrada):
+    """Obtener una imagen BGR desde bytes codificados o un ndarray ya decodificado
+
+    Acepta bytes/bytearray/memoryview o un buffer uint8 de una dimensión
+    (JPEG/PNG sin decodificar), una imagen BGR (alto, ancho, 3) o una
+    imagen en escala de grises (alto, ancho).
+    """
+    if isinstance(entrada, (bytes, bytearray, memoryview)):
+        entrada = np.frombuffer(entrada, dtype=np.uint8)
+
+    if not isinstance(entrada, np.ndarray):
+        raise ErrorImagenSolicitud(f"Tipo de imagen no soportado: {type(entrada).__name__}")
+
+    if entrada.ndim == 1:
+        return decodificar_imagen(entrada)
+    if entrada.ndim == 2:
+        return cv2.cvtColor(entrada, cv2.COLOR_GRAY2BGR)
+    if entrada.ndim == 3 and entrada.shape[2] == 3:
+        return entrada
+    if entrada.ndim == 3 and entrada.shape[2] == 4:
+        return cv2.cvtColor(entrada, cv2.COLOR_BGRA2BGR)
+
+    raise ErrorImagenSolicitud(f"Forma de imagen no soportada: {entrada.shape}")
@@ -7,24 +7,43 @@ import os
 import json
 import sys
 import base64
+import threading
+from imagen_solicitud import imagen_desde_entrada, ErrorImagenSolicitud
+from malla import detectar_landmarks, landmarks_a_pixeles, imagen_deteccion
+from clasificacion_forma import clasificar_forma
+from medidas import PUNTOS_REFERENCIA, calcular_medidas, indices_contorno
+from metricas import etapa, medir, ETAPA_MEDIDAS, ETAPA_CLASIFICACION, ETAPA_CODIFICAR_JPEG
 
 # Configurar la codificación para Windows
 if sys.platform == "win32":
     sys.stdout.reconfigure(encoding='utf-8')
 
 class AnalizadorFormaRostroPDF:
-    def __init__(self):
+    def __init__(self, crear_grafo=True):
         # Inicializar MediaPipe Face Mesh
         self.mp_face_mesh = mp.solutions.face_mesh
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
+        # Con crear_grafo=False el grafo se crea después con iniciar_grafo():
+        # un grafo de MediaPipe no sobrevive a fork() (modo prefork)
+        self.face_mesh = self.crear_face_mesh() if crear_grafo else None
+        # FaceMesh no admite llamadas concurrentes sobre el mismo grafo
+        self.lock_face_mesh = threading.Lock()
+        self.mp_drawing = mp.solutions.drawing_utils
+        self.mp_drawing_styles = mp.solutions.drawing_styles
+        print(">>> MediaPipe Face Mesh inicializado exitosamente")
+    
+    def crear_face_mesh(self):
+        """Construir el grafo de MediaPipe Face Mesh"""
+        return self.mp_face_mesh.FaceMesh(
             static_image_mode=True,
             max_num_faces=1,
             refine_landmarks=True,
             min_detection_confidence=0.5
         )
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.mp_drawing_styles = mp.solutions.drawing_styles
-        print(">>> MediaPipe Face Mesh inicializado exitosamente")
+
+    def iniciar_grafo(self):
+        """Crear el grafo diferido con crear_grafo=False (en cada hijo de prefork.py)"""
+        if self.face_mesh is None:
+            self.face_mesh = self.crear_face_mesh()
     
     def cargar_imagen(self, ruta_imagen):
         """Cargar y preparar imagen"""
@@ -40,141 +59,51 @@ class AnalizadorFormaRostroPDF:
             print("ERROR: No se pudo cargar la imagen con OpenCV")
             return None, None
         
+        return self.preparar_imagen(imagen)
+    
+    def preparar_imagen(self, imagen):
+        """Preparar una imagen BGR ya decodificada (vista espejo + RGB de detección)
+
+        La vista espejo conserva la resolución original; la RGB se reduce a
+        la resolución de detección (ver malla.py) y queda sin voltear: se
+        detecta igual que en pipeline.py y los puntos se reflejan después.
+        """
         print(f">>> Imagen cargada - Dimensiones: {imagen.shape}")
         
+        imagen_rgb = imagen_deteccion(imagen)
         # Voltear para vista natural (espejo)
         imagen = cv2.flip(imagen, 1)
-        imagen_rgb = cv2.cvtColor(imagen, cv2.COLOR_BGR2RGB)
         return imagen, imagen_rgb
     
-    def detectar_puntos_faciales(self, imagen_rgb):
-        """Detectar puntos faciales con MediaPipe"""
-        resultados = self.face_mesh.process(imagen_rgb)
-        
-        if not resultados.multi_face_landmarks:
+    def detectar_puntos_faciales(self, imagen_rgb, forma_original=None, espejo=False):
+        """Detectar puntos faciales con MediaPipe
+
+        Con `forma_original` (shape de la imagen sin reducir) los puntos
+        quedan en píxeles de la imagen original; con `espejo` se devuelven
+        en la vista espejo (ver landmarks_a_pixeles).
+        """
+        with self.lock_face_mesh:
+            landmarks = detectar_landmarks(self.face_mesh, imagen_rgb)
+        
+        if landmarks is None:
             return None
         
-        # Obtener el primer rostro detectado
-        landmarks = resultados.multi_face_landmarks[0]
-        
         # Convertir puntos a coordenadas de píxeles
-        h, w, _ = imagen_rgb.shape
-        puntos = []
-        
-        for landmark in landmarks.landmark:
-            x = int(landmark.x * w)
-            y = int(landmark.y * h)
-            puntos.append((x, y))
-        
-        return np.array(puntos)
+        h, w = (forma_original or imagen_rgb.shape)[:2]
+        return landmarks_a_pixeles(landmarks, w, h, espejo=espejo)
     
     def mapear_puntos_mediapipe(self, puntos, imagen_shape):
         """Mapear puntos de MediaPipe a nombres descriptivos"""
-        h, w = imagen_shape[:2]
-        
-        # Índices de MediaPipe Face Mesh
-        return {
-            'barbilla': tuple(puntos[152]),
-            'frente_centro': tuple(puntos[10]),
-            'frente_izquierda': tuple(puntos[109]),
-            'frente_derecha': tuple(puntos[338]),
-            'sien_izquierda': tuple(puntos[162]),
-            'sien_derecha': tuple(puntos[389]),
-            'mandibula_izquierda': tuple(puntos[172]),
-            'mandibula_derecha': tuple(puntos[397]),
-            'pomulo_izquierdo': tuple(puntos[116]),
-            'pomulo_derecho': tuple(puntos[345]),
-            'pomulo_izquierdo_ext': tuple(puntos[50]),
-            'pomulo_derecho_ext': tuple(puntos[280]),
-            'ojo_izquierdo_centro': tuple(puntos[468]),
-            'ojo_derecho_centro': tuple(puntos[473]),
-            'nariz_punta': tuple(puntos[1]),
-            'nariz_raiz': tuple(puntos[168]),  # PUNTO CLAVE: Raíz de la nariz (comienzo)
-            'ceja_izquierda_medio': tuple(puntos[107]),
-            'ceja_derecha_medio': tuple(puntos[336]),
-            'boca_izquierda_esquina': tuple(puntos[61]),
-            'boca_derecha_esquina': tuple(puntos[291]),
-            'labio_superior_medio': tuple(puntos[0]),
-            'labio_inferior_medio': tuple(puntos[17]),
-            # Puntos del iris (centro de las pupilas)
-            'iris_izquierdo': tuple(puntos[468]),  # Centro del iris izquierdo
-            'iris_derecho': tuple(puntos[473]),    # Centro del iris derecho
-        }
+        return {nombre: tuple(puntos[indice]) for nombre, indice in PUNTOS_REFERENCIA.items()}
     
     def calcular_contorno_rostro(self, puntos):
         """Calcular el contorno del rostro usando puntos clave"""
-        contorno_indices = [10, 338, 297, 332, 284, 251, 389, 356, 454, 323, 
-                          361, 288, 397, 365, 379, 378, 400, 377, 152, 148, 
-                          176, 149, 150, 136, 172, 58, 132, 93, 234, 127, 
-                          162, 21, 54, 103, 67, 109]
-        
-        valid_indices = [i for i in contorno_indices if i < len(puntos)]
-        contorno = [tuple(puntos[i]) for i in valid_indices]
-        return np.array(contorno)
+        return np.asarray(puntos)[indices_contorno(len(puntos))]
     
+    @etapa(ETAPA_MEDIDAS)
     def calcular_medidas_faciales(self, puntos_referencia, puntos_array):
-        """Calcular las medidas faciales clave"""
-        # A: Largo del rostro
-        A = distance.euclidean(puntos_referencia['frente_centro'], puntos_referencia['barbilla'])
-        
-        # B: Ancho de los pómulos
-        B = distance.euclidean(puntos_referencia['pomulo_izquierdo_ext'], puntos_referencia['pomulo_derecho_ext'])
-        
-        # C: Ancho de la frente
-        C = distance.euclidean(puntos_referencia['frente_izquierda'], puntos_referencia['frente_derecha'])
-        
-        # D: Ancho de la mandíbula
-        D = distance.euclidean(puntos_referencia['mandibula_izquierda'], puntos_referencia['mandibula_derecha'])
-        
-        # E: Ancho entre sienes
-        E = distance.euclidean(puntos_referencia['sien_izquierda'], puntos_referencia['sien_derecha'])
-        
-        # F: Distancia entre ojos
-        F = distance.euclidean(puntos_referencia['ojo_izquierdo_centro'], puntos_referencia['ojo_derecho_centro'])
-        
-        # AGREGAR DISTANCIAS NASOPUPILARES (DNP) - CORREGIDAS
-        # Distancia de la raíz de la nariz al iris izquierdo (DNP_I)
-        DNP_I = distance.euclidean(puntos_referencia['nariz_raiz'], puntos_referencia['iris_izquierdo'])
-        
-        # Distancia de la raíz de la nariz al iris derecho (DNP_D)
-        DNP_D = distance.euclidean(puntos_referencia['nariz_raiz'], puntos_referencia['iris_derecho'])
-        
-        # Distancia interpupilar (DIP) - suma de DNP_I + DNP_D
-        DIP = DNP_I + DNP_D
-        
-        # Verificación: DNP_I + DNP_D debe ser aproximadamente igual a DIP
-        diferencia_DIP = abs(DIP - F)
-        
-        # Calcular proporciones clave
-        R_AA = A / B if B != 0 else 0
-        R_BC = B / C if C != 0 else 0
-        R_BD = B / D if D != 0 else 0
-        R_CD = C / D if D != 0 else 0
-        R_AE = A / E if E != 0 else 0
-        
-        # Calcular ángulos de la mandíbula
-        angulo_izq, angulo_der = self.calcular_angulo_mandibula_mejorado(puntos_referencia)
-        angulo_mandibula_promedio = (angulo_izq + angulo_der) / 2
-        
-        # Calcular curvatura del contorno
-        curvatura = self.calcular_curvatura_contorno(puntos_array)
-        
-        # Convertir a tipos nativos de Python para JSON
-        return {
-            # Medidas lineales básicas
-            'A': float(A), 'B': float(B), 'C': float(C), 'D': float(D), 'E': float(E), 'F': float(F),
-            
-            # MEDIDAS PUPILARES PARA GAFAS - AGREGADAS
-            'DNP_I': float(DNP_I),      # Distancia NasoPupilar Izquierda
-            'DNP_D': float(DNP_D),      # Distancia NasoPupilar Derecha  
-            'DIP': float(DIP),          # Distancia InterPupilar (suma)
-            'diferencia_DIP': float(diferencia_DIP),  # Diferencia entre métodos
-            
-            # Proporciones faciales
-            'R_AA': float(R_AA), 'R_BC': float(R_BC), 'R_BD': float(R_BD), 'R_CD': float(R_CD), 'R_AE': float(R_AE),
-            'angulo_mandibula': float(angulo_mandibula_promedio),
-            'curvatura': float(curvatura)
-        }
+        """Calcular las medidas faciales clave (distancias, proporciones, ángulo y curvatura)"""
+        return calcular_medidas(puntos_array)
         
     def analizar_distancias_pupilares(self, puntos_referencia):
         """Análisis específico de distancias pupilares para gafas"""
@@ -204,108 +133,10 @@ class AnalizadorFormaRostroPDF:
             'notas': 'DNP_I + DNP_D = DIP. Valores en píxeles. Para mm, aplicar factor de conversión.'
         }
     
-    def calcular_angulo_mandibula_mejorado(self, puntos):
-        """Calcular ángulo de la mandíbula con mayor precisión"""
-        def calcular_angulo(a, b, c):
-            """Calcular ángulo entre tres puntos"""
-            ba = np.array(a) - np.array(b)
-            bc = np.array(c) - np.array(b)
-            
-            cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc))
-            angle = np.arccos(np.clip(cosine_angle, -1.0, 1.0))
-            return float(np.degrees(angle))  # <-- CONVERTIR A float
-        
-        # Ángulo izquierdo
-        angulo_izq = calcular_angulo(
-            puntos['pomulo_izquierdo'], 
-            puntos['mandibula_izquierda'], 
-            puntos['barbilla']
-        )
-        
-        # Ángulo derecho
-        angulo_der = calcular_angulo(
-            puntos['pomulo_derecho'], 
-            puntos['mandibula_derecha'], 
-            puntos['barbilla']
-        )
-        
-        return angulo_izq, angulo_der
-    
-    def calcular_curvatura_contorno(self, puntos_array):
-        """Calcular la curvatura del contorno facial"""
-        contorno = self.calcular_contorno_rostro(puntos_array)
-        
-        if len(contorno) < 3:
-            return 0.0
-        
-        centro = np.mean(contorno, axis=0)
-        distancias = [distance.euclidean(p, centro) for p in contorno]
-        curvatura = np.std(distancias) if distancias else 0.0
-        
-        return float(curvatura)
-    
+    @etapa(ETAPA_CLASIFICACION)
     def determinar_forma_rostro_avanzada(self, medidas, caracteristicas_contorno):
-        """Determinar forma del rostro con algoritmo avanzado"""
-        R_AA = medidas['R_AA']
-        R_BC = medidas['R_BC']
-        R_BD = medidas['R_BD']
-        R_CD = medidas['R_CD']
-        angulo = medidas['angulo_mandibula']
-        curvatura = medidas['curvatura']
-        
-        # CUADRADO - PARÁMETROS BASADOS EN TUS IMÁGENES CORRECTAS
-        if ((1.60 <= R_AA <= 1.80) and
-            (2.5 <= R_BC <= 2.7) and
-            (0.85 <= R_BD <= 0.90) and
-            (122 <= angulo <= 128) and
-            (6.0 <= curvatura <= 20.0)):
-            return "Cuadrado", "Rostro con estructura angular y mandibula definida"
-        
-        # DIAMANTE
-        if ((1.55 <= R_AA <= 1.75) and
-            (2.3 <= R_BC <= 2.5) and
-            (0.88 <= R_BD <= 0.93) and
-            (135 <= angulo <= 140) and
-            (4.0 <= curvatura <= 15.0)):
-            return "Diamante", "Rostro con pomulos anchos y estructura angular"
-        
-        # OVALADO
-        if ((1.5 <= R_AA <= 1.8) and
-            (2.0 <= R_BC <= 2.6) and
-            (0.90 <= R_BD <= 1.05) and
-            (128 <= angulo <= 135) and
-            (curvatura <= 12.0)):
-            return "Ovalado", "Rostro con proporciones equilibradas y contornos suaves"
-        
-        # OBLONGO
-        if R_AA >= 1.80:
-            if not (0.88 <= R_BD <= 0.93 and 135 <= angulo <= 140):
-                if R_AA >= 1.85 and R_BD <= 0.85:
-                    return "Oblongo", "Rostro muy alargado"
-                elif (2.3 <= R_BC <= 2.8 and 0.80 <= R_BD <= 0.85 and 125 <= angulo <= 140):
-                    return "Oblongo", "Rostro alargado con estructura definida"
-        
-        # REDONDO
-        if ((1.5 <= R_AA <= 1.7) and 
-            (2.4 <= R_BC <= 2.8) and 
-            (0.85 <= R_BD <= 0.92) and 
-            (122 <= angulo <= 128) and 
-            (curvatura >= 3.8)):
-            return "Redondo", "Rostro con contornos curvos y proporciones balanceadas"
-        
-        # Clasificación por defecto
-        if (0.85 <= R_BD <= 0.90) and (122 <= angulo <= 128):
-            return "Cuadrado", "Rostro cuadrado (estructura angular)"
-        elif (0.88 <= R_BD <= 0.93) and (135 <= angulo <= 140):
-            return "Diamante", "Rostro diamante (pomulos prominentes)"
-        elif (0.90 <= R_BD <= 1.05) and (128 <= angulo <= 135):
-            return "Ovalado", "Rostro ovalado (proporciones balanceadas)"
-        elif R_AA >= 1.80 and R_BD <= 0.85:
-            return "Oblongo", "Rostro oblongo"
-        elif R_AA < 1.2:
-            return "Redondo", "Rostro redondeado"
-        else:
-            return "Ovalado", "Rostro con proporciones equilibradas"
+        """Determinar forma del rostro con algoritmo avanzado (reglas de clasificacion_forma.py)"""
+        return clasificar_forma(medidas)
 
     def obtener_rectangulo_rostro(self, puntos_referencia):
         """Obtener rectángulo del rostro basado en puntos clave"""
@@ -577,13 +408,30 @@ class AnalizadorFormaRostroPDF:
     
     def analizar_rostro(self, ruta_imagen):
         """Analizar forma del rostro completa"""
-        resultado = self.cargar_imagen(ruta_imagen)
-        if resultado is None:
+        imagen, imagen_rgb = self.cargar_imagen(ruta_imagen)
+        if imagen is None:
             print("ERROR: No se pudo cargar la imagen")
             return None
         
-        imagen, imagen_rgb = resultado
-        puntos_array = self.detectar_puntos_faciales(imagen_rgb)
+        return self.analizar_imagen_espejo(imagen, imagen_rgb)
+    
+    def analizar_rostro_imagen(self, imagen):
+        """Analizar forma del rostro desde memoria, sin archivos temporales
+
+        `imagen` puede ser bytes codificados (JPEG/PNG) o un ndarray BGR sin voltear.
+        """
+        try:
+            imagen = imagen_desde_entrada(imagen)
+        except ErrorImagenSolicitud as e:
+            print(f"ERROR: No se pudo cargar la imagen: {e}")
+            return None
+        
+        imagen, imagen_rgb = self.preparar_imagen(imagen)
+        return self.analizar_imagen_espejo(imagen, imagen_rgb)
+    
+    def analizar_imagen_espejo(self, imagen, imagen_rgb):
+        """Detectar puntos y analizar una imagen ya preparada por preparar_imagen"""
+        puntos_array = self.detectar_puntos_faciales(imagen_rgb, imagen.shape, espejo=True)
         
         if puntos_array is None:
             print("ERROR: No se detectaron rostros con MediaPipe")
@@ -618,7 +466,8 @@ class AnalizadorFormaRostroPDF:
         
         # Convertir imagen a base64 para JSON
         try:
-            _, buffer = cv2.imencode('.jpg', imagen)
+            with medir(ETAPA_CODIFICAR_JPEG):
+                _, buffer = cv2.imencode('.jpg', imagen)
             imagen_base64 = base64.b64encode(buffer).decode('utf-8')
         except Exception as e:
             print(f"Error convirtiendo imagen a base64: {e}")
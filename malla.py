@@ -0,0 +1,157 @@
+"""
+Utilidades compartidas sobre la malla de 478 puntos de MediaPipe Face Mesh.
+
+Permiten detectar los landmarks una sola vez y derivar de ellos tanto las
+coordenadas de la imagen original (tonos.py) como las de la vista espejo
+que usa main.py, transformando coordenadas en lugar de voltear píxeles.
+
+Face Mesh trabaja internamente con entradas pequeñas (128 px el detector,
+192-256 px el recorte del rostro), así que la detección corre sobre una
+copia reducida a OPTISCAN_RESOLUCION_DETECCION. Los landmarks son
+coordenadas normalizadas: convertidos con el tamaño de la imagen original
+quedan en sus píxeles y las medidas no dependen de la reducción.
+"""
+import math
+import os
+
+import cv2
+import numpy as np
+
+from metricas import medir, ETAPA_FACE_MESH, ETAPA_REDUCIR_IMAGEN
+
+# Lado mayor máximo de la imagen de trabajo (detección y tono); 0 = sin reducir
+RESOLUCION_DETECCION = int(os.environ.get('OPTISCAN_RESOLUCION_DETECCION', '1280'))
+
+# Índice simétrico de cada landmark respecto al eje vertical del rostro:
+# INDICES_ESPEJO[i] es el punto que ocupa el lugar de i en la imagen volteada
+# (p. ej. 468 <-> 473 para el centro de los iris). Los puntos de la línea
+# media (10, 152, 168, ...) son su propio espejo.
+INDICES_ESPEJO = np.array([
+    0, 1, 2, 248, 4, 5, 6, 249, 8, 9, 10, 11,
+    12, 13, 14, 15, 16, 17, 18, 19, 250, 251, 252, 253,
+    254, 255, 256, 257, 258, 259, 260, 261, 262, 263, 264, 265,
+    266, 267, 268, 269, 270, 271, 272, 273, 274, 275, 276, 277,
+    278, 279, 280, 281, 282, 283, 284, 285, 286, 287, 288, 289,
+    290, 291, 292, 293, 294, 295, 296, 297, 298, 299, 300, 301,
+    302, 303, 304, 305, 306, 307, 308, 309, 310, 311, 312, 313,
+    314, 315, 316, 317, 318, 319, 320, 321, 322, 323, 94, 324,
+    325, 326, 327, 328, 329, 330, 331, 332, 333, 334, 335, 336,
+    337, 338, 339, 340, 341, 342, 343, 344, 345, 346, 347, 348,
+    349, 350, 351, 352, 353, 354, 355, 356, 357, 358, 359, 360,
+    361, 362, 363, 364, 365, 366, 367, 368, 369, 370, 371, 372,
+    373, 374, 375, 376, 377, 378, 379, 151, 152, 380, 381, 382,
+    383, 384, 385, 386, 387, 388, 389, 390, 164, 391, 392, 393,
+    168, 394, 395, 396, 397, 398, 399, 175, 400, 401, 402, 403,
+    404, 405, 406, 407, 408, 409, 410, 411, 412, 413, 414, 415,
+    416, 417, 418, 195, 419, 197, 420, 199, 200, 421, 422, 423,
+    424, 425, 426, 427, 428, 429, 430, 431, 432, 433, 434, 435,
+    436, 437, 438, 439, 440, 441, 442, 443, 444, 445, 446, 447,
+    448, 449, 450, 451, 452, 453, 454, 455, 456, 457, 458, 459,
+    460, 461, 462, 463, 464, 465, 466, 467, 3, 7, 20, 21,
+    22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33,
+    34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45,
+    46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57,
+    58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69,
+    70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81,
+    82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93,
+    95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106,
+    107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117, 118,
+    119, 120, 121, 122, 123, 124, 125, 126, 127, 128, 129, 130,
+    131, 132, 133, 134, 135, 136, 137, 138, 139, 140, 141, 142,
+    143, 144, 145, 146, 147, 148, 149, 150, 153, 154, 155, 156,
+    157, 158, 159, 160, 161, 162, 163, 165, 166, 167, 169, 170,
+    171, 172, 173, 174, 176, 177, 178, 179, 180, 181, 182, 183,
+    184, 185, 186, 187, 188, 189, 190, 191, 192, 193, 194, 196,
+    198, 201, 202, 203, 204, 205, 206, 207, 208, 209, 210, 211,
+    212, 213, 214, 215, 216, 217, 218, 219, 220, 221, 222, 223,
+    224, 225, 226, 227, 228, 229, 230, 231, 232, 233, 234, 235,
+    236, 237, 238, 239, 240, 241, 242, 243, 244, 245, 246, 247,
+    473, 476, 475, 474, 477, 468, 471, 470, 469, 472,
+], dtype=np.intp)
+
+
+# Un NormalizedLandmark serializado con x, y, z (protobuf, little endian):
+# 0x0a <long. 15> 0x0d <x float32> 0x15 <y float32> 0x1d <z float32>
+REGISTRO_LANDMARK = np.dtype({
+    'names': ['x', 'y', 'z'],
+    'formats': ['<f4', '<f4', '<f4'],
+    'offsets': [3, 8, 13],
+    'itemsize': 17
+})
+POSICIONES_CABECERA = np.array([0, 1, 2, 7, 12], dtype=np.intp)
+CABECERA_LANDMARK = np.array([0x0a, 0x0f, 0x0d, 0x15, 0x1d], dtype=np.uint8)
+
+
+def reducir_imagen(imagen, lado_max=None):
+    """Copia reducida con el lado mayor <= lado_max; la misma imagen si ya cabe
+
+    Se reduce por un factor entero: INTER_AREA con escala 1/k es un promedio
+    de bloques k x k, varias veces más rápido que con una escala arbitraria.
+    """
+    lado_max = RESOLUCION_DETECCION if lado_max is None else lado_max
+    lado = max(imagen.shape[:2])
+    if lado_max <= 0 or lado <= lado_max:
+        return imagen
+
+    factor = math.ceil(lado / lado_max)
+    with medir(ETAPA_REDUCIR_IMAGEN):
+        return cv2.resize(imagen, None, fx=1 / factor, fy=1 / factor, interpolation=cv2.INTER_AREA)
+
+
+def imagen_deteccion(imagen_bgr, lado_max=None):
+    """Imagen RGB de trabajo: reducida primero, así la conversión de color también es barata"""
+    return cv2.cvtColor(reducir_imagen(imagen_bgr, lado_max), cv2.COLOR_BGR2RGB)
+
+
+def landmarks_a_array(lista_landmarks):
+    """(N, 3) float32 contiguo con x, y, z de un NormalizedLandmarkList
+
+    En lugar de recorrer los 478 objetos landmark desde Python, se lee el
+    mensaje serializado: cada landmark con solo x, y, z ocupa un registro
+    fijo de 17 bytes (REGISTRO_LANDMARK). Si el mensaje trae otra cosa
+    (visibility, presence) se usa el recorrido de siempre.
+    """
+    datos = lista_landmarks.SerializeToString()
+    if datos and len(datos) % REGISTRO_LANDMARK.itemsize == 0:
+        bytes_registro = np.frombuffer(datos, np.uint8).reshape(-1, REGISTRO_LANDMARK.itemsize)
+        if (bytes_registro[:, POSICIONES_CABECERA] == CABECERA_LANDMARK).all():
+            registros = np.frombuffer(datos, REGISTRO_LANDMARK)
+            return np.stack((registros['x'], registros['y'], registros['z']), axis=1).astype(np.float32)
+    return np.array([(l.x, l.y, l.z) for l in lista_landmarks.landmark], dtype=np.float32).reshape(-1, 3)
+
+
+def detectar_landmarks(face_mesh, imagen_rgb):
+    """Ejecutar Face Mesh y devolver los landmarks normalizados (N, 3) float32, o None"""
+    with medir(ETAPA_FACE_MESH):
+        resultados = face_mesh.process(imagen_rgb)
+
+    if not resultados.multi_face_landmarks:
+        return None
+
+    # Primer rostro detectado
+    return landmarks_a_array(resultados.multi_face_landmarks[0])
+
+
+def landmarks_a_pixeles(landmarks, ancho, alto, espejo=False, enteros=True):
+    """Convertir landmarks normalizados (N, 2) o (N, 3) a coordenadas (N, 2) de píxeles
+
+    Con espejo=True devuelve los puntos tal como los detectaría MediaPipe
+    sobre la imagen volteada horizontalmente (cv2.flip(imagen, 1)): se
+    refleja la coordenada x y se intercambian los índices izquierda/derecha.
+
+    Con enteros=True (lo que usan las medidas, el dibujo y las máscaras) se
+    trunca igual que int(landmark.x * w); con enteros=False quedan en float.
+    """
+    # El producto en float64 (exacto para valores float32) trunca igual que
+    # Python con los floats del landmark
+    xs = landmarks[:, 0].astype(np.float64)
+    ys = landmarks[:, 1].astype(np.float64)
+
+    if espejo:
+        indices = INDICES_ESPEJO[:len(landmarks)]
+        xs = 1.0 - xs[indices]
+        ys = ys[indices]
+
+    if not enteros:
+        return np.column_stack((xs * ancho, ys * alto))
+    return np.column_stack(((xs * ancho).astype(int), (ys * alto).astype(int)))
@@ -0,0 +1,147 @@
+"""
+Medidas faciales sobre los landmarks de MediaPipe en píxeles.
+
+Las medidas se definen como tablas de índices de la malla: pares para las
+distancias (A-F, DNP), cocientes entre medidas, tríos para los ángulos de
+la mandíbula y la lista de puntos del contorno para la curvatura. Todas se
+calculan a la vez con unas pocas operaciones de NumPy sobre el array de
+puntos (478, 2), o sobre una pila (..., 478, 2) de varios rostros.
+
+El resultado es el mismo, bit a bit, que el cálculo punto a punto con
+scipy.spatial.distance.euclidean. Sobre píxeles enteros euclidean pasa por
+el dot de BLAS, que matmul reproduce (u0*v0 + u1*v1 no siempre); sobre las
+distancias al centro del contorno, que es fraccionario, pasa por el nrm2 de
+BLAS, que acumula en precisión extendida (np.longdouble).
+"""
+import numpy as np
+
+# Puntos de referencia con nombre (índices de MediaPipe Face Mesh)
+PUNTOS_REFERENCIA = {
+    'barbilla': 152,
+    'frente_centro': 10,
+    'frente_izquierda': 109,
+    'frente_derecha': 338,
+    'sien_izquierda': 162,
+    'sien_derecha': 389,
+    'mandibula_izquierda': 172,
+    'mandibula_derecha': 397,
+    'pomulo_izquierdo': 116,
+    'pomulo_derecho': 345,
+    'pomulo_izquierdo_ext': 50,
+    'pomulo_derecho_ext': 280,
+    'ojo_izquierdo_centro': 468,
+    'ojo_derecho_centro': 473,
+    'nariz_punta': 1,
+    'nariz_raiz': 168,  # PUNTO CLAVE: Raíz de la nariz (comienzo)
+    'ceja_izquierda_medio': 107,
+    'ceja_derecha_medio': 336,
+    'boca_izquierda_esquina': 61,
+    'boca_derecha_esquina': 291,
+    'labio_superior_medio': 0,
+    'labio_inferior_medio': 17,
+    # Puntos del iris (centro de las pupilas)
+    'iris_izquierdo': 468,
+    'iris_derecho': 473,
+}
+
+# Distancias: (medida, punto, punto)
+DISTANCIAS = (
+    ('A', 'frente_centro', 'barbilla'),                # Largo del rostro
+    ('B', 'pomulo_izquierdo_ext', 'pomulo_derecho_ext'),  # Ancho de los pómulos
+    ('C', 'frente_izquierda', 'frente_derecha'),       # Ancho de la frente
+    ('D', 'mandibula_izquierda', 'mandibula_derecha'),  # Ancho de la mandíbula
+    ('E', 'sien_izquierda', 'sien_derecha'),           # Ancho entre sienes
+    ('F', 'ojo_izquierdo_centro', 'ojo_derecho_centro'),  # Distancia entre ojos
+    ('DNP_I', 'nariz_raiz', 'iris_izquierdo'),         # Distancia nasopupilar izquierda
+    ('DNP_D', 'nariz_raiz', 'iris_derecho'),           # Distancia nasopupilar derecha
+)
+NOMBRES_DISTANCIAS = tuple(nombre for nombre, _, _ in DISTANCIAS)
+PARES_DISTANCIAS = np.array([(PUNTOS_REFERENCIA[a], PUNTOS_REFERENCIA[b]) for _, a, b in DISTANCIAS],
+                            dtype=np.intp)
+
+# Proporciones: (medida, numerador, denominador); 0 si el denominador es 0
+PROPORCIONES = (
+    ('R_AA', 'A', 'B'),
+    ('R_BC', 'B', 'C'),
+    ('R_BD', 'B', 'D'),
+    ('R_CD', 'C', 'D'),
+    ('R_AE', 'A', 'E'),
+)
+
+# Ángulos de la mandíbula: (pómulo, vértice en la mandíbula, barbilla), izquierdo y derecho
+TRIOS_ANGULO_MANDIBULA = np.array([
+    (PUNTOS_REFERENCIA['pomulo_izquierdo'], PUNTOS_REFERENCIA['mandibula_izquierda'], PUNTOS_REFERENCIA['barbilla']),
+    (PUNTOS_REFERENCIA['pomulo_derecho'], PUNTOS_REFERENCIA['mandibula_derecha'], PUNTOS_REFERENCIA['barbilla']),
+], dtype=np.intp)
+
+# Contorno del rostro (curvatura y figura del PDF)
+CONTORNO_ROSTRO = np.array([10, 338, 297, 332, 284, 251, 389, 356, 454, 323,
+                            361, 288, 397, 365, 379, 378, 400, 377, 152, 148,
+                            176, 149, 150, 136, 172, 58, 132, 93, 234, 127,
+                            162, 21, 54, 103, 67, 109], dtype=np.intp)
+
+# Claves y orden de las medidas en los resultados
+CLAVES_MEDIDAS = ('A', 'B', 'C', 'D', 'E', 'F', 'DNP_I', 'DNP_D', 'DIP', 'diferencia_DIP',
+                  'R_AA', 'R_BC', 'R_BD', 'R_CD', 'R_AE', 'angulo_mandibula', 'curvatura')
+
+
+def producto_escalar(u, v):
+    """u . v sobre el último eje de dos pilas (..., 2), redondeado como el dot de BLAS"""
+    return (u[..., None, :] @ v[..., :, None])[..., 0, 0]
+
+
+def indices_contorno(num_puntos):
+    """Índices del contorno presentes en una malla de num_puntos puntos"""
+    return CONTORNO_ROSTRO[CONTORNO_ROSTRO < num_puntos]
+
+
+def tomar_puntos(puntos, indices):
+    """Puntos de los índices dados en float64, sin convertir la malla entera"""
+    return puntos[..., indices, :].astype(np.float64)
+
+
+def columnas_medidas(puntos):
+    """Medidas de una pila de mallas (..., N, 2) en píxeles: {medida: array (...)}"""
+    puntos = np.asarray(puntos)
+    columnas = {}
+
+    # Distancias lineales y pupilares
+    diferencias = tomar_puntos(puntos, PARES_DISTANCIAS[:, 0]) - tomar_puntos(puntos, PARES_DISTANCIAS[:, 1])
+    distancias = np.sqrt(producto_escalar(diferencias, diferencias))
+    for k, nombre in enumerate(NOMBRES_DISTANCIAS):
+        columnas[nombre] = distancias[..., k]
+
+    # Distancia interpupilar (DIP) como suma de DNP_I + DNP_D, y su diferencia con F
+    columnas['DIP'] = columnas['DNP_I'] + columnas['DNP_D']
+    columnas['diferencia_DIP'] = np.abs(columnas['DIP'] - columnas['F'])
+
+    for nombre, numerador, denominador in PROPORCIONES:
+        den = columnas[denominador]
+        columnas[nombre] = np.divide(columnas[numerador], den, out=np.zeros_like(den), where=den != 0)
+
+    # Ángulo en el vértice de cada trío, promedio de ambos lados
+    vertices = tomar_puntos(puntos, TRIOS_ANGULO_MANDIBULA[:, 1])
+    ba = tomar_puntos(puntos, TRIOS_ANGULO_MANDIBULA[:, 0]) - vertices
+    bc = tomar_puntos(puntos, TRIOS_ANGULO_MANDIBULA[:, 2]) - vertices
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coseno = producto_escalar(ba, bc) / (np.sqrt(producto_escalar(ba, ba)) * np.sqrt(producto_escalar(bc, bc)))
+    angulos = np.degrees(np.arccos(np.clip(coseno, -1.0, 1.0)))
+    columnas['angulo_mandibula'] = (angulos[..., 0] + angulos[..., 1]) / 2
+
+    # Curvatura: desviación estándar de la distancia de cada punto del contorno a su centro
+    indices = indices_contorno(puntos.shape[-2])
+    if len(indices) < 3:
+        columnas['curvatura'] = np.zeros(puntos.shape[:-2])
+    else:
+        contorno = tomar_puntos(puntos, indices)
+        # Filas contiguas: np.std suma cada rostro en el mismo orden que con uno solo
+        desde_centro = (contorno - np.mean(contorno, axis=-2, keepdims=True)).astype(np.longdouble)
+        distancias_centro = np.sqrt(np.sum(desde_centro * desde_centro, axis=-1)).astype(np.float64, order='C')
+        columnas['curvatura'] = np.std(distancias_centro, axis=-1)
+
+    return {clave: columnas[clave] for clave in CLAVES_MEDIDAS}
+
+
+def calcular_medidas(puntos):
+    """Medidas de una malla (N, 2) en píxeles como diccionario de floats de Python"""
+    return {clave: float(valor) for clave, valor in columnas_medidas(puntos).items()}
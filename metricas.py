@@ -0,0 +1,487 @@
+"""
+Métricas de latencia por etapa y de solicitudes en formato de texto Prometheus.
+
+Las etapas del pipeline (decodificación, Face Mesh, KMeans, cuadrado de
+referencia, codificación JPEG, ...) se miden en los propios métodos de los
+analizadores con `medir(etapa)` o el decorador `etapa(nombre)`, así que los
+histogramas se llenan igual cuando los analizadores se usan como librería.
+Los servidores Flask añaden contadores por endpoint y resultado, latencia
+por endpoint y solicitudes en vuelo (instrumentar_app), y exponen todo en
+/metrics (respuesta_metricas). Con el decorador con_tiempos cada respuesta
+lleva además el desglose de su propia solicitud en la cabecera
+Server-Timing y, si se pide con ?timings=1, en un objeto "timings" del JSON.
+
+El registro es por proceso. Los trabajadores del modo "pool" recogen sus
+etapas con recolectar_etapas() y las devuelven en la respuesta para que el
+servidor las registre.
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from plazos import verificar_plazo
+
+TIPO_CONTENIDO = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Límites superiores (segundos) de los buckets de los histogramas
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etapas instrumentadas (valor de la etiqueta "etapa")
+ETAPA_DECODIFICAR_BASE64 = 'decodificar_base64'
+ETAPA_DECODIFICAR_IMAGEN = 'decodificar_imagen'
+ETAPA_REDUCIR_IMAGEN = 'reducir_imagen'
+ETAPA_ARCHIVO_TEMPORAL = 'archivo_temporal'
+ETAPA_SUBPROCESO = 'script_subproceso'
+ETAPA_ARRANQUE_TRABAJADOR = 'arranque_trabajador'
+ETAPA_ESPERA_ADMISION = 'espera_admision'
+ETAPA_FACE_MESH = 'face_mesh'
+ETAPA_MEDIDAS = 'medidas'
+ETAPA_CLASIFICACION = 'clasificacion'
+ETAPA_KMEANS = 'kmeans_tono'
+ETAPA_CUADRADO_VERDE = 'cuadrado_verde'
+ETAPA_CODIFICAR_JPEG = 'codificar_jpeg'
+ETAPA_GENERAR_PDF = 'generar_pdf'
+
+# Lista de (etapa, segundos) de la operación en curso, si alguien la recoge
+_etapas_actuales = contextvars.ContextVar('optiscan_etapas', default=None)
+# False mientras se ejecuta trabajo que no debe contar (calentamiento)
+_registrar_etapas = contextvars.ContextVar('optiscan_registrar_etapas', default=True)
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _formatear_etiquetas(nombres, valores, extra=None):
+    pares = list(zip(nombres, valores))
+    if extra:
+        pares.append(extra)
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{n}="{_escapar(v)}"' for n, v in pares) + '}'
+
+
+def _formatear_numero(valor):
+    if valor == float('inf'):
+        return '+Inf'
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+class Metrica:
+    """Base de las métricas: nombre, ayuda y series por combinación de etiquetas"""
+
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, valores):
+        if len(valores) != len(self.etiquetas):
+            raise ValueError(f"{self.nombre} espera las etiquetas {self.etiquetas}")
+        return tuple(str(v) for v in valores)
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for valores, serie in series:
+            lineas.extend(self._exportar_serie(valores, serie))
+        return lineas
+
+
+class Contador(Metrica):
+    tipo = 'counter'
+
+    def incrementar(self, *valores, cantidad=1):
+        clave = self._clave(valores)
+        with self._lock:
+            self._series[clave] = self._series.get(clave, 0) + cantidad
+
+    def _exportar_serie(self, valores, serie):
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, valores)} {_formatear_numero(serie)}"]
+
+
+class Medidor(Metrica):
+    """Gauge: valor que sube y baja (p. ej. solicitudes en vuelo)"""
+
+    tipo = 'gauge'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        # Medidor sin etiquetas leído en el momento de exportar
+        self.funcion = funcion
+
+    def sumar(self, *valores, cantidad=1):
+        clave = self._clave(valores)
+        with self._lock:
+            self._series[clave] = self._series.get(clave, 0) + cantidad
+
+    def restar(self, *valores, cantidad=1):
+        self.sumar(*valores, cantidad=-cantidad)
+
+    def establecer(self, *valores, valor):
+        clave = self._clave(valores)
+        with self._lock:
+            self._series[clave] = valor
+
+    def exportar(self):
+        if self.funcion is not None:
+            try:
+                self.establecer(valor=float(self.funcion()))
+            except Exception:
+                pass
+        return super().exportar()
+
+    def _exportar_serie(self, valores, serie):
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, valores)} {_formatear_numero(serie)}"]
+
+
+class Histograma(Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, *valores, valor):
+        clave = self._clave(valores)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                # [conteos por bucket (no acumulados)..., +Inf, suma]
+                serie = self._series[clave] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+                    break
+            else:
+                serie[len(self.buckets)] += 1
+            serie[-1] += valor
+
+    def _exportar_serie(self, valores, serie):
+        lineas = []
+        acumulado = 0
+        for limite, conteo in zip(self.buckets + (float('inf'),), serie[:-1]):
+            acumulado += conteo
+            etiquetas = _formatear_etiquetas(self.etiquetas, valores, ('le', _formatear_numero(limite)))
+            lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+        etiquetas = _formatear_etiquetas(self.etiquetas, valores)
+        lineas.append(f"{self.nombre}_sum{etiquetas} {_formatear_numero(serie[-1])}")
+        lineas.append(f"{self.nombre}_count{etiquetas} {acumulado}")
+        return lineas
+
+
+class RegistroMetricas:
+    """Conjunto de métricas de un proceso"""
+
+    def __init__(self):
+        self._metricas = {}
+        self._lock = threading.Lock()
+
+    def _registrar(self, clase, nombre, *args, **kwargs):
+        with self._lock:
+            metrica = self._metricas.get(nombre)
+            if metrica is None:
+                metrica = self._metricas[nombre] = clase(nombre, *args, **kwargs)
+            elif not isinstance(metrica, clase):
+                raise ValueError(f"La métrica {nombre} ya existe con otro tipo")
+            return metrica
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador, nombre, ayuda, etiquetas)
+
+    def medidor(self, nombre, ayuda, etiquetas=(), funcion=None):
+        return self._registrar(Medidor, nombre, ayuda, etiquetas, funcion=funcion)
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        return self._registrar(Histograma, nombre, ayuda, etiquetas, buckets=buckets)
+
+    def exportar(self):
+        """Texto de exposición de Prometheus con todas las métricas"""
+        with self._lock:
+            metricas = list(self._metricas.values())
+        lineas = []
+        for metrica in metricas:
+            lineas.extend(metrica.exportar())
+        return '\n'.join(lineas) + '\n'
+
+
+registro = RegistroMetricas()
+
+duracion_etapas = registro.histograma(
+    'optiscan_etapa_duracion_segundos',
+    'Duración de cada etapa del pipeline de análisis',
+    ('etapa',)
+)
+
+
+def observar(nombre_etapa, segundos):
+    """Registrar la duración de una etapa (y anotarla si se están recogiendo)"""
+    if not _registrar_etapas.get():
+        return
+    duracion_etapas.observar(nombre_etapa, valor=segundos)
+    etapas = _etapas_actuales.get()
+    if etapas is not None:
+        etapas.append((nombre_etapa, segundos))
+
+
+@contextmanager
+def medir(nombre_etapa):
+    """Medir el bloque como una etapa del pipeline
+
+    Es también el punto de control del plazo de la solicitud (plazos.py):
+    si venció o el cliente se fue, la etapa no empieza.
+    """
+    verificar_plazo(nombre_etapa)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(nombre_etapa, time.perf_counter() - inicio)
+
+
+def etapa(nombre_etapa):
+    """Decorador: medir cada llamada a la función como una etapa"""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir(nombre_etapa):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+@contextmanager
+def recolectar_etapas():
+    """Recoger en una lista las etapas (nombre, segundos) medidas dentro del bloque
+
+    Los hilos lanzados con copiar_contexto() anotan en la misma lista.
+    """
+    etapas = []
+    token = _etapas_actuales.set(etapas)
+    try:
+        yield etapas
+    finally:
+        _etapas_actuales.reset(token)
+
+
+@contextmanager
+def sin_metricas():
+    """No registrar las etapas medidas dentro del bloque (p. ej. el calentamiento)"""
+    token = _registrar_etapas.set(False)
+    try:
+        yield
+    finally:
+        _registrar_etapas.reset(token)
+
+
+def copiar_contexto(funcion):
+    """Envolver una función para ejecutarla en otro hilo con el contexto actual"""
+    contexto = contextvars.copy_context()
+    return functools.partial(contexto.run, funcion)
+
+
+def resumir_etapas(etapas, total=None):
+    """Milisegundos por etapa (sumando llamadas repetidas), en orden de aparición
+
+    Las etapas que corren en paralelo se solapan: su suma puede superar el total.
+    """
+    tiempos = {}
+    for nombre_etapa, segundos in etapas:
+        tiempos[nombre_etapa] = tiempos.get(nombre_etapa, 0.0) + 1000 * segundos
+    if total is not None:
+        tiempos['total'] = 1000 * total
+    return {nombre_etapa: round(ms, 2) for nombre_etapa, ms in tiempos.items()}
+
+
+def cabecera_server_timing(tiempos):
+    """Valor de la cabecera Server-Timing para un resumen de resumir_etapas"""
+    return ', '.join(f"{nombre_etapa};dur={ms}" for nombre_etapa, ms in tiempos.items())
+
+
+# ==========================
+# SOLICITUDES HTTP (Flask)
+# ==========================
+
+solicitudes_total = registro.contador(
+    'optiscan_solicitudes_total',
+    'Solicitudes atendidas por endpoint y resultado',
+    ('endpoint', 'resultado', 'codigo')
+)
+duracion_solicitudes = registro.histograma(
+    'optiscan_solicitud_duracion_segundos',
+    'Duración de las solicitudes por endpoint (incluye el envío en streaming)',
+    ('endpoint',)
+)
+solicitudes_en_vuelo = registro.medidor(
+    'optiscan_solicitudes_en_vuelo',
+    'Solicitudes en curso por endpoint',
+    ('endpoint',)
+)
+
+
+# Ventana de solicitudes recientes por endpoint para los percentiles de /health/deep
+MUESTRAS_LATENCIA_RECIENTE = 500
+
+
+class LatenciasRecientes:
+    """Duración de las últimas solicitudes de cada endpoint
+
+    Los histogramas de /metrics acumulan desde el arranque; los percentiles
+    de esta ventana reflejan la carga de ahora.
+    """
+
+    def __init__(self, muestras=MUESTRAS_LATENCIA_RECIENTE):
+        self.muestras = muestras
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def anotar(self, endpoint, segundos):
+        with self._lock:
+            serie = self._series.get(endpoint)
+            if serie is None:
+                serie = self._series[endpoint] = deque(maxlen=self.muestras)
+            serie.append(segundos)
+
+    def estadisticas(self):
+        with self._lock:
+            series = {endpoint: sorted(serie) for endpoint, serie in self._series.items()}
+        return {
+            endpoint: {
+                'muestras': len(duraciones),
+                'p50_ms': round(1000 * duraciones[int(0.50 * (len(duraciones) - 1))], 2),
+                'p95_ms': round(1000 * duraciones[int(0.95 * (len(duraciones) - 1))], 2),
+                'p99_ms': round(1000 * duraciones[int(0.99 * (len(duraciones) - 1))], 2),
+                'max_ms': round(1000 * duraciones[-1], 2)
+            }
+            for endpoint, duraciones in sorted(series.items()) if duraciones
+        }
+
+
+latencias_recientes = LatenciasRecientes()
+
+
+PARAMETRO_TIEMPOS = 'timings'
+VALORES_VERDADEROS = ('1', 'true', 'yes', 'si', 'sí')
+
+
+def pide_tiempos(req):
+    """True si la solicitud pide el objeto "timings" en el JSON (query, formulario o JSON)"""
+    valor = req.args.get(PARAMETRO_TIEMPOS, req.form.get(PARAMETRO_TIEMPOS))
+    if valor is None and req.is_json:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            valor = data.get(PARAMETRO_TIEMPOS)
+    if isinstance(valor, bool):
+        return valor
+    return valor is not None and str(valor).strip().lower() in VALORES_VERDADEROS
+
+
+def con_tiempos(vista):
+    """Decorador de endpoint: desglose por etapa de esta solicitud
+
+    Siempre añade la cabecera Server-Timing; si la solicitud lo pide
+    (pide_tiempos) y la respuesta es un objeto JSON, añade "timings".
+    Las respuestas en streaming no llevan desglose (la cabecera sale antes
+    que el trabajo).
+    """
+    from flask import request
+
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        if request.method == 'OPTIONS':
+            return vista(*args, **kwargs)
+
+        inicio = time.perf_counter()
+        with recolectar_etapas() as etapas:
+            resultado = vista(*args, **kwargs)
+
+        respuesta = resultado[0] if isinstance(resultado, tuple) else resultado
+        if not hasattr(respuesta, 'headers') or \
+                (respuesta.is_streamed and not respuesta.direct_passthrough):
+            return resultado
+
+        tiempos = resumir_etapas(etapas, time.perf_counter() - inicio)
+        respuesta.headers['Server-Timing'] = cabecera_server_timing(tiempos)
+        # El frontend (otro origen, CORS abierto) puede leerla en serverTiming
+        respuesta.headers.setdefault('Timing-Allow-Origin', '*')
+
+        if respuesta.is_json and pide_tiempos(request):
+            datos = respuesta.get_json(silent=True)
+            if isinstance(datos, dict):
+                datos['timings'] = tiempos
+                respuesta.set_data(json.dumps(datos, ensure_ascii=False))
+        return resultado
+
+    return envoltura
+
+
+def resultado_http(codigo):
+    """Clasificar un código HTTP en exito, rechazada, error_cliente o error_servidor"""
+    if codigo in (429, 503):
+        return 'rechazada'
+    if codigo >= 500:
+        return 'error_servidor'
+    if codigo >= 400:
+        return 'error_cliente'
+    return 'exito'
+
+
+def instrumentar_app(app):
+    """Registrar contadores, latencia y en-vuelo por endpoint en una app Flask"""
+    from flask import g, request
+
+    def nombre_endpoint():
+        # La regla de la ruta (no la URL) acota la cardinalidad
+        return request.url_rule.rule if request.url_rule is not None else 'desconocido'
+
+    @app.before_request
+    def _inicio_solicitud():
+        g.metricas_inicio = time.perf_counter()
+        g.metricas_endpoint = nombre_endpoint()
+        solicitudes_en_vuelo.sumar(g.metricas_endpoint)
+
+    def terminar(endpoint, inicio, codigo):
+        solicitudes_en_vuelo.restar(endpoint)
+        solicitudes_total.incrementar(endpoint, resultado_http(codigo), codigo)
+        duracion = time.perf_counter() - inicio
+        duracion_solicitudes.observar(endpoint, valor=duracion)
+        latencias_recientes.anotar(endpoint, duracion)
+
+    @app.after_request
+    def _codigo_solicitud(respuesta):
+        # Respuestas generadas en streaming (NDJSON): se cuentan al cerrarlas
+        if respuesta.is_streamed and not respuesta.direct_passthrough and 'metricas_inicio' in g:
+            respuesta.call_on_close(functools.partial(
+                terminar, g.pop('metricas_endpoint'), g.pop('metricas_inicio'), respuesta.status_code
+            ))
+        else:
+            g.metricas_codigo = respuesta.status_code
+        return respuesta
+
+    @app.teardown_request
+    def _fin_solicitud(error=None):
+        inicio = g.pop('metricas_inicio', None)
+        if inicio is None:
+            return
+        codigo = 500 if error is not None else g.pop('metricas_codigo', 500)
+        terminar(g.pop('metricas_endpoint'), inicio, codigo)
+
+    return app
+
+
+def respuesta_metricas():
+    """Respuesta Flask con el texto de exposición para /metrics"""
+    from flask import Response
+    return Response(registro.exportar(), mimetype=None, content_type=TIPO_CONTENIDO)
@@ -3,6 +3,8 @@ import cv2
 import numpy as np
 import base64
 import json
+from campos_respuesta import incluye, CAMPO_IMAGEN_DEBUG
+from metricas import etapa, medir, ETAPA_CUADRADO_VERDE, ETAPA_CODIFICAR_JPEG
 
 class ConversorMedidasReales:
     """
@@ -40,9 +42,13 @@ class ConversorMedidasReales:
             print(f"❌ Error cargando imagen desde base64: {e}")
             return None
     
-    def detectar_cuadrado_verde(self, imagen):
+    @etapa(ETAPA_CUADRADO_VERDE)
+    def detectar_cuadrado_verde(self, imagen, incluir=None):
         """
         Detectar el cuadrado verde de referencia de 5x5 cm en la imagen
+        
+        La imagen de debug solo se genera si `incluir` contiene
+        "imagen_debug" (None la incluye siempre)
         """
         try:
             print("🔍 Buscando cuadrado verde de referencia (5x5 cm)...")
@@ -129,26 +135,12 @@ class ConversorMedidasReales:
             self.pixeles_por_mm = pixeles_por_mm
             self.referencia_detectada = True
             
-            # Crear imagen de debug
-            debug_img = imagen.copy()
-            cv2.rectangle(debug_img, (x, y), (x + w, y + h), (0, 0, 255), 3)
-            
-            # Etiqueta informativa
-            label = f"Referencia: {w}x{h}px = 5x5cm"
-            cv2.putText(debug_img, label, (x, y - 10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-            
-            # Convertir imagen de debug a base64
-            _, buffer = cv2.imencode('.jpg', debug_img)
-            debug_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            return {
+            deteccion = {
                 'detectado': True,
                 'bbox': (int(x), int(y), int(w), int(h)),
                 'dimensiones_px': {'ancho': int(w), 'alto': int(h)},
                 'pixeles_por_cm': float(pixeles_por_cm),
                 'pixeles_por_mm': float(pixeles_por_mm),
-                'imagen_debug': f"data:image/jpeg;base64,{debug_base64}",
                 'factor_conversion': {
                     'cm': float(pixeles_por_cm),
                     'mm': float(pixeles_por_mm),
@@ -156,6 +148,24 @@ class ConversorMedidasReales:
                 }
             }
             
+            if incluye(incluir, CAMPO_IMAGEN_DEBUG):
+                # Crear imagen de debug
+                debug_img = imagen.copy()
+                cv2.rectangle(debug_img, (x, y), (x + w, y + h), (0, 0, 255), 3)
+                
+                # Etiqueta informativa
+                label = f"Referencia: {w}x{h}px = 5x5cm"
+                cv2.putText(debug_img, label, (x, y - 10), 
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                
+                # Convertir imagen de debug a base64
+                with medir(ETAPA_CODIFICAR_JPEG):
+                    _, buffer = cv2.imencode('.jpg', debug_img)
+                debug_base64 = base64.b64encode(buffer).decode('utf-8')
+                deteccion['imagen_debug'] = f"data:image/jpeg;base64,{debug_base64}"
+            
+            return deteccion
+            
         except Exception as e:
             print(f"❌ Error detectando cuadrado verde: {e}")
             import traceback
@@ -254,8 +264,18 @@ class ConversorMedidasReales:
             if imagen is None:
                 return {"error": "No se pudo cargar la imagen"}
             
+            return self.procesar_imagen(imagen)
+            
+        except Exception as e:
+            return {"error": f"Error procesando imagen: {str(e)}"}
+    
+    def procesar_imagen(self, imagen, incluir=None):
+        """
+        Detectar el cuadrado verde en una imagen BGR ya decodificada
+        """
+        try:
             # Detectar cuadrado verde
-            deteccion = self.detectar_cuadrado_verde(imagen)
+            deteccion = self.detectar_cuadrado_verde(imagen, incluir)
             
             if not deteccion or not deteccion['detectado']:
                 return {
@@ -284,14 +304,41 @@ def analizar_imagen_con_medidas_reales(imagen_base64, analisis_existente):
     Función principal que integra la detección del cuadrado verde
     y la conversión de medidas con el análisis existente
     """
+    conversor = ConversorMedidasReales()
+    imagen = conversor.cargar_imagen_desde_base64(imagen_base64)
+    if imagen is None:
+        print("⚠️ No se pudo decodificar la imagen, usando factor por defecto")
+    return integrar_medidas_reales(imagen, analisis_existente, conversor)
+
+
+def integrar_medidas_reales(imagen, analisis_existente, conversor=None, incluir=None):
+    """
+    Igual que analizar_imagen_con_medidas_reales pero sobre una imagen BGR
+    ya decodificada (sin voltear), para no decodificar la imagen otra vez
+    """
+    # Crear conversor
+    if conversor is None:
+        conversor = ConversorMedidasReales()
+    
+    # Procesar imagen para detección
+    if imagen is None:
+        deteccion_result = {"error": "No se pudo cargar la imagen"}
+    else:
+        deteccion_result = conversor.procesar_imagen(imagen, incluir)
+    
+    return aplicar_medidas_reales(analisis_existente, deteccion_result, conversor)
+
+
+def aplicar_medidas_reales(analisis_existente, deteccion_result, conversor=None):
+    """
+    Convertir las medidas del análisis con un resultado de detección del
+    cuadrado de referencia ya calculado (p. ej. en paralelo con el análisis)
+    """
     try:
         print("🔄 Integrando medidas reales en el análisis...")
         
-        # Crear conversor
-        conversor = ConversorMedidasReales()
-        
-        # Procesar imagen para detección
-        deteccion_result = conversor.procesar_imagen_base64(imagen_base64)
+        if conversor is None:
+            conversor = ConversorMedidasReales()
         
         # Si no hay detección, usar valor por defecto
         factor_conversion = None
@@ -0,0 +1,195 @@
+"""
+Pipeline unificado para el análisis completo (forma + tono + medidas reales).
+
+La imagen se decodifica una sola vez y los 478 landmarks se detectan una
+sola vez. La misma malla alimenta la forma del rostro (vista espejo,
+obtenida transformando coordenadas), la máscara de piel (coordenadas
+originales) y la conversión a medidas reales de mm.py.
+
+Las etapas independientes (cuadrado de referencia, forma y tono) se
+ejecutan en paralelo en un pool de hilos acotado: son trabajo de
+OpenCV/MediaPipe/NumPy que libera el GIL, así que la latencia total se
+acerca a la de la etapa más lenta en lugar de a la suma de todas.
+
+analizar_por_etapas() entrega además cada parte del resultado en cuanto
+termina su etapa, para la variante en streaming de /analyze-complete.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+
+from imagen_solicitud import imagen_desde_entrada, ErrorImagenSolicitud
+from malla import landmarks_a_pixeles, imagen_deteccion
+from mm import ConversorMedidasReales, aplicar_medidas_reales
+from metricas import copiar_contexto
+
+# Hilos compartidos por todas las solicitudes para las etapas del pipeline
+MAX_HILOS_PIPELINE = int(os.environ.get('OPTISCAN_HILOS_PIPELINE', '4'))
+
+# Eventos de analizar_por_etapas(), además del final EVENTO_COMPLETO
+EVENTO_FORMA = 'forma_rostro'
+EVENTO_RECOMENDACIONES = 'recomendaciones'
+EVENTO_MEDIDAS = 'medidas_convertidas'
+EVENTO_TONO = 'tono_piel'
+EVENTO_COMPLETO = 'completo'
+
+
+def eventos_resultado(resultados):
+    """Eventos de analizar_por_etapas() a partir de un resultado completo ya calculado
+
+    Para la caché y los modos sin pipeline residente: mismos eventos, todos a la vez.
+    """
+    forma = resultados.get('forma_rostro')
+    if isinstance(forma, dict):
+        yield from eventos_forma(forma)
+        if 'medidas_convertidas' in forma:
+            yield EVENTO_MEDIDAS, {
+                'medidas_convertidas': forma['medidas_convertidas'],
+                'deteccion_referencia': forma.get('deteccion_referencia')
+            }
+    if 'tono_piel' in resultados:
+        yield EVENTO_TONO, resultados['tono_piel']
+    yield EVENTO_COMPLETO, resultados
+
+
+def eventos_forma(forma):
+    """Forma del rostro (sin recomendaciones) y, por separado, las recomendaciones"""
+    yield EVENTO_FORMA, {k: v for k, v in forma.items()
+                         if k not in ('recomendaciones', 'medidas_convertidas', 'deteccion_referencia')}
+    if 'recomendaciones' in forma:
+        yield EVENTO_RECOMENDACIONES, forma['recomendaciones']
+
+
+class PipelineAnalisisCompleto:
+    """Análisis completo con una sola pasada de MediaPipe Face Mesh"""
+
+    def __init__(self, analizador_forma, analizador_tono, max_hilos=None):
+        # Los landmarks se detectan con el grafo del analizador de forma
+        self.analizador_forma = analizador_forma
+        self.analizador_tono = analizador_tono
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_hilos or MAX_HILOS_PIPELINE,
+            thread_name_prefix='pipeline'
+        )
+        print(">>> Pipeline de análisis completo inicializado")
+
+    @staticmethod
+    def resultado_sin_imagen():
+        return {
+            'forma_rostro': {'error': 'No se pudo cargar la imagen', 'estado': 'error'},
+            'tono_piel': {'estado': 'error', 'error': 'No se pudo cargar la imagen'}
+        }
+
+    def analizar_archivo(self, ruta_imagen, incluir=None):
+        """Análisis completo a partir de un archivo de imagen"""
+        imagen = cv2.imread(ruta_imagen)
+        if imagen is None:
+            print(f"ERROR: No se pudo cargar la imagen {ruta_imagen}")
+            return self.resultado_sin_imagen()
+        return self.analizar(imagen, incluir)
+
+    def analizar_imagen(self, imagen, incluir=None):
+        """Análisis completo desde memoria: bytes codificados (JPEG/PNG) o ndarray BGR"""
+        try:
+            imagen = imagen_desde_entrada(imagen)
+        except ErrorImagenSolicitud as e:
+            print(f"ERROR: No se pudo cargar la imagen: {e}")
+            return self.resultado_sin_imagen()
+        return self.analizar(imagen, incluir)
+
+    def detectar_referencia(self, imagen, incluir=None):
+        """Detectar el cuadrado verde; devuelve el conversor usado y su resultado"""
+        conversor = ConversorMedidasReales()
+        return conversor, conversor.procesar_imagen(imagen, incluir)
+
+    def analizar_forma(self, imagen, landmarks, incluir=None):
+        """Forma del rostro en la vista espejo de main.py, sin voltear los píxeles para detectar"""
+        try:
+            h, w = imagen.shape[:2]
+            puntos_espejo = landmarks_a_pixeles(landmarks, w, h, espejo=True)
+            # Solo la imagen de visualización se voltea
+            return self.analizador_forma.analizar_puntos(puntos_espejo, cv2.flip(imagen, 1), incluir)
+        except Exception as e:
+            print(f"ERROR en el análisis: {str(e)}")
+            return {'error': f'Error en el análisis: {str(e)}', 'estado': 'error'}
+
+    def analizar_tono(self, imagen_rgb, landmarks, incluir=None, forma_original=None):
+        """Tono de piel en coordenadas originales, igual que tonos.py"""
+        h, w = imagen_rgb.shape[:2]
+        puntos = landmarks_a_pixeles(landmarks, w, h)
+        return self.analizador_tono.analizar_tono_desde_puntos(imagen_rgb, puntos, incluir, forma_original)
+
+    def analizar(self, imagen, incluir=None):
+        """Análisis completo sobre una imagen BGR ya decodificada (sin voltear)
+
+        `incluir` limita los artefactos pesados (ver campos_respuesta.py);
+        None los incluye todos.
+        """
+        for evento, datos in self.analizar_por_etapas(imagen, incluir):
+            if evento == EVENTO_COMPLETO:
+                return datos
+
+    def analizar_por_etapas(self, imagen, incluir=None):
+        """Generador de (evento, datos) en cuanto termina cada etapa
+
+        Emite forma_rostro y recomendaciones al terminar la forma,
+        medidas_convertidas cuando además termina el cuadrado de referencia,
+        tono_piel al terminar el tono (en el orden en que terminen) y por
+        último "completo" con el mismo resultado que analizar(). Cada evento
+        debe serializarse antes de pedir el siguiente: la forma se completa
+        con las medidas reales sobre el mismo diccionario.
+        """
+        # El cuadrado de referencia no depende de los landmarks: arranca ya
+        futuro_referencia = self.executor.submit(copiar_contexto(self.detectar_referencia), imagen, incluir)
+
+        # Detección y tono sobre la imagen reducida; la forma usa los landmarks
+        # en píxeles de la original y el cuadrado de referencia la imagen completa
+        imagen_rgb = imagen_deteccion(imagen)
+
+        print(">>> Detectando landmarks (pasada única)...")
+        landmarks = self.analizador_forma.detectar_landmarks(imagen_rgb)
+
+        if landmarks is None:
+            print("ERROR: No se detectaron rostros con MediaPipe")
+            forma = {'error': 'No se pudo detectar rostro en la imagen', 'estado': 'error'}
+            tono = {'estado': 'error', 'error': 'No se detectaron rostros en la imagen'}
+            futuro_forma = futuro_tono = None
+            pendientes = {futuro_referencia}
+        else:
+            futuro_tono = self.executor.submit(copiar_contexto(self.analizar_tono), imagen_rgb, landmarks, incluir,
+                                              imagen.shape)
+            futuro_forma = self.executor.submit(copiar_contexto(self.analizar_forma), imagen, landmarks, incluir)
+            pendientes = {futuro_forma, futuro_tono, futuro_referencia}
+
+        try:
+            if landmarks is None:
+                yield EVENTO_FORMA, forma
+                yield EVENTO_TONO, tono
+            while pendientes:
+                hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                if futuro_forma in hechos:
+                    forma = futuro_forma.result()
+                    yield from eventos_forma(forma)
+                if futuro_tono in hechos:
+                    tono = futuro_tono.result()
+                    yield EVENTO_TONO, tono
+                # Unir: medidas reales a partir de la forma y la referencia detectada
+                if futuro_referencia not in pendientes and futuro_forma not in pendientes \
+                        and (futuro_forma in hechos or futuro_referencia in hechos):
+                    conversor, deteccion_result = futuro_referencia.result()
+                    forma = aplicar_medidas_reales(forma, deteccion_result, conversor)
+                    if 'medidas_convertidas' in forma:
+                        yield EVENTO_MEDIDAS, {
+                            'medidas_convertidas': forma['medidas_convertidas'],
+                            'deteccion_referencia': forma['deteccion_referencia']
+                        }
+        finally:
+            # Cliente desconectado: no dejar etapas pendientes que nadie va a leer
+            for futuro in pendientes:
+                futuro.cancel()
+
+        yield EVENTO_COMPLETO, {
+            'forma_rostro': forma,
+            'tono_piel': tono
+        }
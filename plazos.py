@@ -0,0 +1,171 @@
+"""
+Plazos y cancelación cooperativa de los análisis.
+
+Cada solicitud de análisis lleva un plazo (OPTISCAN_PLAZO_S) que viaja en
+una variable de contexto, así que llega también a los hilos del pipeline
+lanzados con copiar_contexto(). metricas.medir() lo comprueba al empezar
+cada etapa (decodificar, reducir, face_mesh, medidas, clasificación,
+kmeans_tono, cuadrado_verde, codificar_jpeg, ...): una vez vencido el
+plazo o cancelada la solicitud, la siguiente etapa lanza AnalisisCancelado
+y el resto del análisis no se ejecuta, con lo que el hilo (o el trabajador
+del pool) queda libre para otra solicitud. Una etapa que ya está corriendo
+(una llamada a MediaPipe o a KMeans) no se interrumpe.
+
+Con el servidor de Werkzeug (app.run o prefork.py) en cada punto de
+control se comprueba además si el cliente cerró la conexión. En las
+respuestas en streaming la cancelación llega al cerrarse la respuesta.
+"""
+import contextvars
+import functools
+import os
+import select
+import socket
+import time
+from contextlib import contextmanager
+
+# Plazo por solicitud en segundos (0 = sin plazo)
+PLAZO_S = float(os.environ.get('OPTISCAN_PLAZO_S', '30'))
+
+MOTIVO_PLAZO = 'plazo'
+MOTIVO_CLIENTE = 'cliente'
+
+_plazo_actual = contextvars.ContextVar('optiscan_plazo', default=None)
+
+
+class AnalisisCancelado(BaseException):
+    """El análisis se abandonó: plazo vencido o cliente desconectado
+
+    Hereda de BaseException (como asyncio.CancelledError) porque los
+    analizadores capturan Exception para devolver {'estado': 'error'} y la
+    cancelación debe atravesarlos hasta el endpoint.
+    """
+
+    def __init__(self, motivo, etapa=None):
+        super().__init__(motivo, etapa)
+        self.motivo = motivo
+        self.etapa = etapa
+
+    def __str__(self):
+        texto = "Plazo del análisis vencido" if self.motivo == MOTIVO_PLAZO else "Cliente desconectado"
+        return f"{texto} (etapa {self.etapa})" if self.etapa else texto
+
+
+class Plazo:
+    """Límite de tiempo y estado de cancelación de una solicitud"""
+
+    def __init__(self, segundos=None, conexion=None):
+        self.segundos = PLAZO_S if segundos is None else segundos
+        self.limite = time.monotonic() + self.segundos if self.segundos > 0 else None
+        # Socket del cliente para detectar desconexiones (None si el servidor no lo expone)
+        self.conexion = conexion
+        self.motivo = None
+
+    @property
+    def cancelado(self):
+        return self.motivo is not None
+
+    def restante(self):
+        """Segundos hasta el límite (None sin plazo)"""
+        if self.limite is None:
+            return None
+        return max(0.0, self.limite - time.monotonic())
+
+    def cancelar(self, motivo=MOTIVO_CLIENTE):
+        if self.motivo is None:
+            self.motivo = motivo
+
+    def cliente_desconectado(self):
+        """True si el cliente cerró la conexión (el cuerpo ya está leído)"""
+        if self.conexion is None:
+            return False
+        try:
+            legible, _, _ = select.select([self.conexion], [], [], 0)
+            if not legible:
+                return False
+            # Legible sin datos pendientes = fin de la conexión
+            return self.conexion.recv(1, socket.MSG_PEEK) == b''
+        except ValueError:
+            # Descriptor fuera del rango de select(): no se puede vigilar
+            return False
+        except OSError:
+            return True
+
+    def verificar(self, etapa=None):
+        """Lanzar AnalisisCancelado si el plazo venció o el cliente se fue"""
+        if self.motivo is None:
+            if self.limite is not None and time.monotonic() >= self.limite:
+                self.motivo = MOTIVO_PLAZO
+            elif self.cliente_desconectado():
+                self.motivo = MOTIVO_CLIENTE
+        if self.motivo is not None:
+            raise AnalisisCancelado(self.motivo, etapa)
+
+
+def plazo_solicitud(req, segundos=None):
+    """Plazo de una solicitud de Flask, vigilando su conexión si el servidor la expone"""
+    return Plazo(segundos, req.environ.get('werkzeug.socket'))
+
+
+@contextmanager
+def activar_plazo(plazo):
+    """Hacer de `plazo` el plazo vigente dentro del bloque (y de los hilos que copien el contexto)"""
+    token = _plazo_actual.set(plazo)
+    try:
+        yield plazo
+    finally:
+        _plazo_actual.reset(token)
+
+
+def plazo_actual():
+    return _plazo_actual.get()
+
+
+def verificar_plazo(etapa=None):
+    """Punto de control entre etapas; no hace nada fuera de una solicitud con plazo"""
+    plazo = _plazo_actual.get()
+    if plazo is not None:
+        plazo.verificar(etapa)
+
+
+def plazo_restante(maximo):
+    """Tiempo para una espera bloqueante: el restante del plazo vigente, como mucho `maximo`"""
+    plazo = _plazo_actual.get()
+    restante = plazo.restante() if plazo is not None else None
+    return maximo if restante is None else min(maximo, restante)
+
+
+def respuesta_cancelado(error):
+    """Respuesta de Flask para un análisis cancelado: 504 por plazo, 499 si el cliente se fue"""
+    from flask import jsonify
+
+    print(f">>> Análisis cancelado: {error}")
+    if error.motivo == MOTIVO_PLAZO:
+        return jsonify({
+            "success": False,
+            "error": "El análisis superó el plazo de la solicitud",
+            "etapa": error.etapa,
+            "message": "Intenta de nuevo con una imagen más pequeña o más tarde"
+        }), 504
+    # Nadie va a leer la respuesta: 499 (como nginx) para las métricas y el log
+    return jsonify({"success": False, "error": str(error)}), 499
+
+
+def con_plazo(vista):
+    """Decorador de endpoint: ejecutar la vista con el plazo de la solicitud
+
+    Va por fuera de requiere_admision(): la espera en la cola cuenta dentro
+    del plazo.
+    """
+    from flask import request
+
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        if request.method == 'OPTIONS':
+            return vista(*args, **kwargs)
+        with activar_plazo(plazo_solicitud(request)):
+            try:
+                return vista(*args, **kwargs)
+            except AnalisisCancelado as e:
+                return respuesta_cancelado(e)
+
+    return envoltura
@@ -0,0 +1,332 @@
+"""
+Pool de procesos trabajadores pre-cargados para los analizadores.
+
+Cada trabajador (trabajador.py) carga los analizadores una sola vez y
+atiende muchos trabajos (forma, tono o completo) por stdin/stdout con el
+protocolo JSON-lines. La imagen se envía en el mensaje, sin archivos
+temporales de por medio.
+El pool recicla trabajadores tras N trabajos o al superar un umbral de
+memoria, reinicia los que se caen o se cuelgan y reporta la utilización
+de cada uno.
+"""
+import atexit
+import base64
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from trabajador import enviar_mensaje, decodificar_mensaje
+from metricas import observar, ETAPA_ARRANQUE_TRABAJADOR
+from plazos import AnalisisCancelado, MOTIVO_PLAZO
+
+trabajador_script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trabajador.py")
+
+# Tiempo extra tras el plazo antes de dar por colgado al trabajador y matarlo
+MARGEN_PLAZO_S = 2.0
+
+
+class ErrorTrabajador(Exception):
+    """Fallo de un trabajador del pool (caída, respuesta inválida o error del análisis)"""
+
+
+def memoria_proceso_mb(pid):
+    """Memoria residente (RSS) de un proceso en MB, o None si no se puede medir"""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    except Exception:
+        return None
+
+    # Respaldo sin psutil (Linux)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Trabajador:
+    """Un proceso trabajador persistente y sus estadísticas de uso"""
+
+    def __init__(self, indice, python_path):
+        self.indice = indice
+        self.python_path = python_path
+        self.proceso = None
+        self.respuestas = None
+        self.creado = time.time()
+        self.iniciado = None
+        self.ocupado = False
+        self.trabajos_proceso = 0
+        self.trabajos_totales = 0
+        self.errores = 0
+        self.tiempo_ocupado = 0.0
+        self.reinicios = 0
+        self.reciclajes = 0
+
+    def iniciar(self, timeout_arranque=120):
+        """Lanzar el proceso y esperar a que el analizador esté cargado"""
+        inicio = time.perf_counter()
+        self.proceso = subprocess.Popen(
+            [self.python_path, trabajador_script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None,  # Los diagnósticos van al log del servidor
+            text=True,
+            encoding='utf-8',
+            bufsize=1
+        )
+        # Cola nueva por proceso: nunca se leen respuestas de un proceso anterior
+        self.respuestas = queue.Queue()
+        threading.Thread(
+            target=self._leer_salida,
+            args=(self.proceso, self.respuestas),
+            daemon=True
+        ).start()
+
+        mensaje = self._esperar_mensaje(timeout_arranque)
+        if not mensaje or not mensaje.get('listo'):
+            self.detener()
+            raise ErrorTrabajador(f"El trabajador #{self.indice} no pudo iniciar")
+
+        # Arranque del intérprete + importaciones + carga de MediaPipe
+        observar(ETAPA_ARRANQUE_TRABAJADOR, time.perf_counter() - inicio)
+        self.iniciado = time.time()
+        self.trabajos_proceso = 0
+        print(f">>> Trabajador #{self.indice} listo (pid {self.proceso.pid})")
+
+    @staticmethod
+    def _leer_salida(proceso, respuestas):
+        """Hilo lector: pasa cada mensaje del trabajador a la cola; None al cerrar"""
+        for linea in proceso.stdout:
+            mensaje = decodificar_mensaje(linea)
+            if mensaje is not None:
+                respuestas.put(mensaje)
+        respuestas.put(None)
+
+    def _esperar_mensaje(self, timeout):
+        try:
+            return self.respuestas.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def vivo(self):
+        return self.proceso is not None and self.proceso.poll() is None
+
+    def detener(self, timeout=5):
+        """Pedir al trabajador que termine; matarlo si no responde"""
+        if self.proceso is None:
+            return
+        try:
+            if self.proceso.poll() is None:
+                enviar_mensaje(self.proceso.stdin, {'accion': 'salir'})
+                self.proceso.wait(timeout=timeout)
+        except Exception:
+            self.proceso.kill()
+            self.proceso.wait()
+        self.proceso = None
+
+    def reiniciar(self, reciclaje=False):
+        self.detener()
+        if reciclaje:
+            self.reciclajes += 1
+        else:
+            self.reinicios += 1
+        self.iniciar()
+
+    def ejecutar(self, id_trabajo, tipo, imagen_base64, timeout, incluir=None, plazo_s=None):
+        """Enviar un trabajo y esperar su respuesta
+
+        Con `plazo_s` el trabajador abandona el análisis por su cuenta al
+        vencer (plazos.py); `timeout` es el límite tras el que se le mata.
+        """
+        self.ocupado = True
+        inicio = time.time()
+        try:
+            try:
+                enviar_mensaje(self.proceso.stdin, {
+                    'id': id_trabajo,
+                    'tipo': tipo,
+                    'imagen': imagen_base64,
+                    'incluir': sorted(incluir) if incluir is not None else None,
+                    'plazo_s': plazo_s
+                })
+            except (BrokenPipeError, OSError, ValueError):
+                raise ErrorTrabajador(f"El trabajador #{self.indice} no acepta trabajos")
+
+            limite = inicio + timeout
+            while True:
+                restante = limite - time.time()
+                if restante <= 0:
+                    # Trabajador colgado: se mata y el pool lo reinicia
+                    self.proceso.kill()
+                    raise subprocess.TimeoutExpired(trabajador_script_path, timeout)
+
+                mensaje = self._esperar_mensaje(restante)
+                if mensaje is None:
+                    # Fin de stdout: el proceso terminó
+                    raise ErrorTrabajador(f"El trabajador #{self.indice} terminó inesperadamente")
+                if mensaje.get('id') == id_trabajo:
+                    break
+
+            if mensaje.get('cancelado'):
+                # El trabajador abandonó el análisis al vencer el plazo y sigue sano
+                raise AnalisisCancelado(mensaje['cancelado'], mensaje.get('etapa'))
+            if not mensaje.get('ok'):
+                self.errores += 1
+                raise ErrorTrabajador(mensaje.get('error', 'Error desconocido en el trabajador'))
+
+            # Etapas medidas en el trabajador: a los histogramas de este proceso
+            for nombre_etapa, segundos in mensaje.get('etapas') or ():
+                observar(nombre_etapa, segundos)
+
+            return mensaje.get('resultado')
+        finally:
+            self.ocupado = False
+            self.trabajos_proceso += 1
+            self.trabajos_totales += 1
+            self.tiempo_ocupado += time.time() - inicio
+
+    def memoria_mb(self):
+        proceso = self.proceso
+        return memoria_proceso_mb(proceso.pid) if proceso and proceso.poll() is None else None
+
+    def estadisticas(self):
+        """Utilización y estado del trabajador"""
+        proceso = self.proceso
+        vivo = proceso is not None and proceso.poll() is None
+        antiguedad = max(time.time() - self.creado, 1e-9)
+        memoria = self.memoria_mb()
+        return {
+            'indice': self.indice,
+            'pid': proceso.pid if vivo else None,
+            'vivo': vivo,
+            'ocupado': self.ocupado,
+            'trabajos_proceso_actual': self.trabajos_proceso,
+            'trabajos_totales': self.trabajos_totales,
+            'errores': self.errores,
+            'tiempo_ocupado_s': round(self.tiempo_ocupado, 3),
+            'utilizacion': round(self.tiempo_ocupado / antiguedad, 4),
+            'uptime_s': round(time.time() - self.iniciado, 1) if self.iniciado and vivo else 0.0,
+            'memoria_mb': round(memoria, 1) if memoria is not None else None,
+            'reinicios': self.reinicios,
+            'reciclajes': self.reciclajes
+        }
+
+
+class PoolTrabajadores:
+    """Pool fijo de trabajadores persistentes"""
+
+    def __init__(self, tamano=2, max_trabajos=200, max_memoria_mb=1024,
+                 timeout=30, python_path=None):
+        self.max_trabajos = max_trabajos
+        self.max_memoria_mb = max_memoria_mb
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._libres = queue.Queue()
+        self.trabajadores = [
+            Trabajador(i, python_path or sys.executable)
+            for i in range(tamano)
+        ]
+
+        # Pre-calentar todos los trabajadores en paralelo
+        hilos = [threading.Thread(target=self._iniciar_trabajador, args=(t,))
+                 for t in self.trabajadores]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        atexit.register(self.cerrar)
+        print(f">>> Pool de trabajadores inicializado ({tamano} procesos)")
+
+    def _iniciar_trabajador(self, trabajador, reciclaje=None):
+        try:
+            if reciclaje is None:
+                trabajador.iniciar()
+            else:
+                trabajador.reiniciar(reciclaje=reciclaje)
+        except Exception as e:
+            print(f">>> Error iniciando trabajador #{trabajador.indice}: {e}")
+        # Aunque no haya arrancado vuelve a la cola: ejecutar() lo reintenta
+        self._libres.put(trabajador)
+
+    def _necesita_reciclaje(self, trabajador):
+        if trabajador.trabajos_proceso >= self.max_trabajos:
+            return True
+        memoria = trabajador.memoria_mb()
+        return memoria is not None and memoria > self.max_memoria_mb
+
+    def ejecutar(self, tipo, buffer_imagen, timeout=None, incluir=None, plazo_s=None):
+        """Ejecutar un análisis ('forma', 'tono' o 'completo') en el primer trabajador libre
+
+        `buffer_imagen` son los bytes codificados (JPEG/PNG) de la imagen e
+        `incluir` los artefactos pesados pedidos (None: todos). Con `plazo_s`
+        el trabajador se detiene solo al vencer; si no responde, se le mata
+        MARGEN_PLAZO_S después. La espera por un trabajador libre cuenta
+        dentro de `timeout` y de `plazo_s`.
+        """
+        inicio = time.monotonic()
+        timeout = timeout or self.timeout
+        if plazo_s is not None:
+            timeout = min(timeout, plazo_s + MARGEN_PLAZO_S)
+        # El canal es texto: la imagen viaja en base64 dentro del mensaje JSON
+        imagen_base64 = base64.b64encode(buffer_imagen).decode('ascii')
+        try:
+            trabajador = self._libres.get(timeout=timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired(trabajador_script_path, timeout)
+
+        try:
+            if not trabajador.vivo():
+                trabajador.reiniciar()
+            # Lo que queda de cada límite tras la espera (y el reinicio)
+            transcurrido = time.monotonic() - inicio
+            if plazo_s is not None:
+                plazo_s -= transcurrido
+                if plazo_s <= 0:
+                    raise AnalisisCancelado(MOTIVO_PLAZO, 'espera_trabajador')
+            restante = timeout - transcurrido
+            if restante <= 0:
+                raise subprocess.TimeoutExpired(trabajador_script_path, timeout)
+            return trabajador.ejecutar(next(self._ids), tipo, imagen_base64, restante, incluir, plazo_s)
+        finally:
+            if not trabajador.vivo():
+                reciclaje = False
+            elif self._necesita_reciclaje(trabajador):
+                reciclaje = True
+            else:
+                reciclaje = None
+
+            if reciclaje is None:
+                self._libres.put(trabajador)
+            else:
+                # Reinicio en segundo plano para no retrasar esta respuesta
+                threading.Thread(
+                    target=self._iniciar_trabajador,
+                    args=(trabajador, reciclaje),
+                    daemon=True
+                ).start()
+
+    def estadisticas(self):
+        trabajadores = [t.estadisticas() for t in self.trabajadores]
+        return {
+            'tamano': len(self.trabajadores),
+            'ocupados': sum(1 for t in trabajadores if t['ocupado']),
+            'libres': self._libres.qsize(),
+            'max_trabajos': self.max_trabajos,
+            'max_memoria_mb': self.max_memoria_mb,
+            'trabajadores': trabajadores
+        }
+
+    def cerrar(self):
+        for trabajador in self.trabajadores:
+            trabajador.detener()
@@ -0,0 +1,146 @@
+"""
+Servidor prefork para app.py y appdf.py (Linux/macOS).
+
+El proceso maestro importa el servidor (mediapipe, cv2, sklearn, matplotlib)
+y construye los analizadores una sola vez; después abre el socket y crea N
+hijos con fork(). Los hijos heredan las páginas de las bibliotecas ya
+cargadas (copy-on-write), así que el arranque cuesta una importación en
+lugar de N y cada hijo ocupa menos memoria propia.
+
+Los grafos de MediaPipe no sobreviven a fork(): arrancan hilos internos y un
+hijo creado después (aunque el grafo se haya cerrado) corrompe el heap. Por
+eso el maestro construye los analizadores sin grafo y cada hijo los crea en
+preparar_proceso_hijo() (unos milisegundos frente a segundos de importación),
+se calienta y atiende el socket compartido con el servidor de Werkzeug; el
+kernel reparte las conexiones. El maestro no atiende solicitudes: relanza
+los hijos que mueran y los termina al recibir SIGTERM o SIGINT.
+
+Uso:
+    python prefork.py app --trabajadores 4
+    python prefork.py appdf --puerto 5001
+
+Métricas, caché en memoria y límites de admisión son de cada hijo.
+"""
+import argparse
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+
+PREFORK_TRABAJADORES = int(os.environ.get('OPTISCAN_PREFORK_TRABAJADORES', '0')) or os.cpu_count() or 1
+# Espera antes de relanzar un hijo caído (evita bucles de fork si falla al arrancar)
+ESPERA_RELANZAR_S = 1.0
+
+SERVIDORES = {
+    'app': 5000,
+    'appdf': 5001,
+}
+
+
+def crear_socket(host, puerto):
+    """Socket de escucha compartido por todos los hijos"""
+    familia = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(familia, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, puerto))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def ejecutar_hijo(modulo, sock, host, puerto):
+    """Cuerpo de un proceso hijo: crear los grafos, calentar y atender el socket"""
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    modulo.preparar_proceso_hijo()
+    servidor = make_server(host, puerto, modulo.app, threaded=True, fd=sock.fileno())
+    print(f">>> Trabajador prefork {os.getpid()} atendiendo en http://{host}:{puerto}")
+    servidor.serve_forever()
+
+
+def lanzar_hijo(modulo, sock, host, puerto):
+    pid = os.fork()
+    if pid == 0:
+        codigo = 0
+        try:
+            ejecutar_hijo(modulo, sock, host, puerto)
+        except BaseException as e:
+            print(f"❌ Trabajador prefork {os.getpid()} terminó con error: {e}", file=sys.stderr)
+            codigo = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(codigo)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor prefork de OptiScan")
+    parser.add_argument('servidor', choices=sorted(SERVIDORES))
+    parser.add_argument('--trabajadores', type=int, default=PREFORK_TRABAJADORES)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--puerto', type=int, default=None)
+    args = parser.parse_args()
+
+    if not hasattr(os, 'fork'):
+        sys.exit("❌ El modo prefork necesita fork() (Linux/macOS); en Windows usa waitress-serve")
+    if args.servidor == 'app' and os.environ.get('OPTISCAN_AISLAMIENTO', 'proceso') == 'pool':
+        sys.exit("❌ El modo prefork no se combina con OPTISCAN_AISLAMIENTO=pool")
+
+    puerto = args.puerto or SERVIDORES[args.servidor]
+    trabajadores = max(1, args.trabajadores)
+
+    # El calentamiento y los hilos se dejan para los hijos: el maestro no debe
+    # tener hilos propios al hacer fork()
+    os.environ['OPTISCAN_PREFORK'] = '1'
+    inicio = time.perf_counter()
+    modulo = importlib.import_module(args.servidor)
+    print(f">>> Prefork: {args.servidor} cargado en {time.perf_counter() - inicio:.1f}s, "
+          f"lanzando {trabajadores} trabajadores en el puerto {puerto}")
+
+    sock = crear_socket(args.host, puerto)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    hijos = set()
+    terminando = False
+
+    def terminar(signum, frame):
+        nonlocal terminando
+        terminando = True
+        for pid in list(hijos):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminar)
+    signal.signal(signal.SIGINT, terminar)
+
+    for _ in range(trabajadores):
+        hijos.add(lanzar_hijo(modulo, sock, args.host, puerto))
+
+    while hijos:
+        try:
+            pid, estado = os.wait()
+        except ChildProcessError:
+            break
+        hijos.discard(pid)
+        if terminando:
+            continue
+        print(f"⚠️ Trabajador prefork {pid} terminó (estado {estado}), relanzando")
+        time.sleep(ESPERA_RELANZAR_S)
+        if not terminando:
+            hijos.add(lanzar_hijo(modulo, sock, args.host, puerto))
+
+    sock.close()
+    print(">>> Prefork detenido")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""
+Sesiones de análisis compartidas entre el servidor principal y el de PDF.
+
+/analyze-complete con ?session=1 guarda su resultado bajo un analysis_id
+y /generate-pdf-report lo usa para generar el reporte sin volver a subir
+la imagen ni repetir MediaPipe, las medidas reales y el tono. Sin ese
+parámetro el análisis no toca el almacén: la respuesta ligera por
+defecto no codifica la figura del PDF ni escribe en disco.
+
+Los dos servidores son procesos distintos, así que el almacén es un
+directorio local (un archivo JSON por sesión, escrito de forma atómica)
+con TTL: por defecto un subdirectorio del directorio temporal del sistema
+propio del usuario, común a ambos mientras corran en la misma máquina y
+con el mismo usuario. Guarda imágenes de rostros, así que se crea con
+permisos 0700 (crear_directorio_privado).
+
+Cada sesión se indexa además por el contenido de la imagen, y mientras un
+análisis completo está en curso queda una marca en el directorio: así otro
+hijo de prefork.py que recibe la misma imagen espera ese análisis y
+reutiliza su resultado en lugar de repetirlo. El servidor de PDF solo toma
+una sesión ya guardada de la misma imagen; si no la hay, analiza por su
+cuenta en lugar de ocupar un turno esperando a otro proceso.
+"""
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+from cache_resultados import a_json, clave_cache, crear_directorio_privado
+from plazos import verificar_plazo, plazo_restante
+from campos_respuesta import CAMPO_IMAGEN_FORMA, CAMPO_PUNTOS_FACIALES
+
+# "0" desactiva las sesiones (las respuestas no llevan analysis_id)
+SESIONES_ACTIVAS = os.environ.get('OPTISCAN_SESIONES', '1') != '0'
+# Un directorio por usuario (en Windows el directorio temporal ya lo es)
+SUFIJO_USUARIO = f"_{os.getuid()}" if hasattr(os, 'getuid') else ''
+SESIONES_DIRECTORIO = (os.environ.get('OPTISCAN_SESIONES_DIR')
+                       or os.path.join(tempfile.gettempdir(), f"optiscan_sesiones{SUFIJO_USUARIO}"))
+SESIONES_TTL_S = float(os.environ.get('OPTISCAN_SESIONES_TTL_S', '1800'))
+SESIONES_MAX = int(os.environ.get('OPTISCAN_SESIONES_MAX', '2000'))
+
+# Artefactos que el PDF necesita para la figura; /analyze-complete los
+# calcula siempre que guarda una sesión, aunque no los devuelva
+CAMPOS_SESION = frozenset({CAMPO_IMAGEN_FORMA, CAMPO_PUNTOS_FACIALES})
+
+PARAMETRO_ID = 'analysis_id'
+# Guardar el análisis como sesión es opcional por solicitud (?session=1)
+PARAMETRO_SESION = 'session'
+VALORES_SI = frozenset({'1', 'true', 'si', 'sí', 'yes'})
+# Formato de secrets.token_urlsafe(16): evita rutas arbitrarias en el directorio
+FORMATO_ID = re.compile(r'^[A-Za-z0-9_-]{22}$')
+
+# Cada cuántas escrituras se podan las sesiones expiradas o sobrantes
+PODA_CADA = 50
+
+# Espera máxima por un análisis de la misma imagen en curso en otro proceso;
+# una marca más antigua se considera abandonada (proceso caído)
+SESIONES_ESPERA_S = float(os.environ.get('OPTISCAN_SESIONES_ESPERA_S', '30'))
+SONDEO_S = 0.05
+
+SUFIJO_INDICE = '.imagen'
+SUFIJO_EN_CURSO = '.en_curso'
+
+
+def campos_con_sesion(incluir):
+    """Artefactos a calcular para poder guardar la sesión (None = todos)"""
+    return None if incluir is None else incluir | CAMPOS_SESION
+
+
+def clave_imagen(buffer_imagen):
+    """Clave de la imagen para el índice de sesiones y las marcas de análisis en curso"""
+    return clave_cache(buffer_imagen, 'sesion')
+
+
+def campos_cubiertos(disponibles, pedidos):
+    """True si un análisis con los artefactos `disponibles` sirve para `pedidos`"""
+    if disponibles is None:
+        return True
+    return pedidos is not None and set(pedidos) <= set(disponibles)
+
+
+def leer_sesion_solicitud(req):
+    """True si la solicitud pide guardar el análisis como sesión (query, formulario o JSON)"""
+    valor = req.args.get(PARAMETRO_SESION) or req.form.get(PARAMETRO_SESION)
+    if valor is None and req.is_json:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            valor = data.get(PARAMETRO_SESION)
+    if isinstance(valor, bool):
+        return valor
+    return str(valor).strip().lower() in VALORES_SI if valor is not None else False
+
+
+def leer_id_solicitud(req):
+    """analysis_id de la query string, el formulario o el cuerpo JSON (o None)"""
+    valor = req.args.get(PARAMETRO_ID) or req.form.get(PARAMETRO_ID)
+    if not valor and req.is_json:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            valor = data.get(PARAMETRO_ID)
+    return str(valor).strip() if valor else None
+
+
+class AlmacenSesiones:
+    """Resultados de análisis por analysis_id, en disco y con TTL"""
+
+    def __init__(self, directorio=None, ttl_s=None, max_sesiones=None, activo=None):
+        self.directorio = directorio or SESIONES_DIRECTORIO
+        self.ttl_s = SESIONES_TTL_S if ttl_s is None else ttl_s
+        self.max_sesiones = SESIONES_MAX if max_sesiones is None else max_sesiones
+        self.activo = SESIONES_ACTIVAS if activo is None else activo
+
+        self._lock = threading.Lock()
+        self.guardadas = 0
+        self.leidas = 0
+        self.no_encontradas = 0
+        self.expiradas = 0
+        self.esperas = 0
+        self.reutilizadas_por_imagen = 0
+
+        if self.activo:
+            try:
+                crear_directorio_privado(self.directorio)
+            except OSError as e:
+                print(f">>> Sesiones: no se pudo usar {self.directorio} ({e}), desactivadas")
+                self.activo = False
+
+        print(f">>> Sesiones de análisis: {self.directorio if self.activo else 'desactivadas'}, "
+              f"TTL {self.ttl_s:.0f}s")
+
+    def _ruta(self, analysis_id):
+        return os.path.join(self.directorio, f"{analysis_id}.json")
+
+    def _escribir(self, ruta, contenido):
+        # Escritura atómica: el otro servidor nunca lee un archivo a medias
+        serializado = json.dumps(contenido, ensure_ascii=False, default=a_json)
+        fd, temporal = tempfile.mkstemp(dir=self.directorio, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(serializado)
+        os.replace(temporal, ruta)
+
+    def _leer_vigente(self, ruta, vigencia_s):
+        """Contenido JSON de ruta si existe y no es más antiguo que vigencia_s"""
+        try:
+            if time.time() - os.path.getmtime(ruta) > vigencia_s:
+                return None
+            with open(ruta, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def guardar(self, resultado, clave=None, campos=None):
+        """Guardar un resultado y devolver su analysis_id (None si no se pudo)
+
+        Con `clave` (clave_imagen) la sesión queda indexada por la imagen,
+        junto con los artefactos que contiene (`campos`, None = todos).
+        """
+        if not self.activo:
+            return None
+        analysis_id = secrets.token_urlsafe(16)
+        try:
+            self._escribir(self._ruta(analysis_id), resultado)
+            if clave:
+                self._escribir(os.path.join(self.directorio, clave + SUFIJO_INDICE), {
+                    'analysis_id': analysis_id,
+                    'campos': None if campos is None else sorted(campos)
+                })
+        except (TypeError, ValueError, OSError) as e:
+            print(f">>> Sesiones: no se pudo guardar el análisis ({e})")
+            return None
+
+        with self._lock:
+            self.guardadas += 1
+            podar = self.guardadas % PODA_CADA == 0
+        if podar:
+            self.podar()
+        return analysis_id
+
+    def obtener(self, analysis_id):
+        """Resultado guardado bajo analysis_id, o None si no existe o expiró"""
+        if not self.activo or not analysis_id or not FORMATO_ID.match(analysis_id):
+            with self._lock:
+                self.no_encontradas += 1
+            return None
+
+        ruta = self._ruta(analysis_id)
+        try:
+            if time.time() - os.path.getmtime(ruta) > self.ttl_s:
+                os.remove(ruta)
+                with self._lock:
+                    self.expiradas += 1
+                return None
+            with open(ruta, 'r', encoding='utf-8') as f:
+                resultado = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.no_encontradas += 1
+            return None
+
+        with self._lock:
+            self.leidas += 1
+        return resultado
+
+    def id_por_imagen(self, clave, campos=None):
+        """analysis_id vigente de la imagen que cubre `campos`, o None"""
+        if not self.activo:
+            return None
+        indice = self._leer_vigente(os.path.join(self.directorio, clave + SUFIJO_INDICE), self.ttl_s)
+        if not isinstance(indice, dict) or not campos_cubiertos(indice.get('campos'), campos):
+            return None
+        analysis_id = indice.get('analysis_id')
+        if not analysis_id or not os.path.exists(self._ruta(analysis_id)):
+            return None
+        return analysis_id
+
+    def publicar(self, resultado, clave, campos=None):
+        """analysis_id del resultado: el ya indexado para la imagen o uno nuevo"""
+        return self.id_por_imagen(clave, campos) or self.guardar(resultado, clave, campos)
+
+    @contextmanager
+    def en_curso(self, clave, campos=None):
+        """Marcar un análisis completo de la imagen en curso mientras dura el bloque"""
+        ruta = os.path.join(self.directorio, clave + SUFIJO_EN_CURSO)
+        marcado = False
+        if self.activo:
+            try:
+                self._escribir(ruta, {
+                    'pid': os.getpid(),
+                    'campos': None if campos is None else sorted(campos)
+                })
+                marcado = True
+            except OSError as e:
+                print(f">>> Sesiones: no se pudo marcar el análisis en curso ({e})")
+        try:
+            yield
+        finally:
+            if marcado:
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    pass
+
+    def buscar_por_imagen(self, clave, campos=None):
+        """Sesión ya guardada de la misma imagen que cubre `campos`, sin esperar
+
+        Devuelve (analysis_id, resultado) o (None, None).
+        """
+        analysis_id = self.id_por_imagen(clave, campos)
+        resultado = self.obtener(analysis_id) if analysis_id else None
+        if resultado is None:
+            return None, None
+        with self._lock:
+            self.reutilizadas_por_imagen += 1
+        return analysis_id, resultado
+
+    def esperar_por_imagen(self, clave, campos=None, espera_s=None):
+        """Resultado de un análisis completo de la misma imagen, guardado o en curso
+
+        Si otro proceso está analizando la imagen con artefactos que cubren
+        `campos`, espera (como mucho espera_s, y nunca más allá del plazo de
+        la solicitud) a que publique su sesión.
+        Devuelve (analysis_id, resultado) o (None, None).
+        """
+        if not self.activo:
+            return None, None
+        espera_s = SESIONES_ESPERA_S if espera_s is None else espera_s
+        marca = os.path.join(self.directorio, clave + SUFIJO_EN_CURSO)
+        limite = time.monotonic() + plazo_restante(espera_s)
+        espero = False
+        while True:
+            analysis_id, resultado = self.buscar_por_imagen(clave, campos)
+            if resultado is not None:
+                if espero:
+                    with self._lock:
+                        self.esperas += 1
+                return analysis_id, resultado
+
+            en_curso = self._leer_vigente(marca, espera_s)
+            if not isinstance(en_curso, dict) or not campos_cubiertos(en_curso.get('campos'), campos):
+                return None, None
+            # Plazo vencido o cliente desconectado: no seguir esperando ni analizar
+            verificar_plazo('espera_sesion')
+            if time.monotonic() >= limite:
+                return None, None
+            if not espero:
+                print(f">>> Análisis de la misma imagen en curso (pid {en_curso.get('pid')}), esperando")
+                espero = True
+            time.sleep(SONDEO_S)
+
+    def podar(self):
+        """Borrar las sesiones expiradas y, si sobran, las más antiguas
+
+        También los índices por imagen expirados y las marcas abandonadas.
+        """
+        try:
+            archivos = [e for e in os.scandir(self.directorio)
+                        if e.name.endswith(('.json', SUFIJO_INDICE, SUFIJO_EN_CURSO))]
+        except OSError:
+            return
+        ahora = time.time()
+        vigentes = []
+        for entrada in archivos:
+            try:
+                guardado = entrada.stat().st_mtime
+                vigencia = SESIONES_ESPERA_S if entrada.name.endswith(SUFIJO_EN_CURSO) else self.ttl_s
+                if ahora - guardado > vigencia:
+                    os.remove(entrada.path)
+                elif entrada.name.endswith('.json'):
+                    vigentes.append((guardado, entrada.path))
+            except OSError:
+                pass
+        vigentes.sort()
+        for _, ruta in vigentes[:max(0, len(vigentes) - self.max_sesiones)]:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'activo': self.activo,
+                'directorio': self.directorio,
+                'ttl_s': self.ttl_s,
+                'guardadas': self.guardadas,
+                'leidas': self.leidas,
+                'no_encontradas': self.no_encontradas,
+                'expiradas': self.expiradas,
+                'reutilizadas_por_imagen': self.reutilizadas_por_imagen,
+                'esperas': self.esperas
+            }
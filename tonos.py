@@ -2,30 +2,48 @@ import cv2
 import numpy as np
 import mediapipe as mp
 import os
-import json
 import sys
 import base64
+import threading
 from collections import Counter
 from sklearn.cluster import KMeans
+from malla import detectar_landmarks, landmarks_a_pixeles, imagen_deteccion
+from imagen_solicitud import imagen_desde_entrada, ErrorImagenSolicitud
+from campos_respuesta import incluye, CAMPO_IMAGEN_TONO
+from canal_resultado import abrir_canal_resultado, enviar_resultado
+from metricas import etapa, medir, ETAPA_KMEANS, ETAPA_CLASIFICACION, ETAPA_CODIFICAR_JPEG
 
 # Configurar la codificación para Windows
 if sys.platform == "win32":
     sys.stdout.reconfigure(encoding='utf-8')
 
 class AnalizadorTonoPielMejorado:
-    def __init__(self):
+    def __init__(self, crear_grafo=True):
         # Inicializar MediaPipe Face Mesh con configuraciones mejoradas
         self.mp_face_mesh = mp.solutions.face_mesh
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
+        # Con crear_grafo=False el grafo se crea después con iniciar_grafo():
+        # un grafo de MediaPipe no sobrevive a fork() (modo prefork)
+        self.face_mesh = self.crear_face_mesh() if crear_grafo else None
+        # FaceMesh no admite llamadas concurrentes sobre el mismo grafo
+        self.lock_face_mesh = threading.Lock()
+        self.mp_drawing = mp.solutions.drawing_utils
+        self.mp_drawing_styles = mp.solutions.drawing_styles
+        print(">>> Analizador de Tono de Piel Mejorado inicializado")
+    
+    def crear_face_mesh(self):
+        """Construir el grafo de MediaPipe Face Mesh"""
+        return self.mp_face_mesh.FaceMesh(
             static_image_mode=True,
             max_num_faces=1,
             refine_landmarks=True,
             min_detection_confidence=0.7,  # Aumentado para mejor precisión
             min_tracking_confidence=0.7
         )
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.mp_drawing_styles = mp.solutions.drawing_styles
-        print(">>> Analizador de Tono de Piel Mejorado inicializado")
+
+    def iniciar_grafo(self):
+        """Crear el grafo diferido con crear_grafo=False (en cada hijo de prefork.py)"""
+        if self.face_mesh is None:
+            self.face_mesh = self.crear_face_mesh()
     
     def cargar_imagen(self, ruta_imagen):
         """Cargar y preparar imagen"""
@@ -35,8 +53,9 @@ class AnalizadorTonoPielMejorado:
                 return None, None
             
             # No voltear la imagen para mantener coordenadas originales
-            # Voltear solo para visualización si es necesario
-            imagen_rgb = cv2.cvtColor(imagen, cv2.COLOR_BGR2RGB)
+            # Voltear solo para visualización si es necesario.
+            # El tono se analiza sobre la imagen reducida a la resolución de detección
+            imagen_rgb = imagen_deteccion(imagen)
             return imagen, imagen_rgb
         except Exception as e:
             print(f"Error cargando imagen: {e}")
@@ -44,23 +63,18 @@ class AnalizadorTonoPielMejorado:
     
     def detectar_puntos_faciales(self, imagen_rgb):
         """Detectar puntos faciales con MediaPipe"""
-        resultados = self.face_mesh.process(imagen_rgb)
+        with self.lock_face_mesh:
+            landmarks = detectar_landmarks(self.face_mesh, imagen_rgb)
         
-        if not resultados.multi_face_landmarks:
+        if landmarks is None:
             print("No se detectaron rostros en la imagen")
             return None
         
-        landmarks = resultados.multi_face_landmarks[0]
         h, w, _ = imagen_rgb.shape
-        puntos = []
-        
-        for landmark in landmarks.landmark:
-            x = int(landmark.x * w)
-            y = int(landmark.y * h)
-            puntos.append((x, y))
+        puntos = landmarks_a_pixeles(landmarks, w, h)
         
         print(f"Detectados {len(puntos)} puntos faciales")
-        return np.array(puntos)
+        return puntos
     
     def obtener_mascara_facial_completa(self, imagen, puntos_faciales):
         """Crear máscara completa del rostro usando convex hull"""
@@ -234,7 +248,8 @@ class AnalizadorTonoPielMejorado:
         # Usar K-Means para encontrar colores principales
         n_clusters = min(3, len(colores_array))
         kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        labels = kmeans.fit_predict(colores_array)
+        with medir(ETAPA_KMEANS):
+            labels = kmeans.fit_predict(colores_array)
         
         # Encontrar el cluster más grande y más representativo
         cluster_counts = Counter(labels)
@@ -271,6 +286,7 @@ class AnalizadorTonoPielMejorado:
         
         return True
     
+    @etapa(ETAPA_CLASIFICACION)
     def clasificar_tono_piel(self, color_rgb):
         """Clasificar el tono de piel en categorías mejoradas"""
         r, g, b = color_rgb
@@ -445,8 +461,12 @@ class AnalizadorTonoPielMejorado:
             'explicacion': f"Para {categoria.lower()} con subtipo {subtipo.lower()}"
         }
     
-    def analizar_tono_piel(self, ruta_imagen):
-        """Analizar tono de piel completo con método mejorado"""
+    def analizar_tono_piel(self, ruta_imagen, incluir=None):
+        """Analizar tono de piel completo con método mejorado
+
+        `incluir` limita los artefactos pesados (ver campos_respuesta.py);
+        None los incluye todos.
+        """
         try:
             print(f">>> Iniciando análisis de: {ruta_imagen}")
             
@@ -460,16 +480,60 @@ class AnalizadorTonoPielMejorado:
             
             print(">>> Imagen cargada correctamente")
             
-            # Detectar puntos faciales
-            puntos_faciales = self.detectar_puntos_faciales(imagen_rgb)
-            if puntos_faciales is None:
-                return {
-                    'estado': 'error',
-                    'error': 'No se detectaron rostros en la imagen'
-                }
-            
-            print(">>> Puntos faciales detectados")
+            return self.analizar_tono_rgb(imagen_rgb, incluir, imagen.shape)
             
+        except Exception as e:
+            print(f">>> Error en análisis: {str(e)}")
+            return {
+                'estado': 'error',
+                'error': f'Error en análisis: {str(e)}'
+            }
+    
+    def analizar_tono_piel_imagen(self, imagen, incluir=None):
+        """Analizar tono de piel desde memoria, sin archivos temporales
+
+        `imagen` puede ser bytes codificados (JPEG/PNG) o un ndarray BGR.
+        """
+        try:
+            imagen = imagen_desde_entrada(imagen)
+        except ErrorImagenSolicitud as e:
+            print(f">>> Error cargando imagen: {e}")
+            return {
+                'estado': 'error',
+                'error': 'No se pudo cargar la imagen'
+            }
+        
+        try:
+            imagen_rgb = imagen_deteccion(imagen)
+            return self.analizar_tono_rgb(imagen_rgb, incluir, imagen.shape)
+        except Exception as e:
+            print(f">>> Error en análisis: {str(e)}")
+            return {
+                'estado': 'error',
+                'error': f'Error en análisis: {str(e)}'
+            }
+    
+    def analizar_tono_rgb(self, imagen_rgb, incluir=None, forma_original=None):
+        """Detectar puntos faciales y analizar el tono de una imagen RGB"""
+        puntos_faciales = self.detectar_puntos_faciales(imagen_rgb)
+        if puntos_faciales is None:
+            return {
+                'estado': 'error',
+                'error': 'No se detectaron rostros en la imagen'
+            }
+        
+        print(">>> Puntos faciales detectados")
+        
+        return self.analizar_tono_desde_puntos(imagen_rgb, puntos_faciales, incluir, forma_original)
+    
+    def analizar_tono_desde_puntos(self, imagen_rgb, puntos_faciales, incluir=None, forma_original=None):
+        """Analizar tono de piel a partir de puntos faciales ya detectados
+
+        `puntos_faciales` debe estar en coordenadas de `imagen_rgb` (sin voltear).
+        Con `forma_original` (shape de la imagen sin reducir) el área de piel
+        se expresa en píxeles de la imagen original.
+        """
+        try:
             # Crear máscara de piel precisa
             mascara = self.crear_mascara_piel_precisa(imagen_rgb, puntos_faciales)
             
@@ -477,6 +541,9 @@ class AnalizadorTonoPielMejorado:
             area_piel = cv2.countNonZero(mascara)
             area_total = mascara.shape[0] * mascara.shape[1]
             porcentaje_piel = (area_piel / area_total) * 100
+            if forma_original is not None:
+                # Escalar por el factor de área de la reducción (ver malla.py)
+                area_piel = round(area_piel * forma_original[0] * forma_original[1] / area_total)
             
             print(f">>> Área de piel detectada: {area_piel} pixeles ({porcentaje_piel:.1f}%)")
             
@@ -502,30 +569,34 @@ class AnalizadorTonoPielMejorado:
             # Generar recomendaciones
             recomendaciones = self.generar_recomendaciones_colores(clasificacion)
             
-            # Convertir imagen a base64 para visualización
-            try:
-                # Crear imagen de visualización con máscara
-                imagen_visualizacion = imagen_rgb.copy()
-                imagen_visualizacion[mascara == 0] = [0, 0, 0]  # Hacer negro el fondo no piel
-                
-                # Convertir a BGR para JPEG
-                imagen_visualizacion_bgr = cv2.cvtColor(imagen_visualizacion, cv2.COLOR_RGB2BGR)
-                _, buffer = cv2.imencode('.jpg', imagen_visualizacion_bgr)
-                imagen_base64 = base64.b64encode(buffer).decode('utf-8')
-            except Exception as e:
-                print(f">>> Error generando imagen base64: {e}")
-                imagen_base64 = None
-            
-            return {
+            resultado = {
                 'estado': 'exitoso',
                 'clasificacion': clasificacion,
                 'recomendaciones': recomendaciones,
-                'imagen_base64': imagen_base64,
                 'area_piel_pixeles': int(area_piel),
                 'porcentaje_piel': float(porcentaje_piel),
                 'metodo': 'analisis_tono_piel_mejorado'
             }
             
+            # Visualización de la máscara: solo si se pide
+            if incluye(incluir, CAMPO_IMAGEN_TONO):
+                # Convertir imagen a base64 para visualización
+                try:
+                    # Crear imagen de visualización con máscara
+                    imagen_visualizacion = imagen_rgb.copy()
+                    imagen_visualizacion[mascara == 0] = [0, 0, 0]  # Hacer negro el fondo no piel
+                    
+                    # Convertir a BGR para JPEG
+                    imagen_visualizacion_bgr = cv2.cvtColor(imagen_visualizacion, cv2.COLOR_RGB2BGR)
+                    with medir(ETAPA_CODIFICAR_JPEG):
+                        _, buffer = cv2.imencode('.jpg', imagen_visualizacion_bgr)
+                    resultado['imagen_base64'] = base64.b64encode(buffer).decode('utf-8')
+                except Exception as e:
+                    print(f">>> Error generando imagen base64: {e}")
+                    resultado['imagen_base64'] = None
+            
+            return resultado
+            
         except Exception as e:
             print(f">>> Error en análisis: {str(e)}")
             return {
@@ -533,10 +604,15 @@ class AnalizadorTonoPielMejorado:
                 'error': f'Error en análisis: {str(e)}'
             }
 
-def analizar_tono_imagen(ruta_imagen):
-    """Función principal para análisis de tono desde archivo"""
+def analizar_tono_imagen(ruta_imagen, analizador=None):
+    """Función principal para análisis de tono desde archivo
+
+    Si se recibe un analizador ya inicializado se reutiliza, evitando
+    reconstruir el grafo de MediaPipe en cada llamada.
+    """
     try:
-        analizador = AnalizadorTonoPielMejorado()
+        if analizador is None:
+            analizador = AnalizadorTonoPielMejorado()
         resultado = analizador.analizar_tono_piel(ruta_imagen)
         return resultado
     except Exception as e:
@@ -545,6 +621,18 @@ def analizar_tono_imagen(ruta_imagen):
             'error': f'Error en el análisis de tono: {str(e)}'
         }
 
+def analizar_tono_memoria(imagen, analizador=None, incluir=None):
+    """Función principal para análisis de tono desde memoria (bytes o ndarray BGR)"""
+    try:
+        if analizador is None:
+            analizador = AnalizadorTonoPielMejorado()
+        return analizador.analizar_tono_piel_imagen(imagen, incluir)
+    except Exception as e:
+        return {
+            'estado': 'error',
+            'error': f'Error en el análisis de tono: {str(e)}'
+        }
+
 def principal(ruta_imagen=None):
     """Función principal para ejecución local"""
     if ruta_imagen is None:
@@ -563,6 +651,9 @@ def principal(ruta_imagen=None):
     return resultado
 
 if __name__ == "__main__":
+    # stdout queda reservado para el resultado JSON; los diagnósticos van a stderr
+    canal = abrir_canal_resultado()
+
     ruta_imagen = None
     
     if len(sys.argv) > 1:
@@ -573,13 +664,11 @@ if __name__ == "__main__":
     
     try:
         resultado = principal(ruta_imagen)
-        json_output = json.dumps(resultado, ensure_ascii=False)
-        print(json_output)
-        sys.stdout.flush()
     except Exception as e:
-        error_output = json.dumps({
+        resultado = {
             'estado': 'error',
             'error': f'Error ejecutando el análisis: {str(e)}'
-        }, ensure_ascii=False)
-        print(error_output)
-        sys.stdout.flush()
\ No newline at end of file
+        }
+    
+    # Un único mensaje por el canal de resultados
+    enviar_resultado(canal, resultado)
\ No newline at end of file
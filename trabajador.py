@@ -0,0 +1,123 @@
+"""
+Proceso trabajador persistente para los analizadores de OptiScan.
+
+Carga los analizadores de main.py y tonos.py una sola vez y atiende
+trabajos de forma, tono o análisis completo con un protocolo JSON-lines:
+una solicitud por línea en stdin y exactamente una respuesta por línea en
+stdout. La imagen viaja en la propia solicitud ("imagen", JPEG/PNG en
+base64) y se analiza en memoria; "ruta" se sigue aceptando. "incluir"
+(lista opcional) limita los artefactos pesados de la respuesta. Cada
+respuesta trae en "etapas" la duración de las etapas medidas (metricas.py)
+para que el servidor las registre en sus histogramas. Con "plazo_s" el
+análisis se abandona al vencer el plazo (plazos.py) y la respuesta lleva
+"cancelado" y "etapa".
+Los print de diagnóstico de los analizadores (y lo que escriban bibliotecas
+en C) se desvían a stderr para que nunca se mezclen con el canal de
+respuestas (canal_resultado.py).
+
+Uso: python trabajador.py
+"""
+import base64
+import json
+import os
+import sys
+
+from canal_resultado import abrir_canal_resultado
+from metricas import medir, recolectar_etapas, ETAPA_DECODIFICAR_BASE64
+from plazos import Plazo, AnalisisCancelado, activar_plazo
+
+
+def enviar_mensaje(canal, mensaje):
+    """Escribir un mensaje como una sola línea JSON (ASCII, sin saltos internos)"""
+    canal.write(json.dumps(mensaje, ensure_ascii=True) + '\n')
+    canal.flush()
+
+
+def decodificar_mensaje(linea):
+    """Decodificar una línea del protocolo; None si no es un mensaje válido"""
+    linea = linea.strip()
+    if not linea:
+        return None
+    try:
+        mensaje = json.loads(linea)
+    except json.JSONDecodeError:
+        return None
+    return mensaje if isinstance(mensaje, dict) else None
+
+
+def leer_imagen_mensaje(solicitud):
+    """Bytes codificados de la imagen de una solicitud ("imagen" en base64 o "ruta")"""
+    if 'imagen' in solicitud:
+        with medir(ETAPA_DECODIFICAR_BASE64):
+            return base64.b64decode(solicitud['imagen'])
+    with open(solicitud['ruta'], 'rb') as f:
+        return f.read()
+
+
+def cargar_funciones_analisis():
+    """Construir los analizadores una vez y devolver la función de cada tipo de trabajo"""
+    from main import AnalizadorFormaRostroAvanzado, analizar_imagen_memoria
+    from tonos import AnalizadorTonoPielMejorado, analizar_tono_memoria
+    from pipeline import PipelineAnalisisCompleto
+
+    from calentamiento import (EstadoPreparacion, imagen_calentamiento, calentar_forma,
+                               calentar_tono, calentar_completo)
+
+    analizador_forma = AnalizadorFormaRostroAvanzado()
+    analizador_tono = AnalizadorTonoPielMejorado()
+    pipeline = PipelineAnalisisCompleto(analizador_forma, analizador_tono)
+
+    # Calentar antes de anunciarse listo: el pool nunca entrega un trabajador frío
+    imagen = imagen_calentamiento()
+    EstadoPreparacion().ejecutar([
+        ('forma', lambda: calentar_forma(analizador_forma, imagen)),
+        ('tono', lambda: calentar_tono(analizador_tono, imagen)),
+        ('completo', lambda: calentar_completo(pipeline, imagen)),
+    ])
+
+    return {
+        'forma': lambda imagen, incluir: analizar_imagen_memoria(imagen, analizador_forma, incluir),
+        'tono': lambda imagen, incluir: analizar_tono_memoria(imagen, analizador_tono, incluir),
+        'completo': pipeline.analizar_imagen
+    }
+
+
+def principal():
+    """Bucle principal del trabajador"""
+    # El stdout real queda reservado para el protocolo
+    canal = abrir_canal_resultado()
+
+    funciones_analisis = cargar_funciones_analisis()
+    enviar_mensaje(canal, {'listo': True, 'pid': os.getpid()})
+
+    for linea in sys.stdin:
+        solicitud = decodificar_mensaje(linea)
+        if solicitud is None:
+            continue
+
+        if solicitud.get('accion') == 'salir':
+            break
+
+        try:
+            funcion_analisis = funciones_analisis[solicitud['tipo']]
+            incluir = solicitud.get('incluir')
+            plazo_s = solicitud.get('plazo_s')
+            # Plazo ya vencido: un mínimo positivo (0 sería "sin plazo")
+            plazo = Plazo(max(plazo_s, 0.001)) if plazo_s is not None else None
+            with recolectar_etapas() as etapas, activar_plazo(plazo):
+                resultado = funcion_analisis(
+                    leer_imagen_mensaje(solicitud),
+                    frozenset(incluir) if incluir is not None else None
+                )
+            respuesta = {'id': solicitud.get('id'), 'ok': True, 'resultado': resultado, 'etapas': etapas}
+        except AnalisisCancelado as e:
+            respuesta = {'id': solicitud.get('id'), 'ok': False, 'error': str(e),
+                         'cancelado': e.motivo, 'etapa': e.etapa}
+        except Exception as e:
+            respuesta = {'id': solicitud.get('id'), 'ok': False, 'error': str(e)}
+
+        enviar_mensaje(canal, respuesta)
+
+
+if __name__ == "__main__":
+    principal()
@@ -0,0 +1,135 @@
+"""
+Coalescencia de análisis idénticos en curso ("single flight").
+
+Si llegan a la vez varias solicitudes con la misma clave (mismo contenido
+de imagen, tipo de análisis y artefactos pedidos), solo la primera ejecuta
+el análisis; las demás esperan a que termine y reciben una copia de su
+resultado, o la misma excepción si falla. Complementa a la caché de
+resultados, que solo ayuda cuando el primer análisis ya terminó.
+
+El mapa de vuelos es de este proceso; entre el servidor principal y el de
+PDF (o entre hijos de prefork.py) la coordinación pasa por las sesiones de
+análisis (sesiones_analisis.py).
+"""
+import copy
+import threading
+
+from plazos import verificar_plazo
+
+# Cada cuánto comprueba un seguidor su propio plazo mientras espera
+ESPERA_SONDEO_S = 0.1
+
+
+class _Vuelo:
+    """Un análisis en curso y las solicitudes que esperan su resultado"""
+
+    def __init__(self):
+        self.terminado = threading.Event()
+        self.resultado = None
+        self.error = None
+        self.abandonado = False
+        self.seguidores = 0
+
+
+class VueloUnico:
+    """Mapa clave -> análisis en curso"""
+
+    def __init__(self):
+        self._vuelos = {}
+        self._lock = threading.Lock()
+        self.ejecutados = 0
+        self.compartidos = 0
+        self.errores_compartidos = 0
+
+    def unirse(self, clave):
+        """Devolver (vuelo, lider): abrir el vuelo de la clave o unirse al que ya corre
+
+        El líder debe cerrarlo con terminar(); para cálculos que no son una
+        función (p. ej. un generador). Lo habitual es usar ejecutar().
+        """
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            if vuelo is None:
+                vuelo = self._vuelos[clave] = _Vuelo()
+                return vuelo, True
+            vuelo.seguidores += 1
+            return vuelo, False
+
+    def terminar(self, clave, vuelo, resultado=None, error=None, abandonado=False):
+        """Cerrar el vuelo del líder; devuelve cuántas solicitudes lo esperaban
+
+        Con abandonado=True (el líder no llegó a un resultado, p. ej. el
+        cliente se desconectó) los seguidores vuelven a intentarlo.
+        """
+        vuelo.resultado = resultado
+        vuelo.error = error
+        vuelo.abandonado = abandonado
+        with self._lock:
+            del self._vuelos[clave]
+            self.ejecutados += 1
+            seguidores = vuelo.seguidores
+        vuelo.terminado.set()
+        return seguidores
+
+    def esperar(self, vuelo):
+        """Copia del resultado del líder (lanza su excepción); None si lo abandonó
+
+        La espera respeta el plazo de la solicitud que espera (plazos.py).
+        """
+        while not vuelo.terminado.wait(ESPERA_SONDEO_S):
+            verificar_plazo('espera_vuelo')
+        if vuelo.abandonado:
+            return None
+        with self._lock:
+            if vuelo.error is not None:
+                self.errores_compartidos += 1
+            else:
+                self.compartidos += 1
+        if vuelo.error is not None:
+            raise vuelo.error
+        # Cada seguidor recibe su copia: los endpoints pueden modificar el resultado
+        return copy.deepcopy(vuelo.resultado)
+
+    def ejecutar(self, clave, funcion, *args, **kwargs):
+        """Devolver (resultado, compartido): ejecutar funcion o esperar la que ya corre
+
+        compartido es True si el resultado vino de otra solicitud en curso.
+        """
+        while True:
+            vuelo, lider = self.unirse(clave)
+            if lider:
+                break
+            resultado = self.esperar(vuelo)
+            if not vuelo.abandonado:
+                return resultado, True
+
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as e:
+            self.terminar(clave, vuelo, error=e)
+            raise
+        except BaseException:
+            # Cancelación del líder (plazos.AnalisisCancelado): no es un
+            # error del análisis, los seguidores lo intentan por su cuenta
+            self.terminar(clave, vuelo, abandonado=True)
+            raise
+
+        # Con seguidores, el original queda intacto para que lo copien ellos
+        if self.terminar(clave, vuelo, resultado):
+            return copy.deepcopy(resultado), False
+        return resultado, False
+
+    @property
+    def en_curso(self):
+        with self._lock:
+            return len(self._vuelos)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'en_curso': len(self._vuelos),
+                'esperando': sum(v.seguidores for v in self._vuelos.values()),
+                'ejecutados': self.ejecutados,
+                'compartidos': self.compartidos,
+                'errores_compartidos': self.errores_compartidos
+            }